@@ -36,7 +36,9 @@ from dataclasses import dataclass
 from dataclasses import field
 from typing import Dict
 from typing import Final
+from typing import FrozenSet
 from typing import List
+from typing import Tuple
 
 import pkg_resources
 
@@ -114,14 +116,21 @@ class Library:
     guides: guide detail objects
     targets: unique guide sequences
     target_to_guides: mappings of target sequences back to guides
+    target_ids: target sequence to its position in targets, assigned on creation
     """
 
     header: LibraryHeader
     guides: List[Guide]
     targets: List[str]
     target_to_guides: Dict[str, List[int]]
+    target_ids: Dict[str, int] = None
     _sgrna_ids_by_seq: Dict[str, int] = None
-    _guide_by_sgrna_set: Dict[str, int] = None
+    _guide_by_target_ids: Dict[Tuple[int, ...], List[int]] = None
+    _target_guides: List[FrozenSet[int]] = None
+
+    def __post_init__(self):
+        if self.target_ids is None:
+            self.target_ids = {target: t_id for t_id, target in enumerate(self.targets)}
 
     def min_target_len(self) -> int:
         return len(min(self.targets, key=len))
@@ -146,17 +155,33 @@ class Library:
             self._sgrna_ids_by_seq = sgrna_ids_by_seq
         return self._sgrna_ids_by_seq[target_seq]
 
-    def guide_by_sgrna_set(self, seq_l, seq_r) -> List[int]:
-        match = f"{seq_l}|{seq_r}"
-        if self._guide_by_sgrna_set is None:
+    def target_guides(self, target_seq) -> FrozenSet[int]:
+        """
+        guide indexes including the target at any position
+        """
+        if self._target_guides is None:
+            self._target_guides = [frozenset(self.target_to_guides[t]) for t in self.targets]
+        return self._target_guides[self.target_ids[target_seq]]
+
+    def guide_by_target_ids(self, t_id_l: int, t_id_r: int) -> List[int]:
+        """
+        guide indexes with exactly these targets, in order, None when there are none
+        """
+        if self._guide_by_target_ids is None:
             data = {}
             for i, g in enumerate(self.guides):
-                composite_guide = g.composite_sgrna_seq()
-                if composite_guide not in data:
-                    data[composite_guide] = []
-                data[composite_guide].append(i)
-            self._guide_by_sgrna_set = data
-        return self._guide_by_sgrna_set.get(match)
+                t_ids = tuple([self.target_ids[seq] for seq in g.sgrna_seqs])
+                if t_ids not in data:
+                    data[t_ids] = []
+                data[t_ids].append(i)
+            self._guide_by_target_ids = data
+        return self._guide_by_target_ids.get((t_id_l, t_id_r))
+
+    def guide_by_sgrna_set(self, seq_l, seq_r) -> List[int]:
+        """
+        guide_by_target_ids() for callers holding target sequences, pycroquet itself looks up by target id
+        """
+        return self.guide_by_target_ids(self.target_ids.get(seq_l), self.target_ids.get(seq_r))
 
 
 @dataclass
@@ -180,6 +205,8 @@ class Stats:
     length_excluded_reads: int = None
     low_count_guides_user: Dict[str, int] = None
     reversed_reads: bool = False
+    # fastq only, detected while parsing
+    phred_offset: int = None
     version: str = None
     command: str = None
     sample_name: str = None
@@ -203,6 +230,26 @@ class Stats:
         return json.dumps(self.__dict__, sort_keys=True, indent=2)
 
 
+@dataclass
+class HtsOptions:
+    """
+    Alignment output settings
+    output_format: cram, bam or unsorted (uncompressed bam in bucket order, not indexed)
+    level: compression level of the final file, htslib default when None
+    profile: cram codec profile (fast, normal, small, archive)
+    bucket_level: compression level of the intermediate bucket files, 0 is uncompressed
+    write_threads: threads encoding the final file, 0 to use --cpus (max 4)
+    unmapped: keep, drop or separate (unsorted bam of unmapped records only)
+    """
+
+    output_format: str = "cram"
+    level: int = None
+    profile: str = None
+    bucket_level: int = 1
+    write_threads: int = 0
+    unmapped: str = "keep"
+
+
 @dataclass
 class Seqread:
     """
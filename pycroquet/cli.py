@@ -51,6 +51,7 @@ LOG_LEVELS = ("WARNING", "INFO", "DEBUG")
 HELP_TRIMSEQ = "Trim reads back to use first N bases only. This is a destructive process, the alignment CRAM will not include the full read sequence."
 HELP_GUIDELIB = "Expanded guide library definition tsv file with optional headers (common format for single/dual/other)"
 HELP_QUERIES = "Query sequence file (fastq[.gz], sam, bam, cram)"
+HELP_QUERIES_R2 = "Read 2 fastq[.gz] of synchronised read 1/read 2 files, '--queries' is then read 1.  Not required for interleaved fastq."
 HELP_SAMPLE = (
     "Sample name to apply to count column, required for fastq, interrogate header for others when not defined."
 )
@@ -60,7 +61,7 @@ HELP_RULES = "Rules for allowing fuzzy matching (no rules = fast exact/substr ma
 HELP_LOW_COUNT = (
     "*.stats.json includes low_count_guides_lt_{15,30}, this option allow specification of an additional cut-off."
 )
-HELP_QUAL_OFFSET = "Specify phread offset (for fastq) if detection by readname fails"
+HELP_QUAL_OFFSET = "Specify phread offset (for fastq) if detection from readname and quality range fails"
 HELP_CPUS = "CPUs to use (0 to detect)"
 HELP_SGE_UNIQUE = "Only generate the unique sequence counts file, then exit (--guide can be omitted)"
 HELP_CHUNKS = "Reads per mapping block"
@@ -68,8 +69,57 @@ HELP_MINSCORE = "Minimum score to retain, regardless of rule penalties.  Perfect
 HELP_REFERENCE = "Required for cram"
 HELP_EXCLUDEQCF = "Exclude reads that fail QC (sam/bam/cram, CASAVA fastq only)"
 HELP_NO_ALIGNMENT = "Do not output cram alignments"
+HELP_DG_NO_ALIGNMENT = (
+    "Do not output cram alignments, counts are generated from the unique read pairs without reading the input again"
+)
 HELP_BOUNDARY = "Control boundary matching types, see end of options"
 HELP_FASTA = "Write fasta to this file"
+HELP_PACK_SEQS = (
+    "Hold unique read sequences as 2-bit packed keys, reduces memory for high diversity inputs at some CPU cost"
+)
+
+HELP_MAX_MEMORY = (
+    "Approximate memory budget (MB) for the unique read table only, spills hash partitions to the workspace when "
+    "exceeded.  Alignment results are still held for every sequence, except by single-guide/long-read with "
+    "'--no-alignment' (see README)"
+)
+
+HELP_MISMATCH_INDEX = (
+    "With mismatch only rules and '-b exact' rank guides by mismatches via an index instead of alignment, "
+    "results can differ from alignment (see README)"
+)
+
+HELP_STRICT_HEADERS = "Validate every FastQ header, by default the format is detected from the first record"
+
+HELP_COLLAPSE = (
+    "Write one alignment per unique read sequence (pair for dual-guide) with the read count in tag YC, "
+    "input is only read once"
+)
+
+HELP_SINGLE_PASS = (
+    "Read the input once, mapping sequences as first seen and writing alignments in input order (ignores --max-memory)"
+)
+
+HELP_CACHE_READS = (
+    "Keep read names, sequences and qualities in the workspace while parsing, alignments are written from this "
+    "rather than decoding the input again (not with --single-pass)"
+)
+
+HELP_OUTPUT_FORMAT = (
+    "Alignment file format, unsorted is an uncompressed BAM in bucket order (no index) for piping to other tools"
+)
+
+HELP_COMPRESSION = "Compression level of the alignment file (htslib default when not set)"
+
+HELP_CRAM_PROFILE = "CRAM codec profile, --compression overrides the level of the profile"
+
+HELP_BUCKET_COMPRESSION = "Compression level of the intermediate alignment files in the workspace, 0 is uncompressed"
+
+HELP_WRITE_THREADS = "Threads used to encode the alignment file (0 uses --cpus, max 4)"
+
+HELP_UNMAPPED = (
+    "Unmapped reads are kept in the alignment file, dropped, or written to a separate unsorted *.unmapped.bam"
+)
 
 HELP_EPILOG = """
 Additional option info:
@@ -219,6 +269,148 @@ def common_params(f):
     return wrapper
 
 
+optgroup_perf = OptionGroup("\nPerformance options", help="Options trading memory, disk and CPU use")
+
+
+def perf_params(f):
+    @optgroup_perf.option(
+        "--pack-seqs",
+        required=False,
+        default=False,
+        type=bool,
+        help=HELP_PACK_SEQS,
+        show_default=True,
+        is_flag=True,
+    )
+    @optgroup_perf.option(
+        "--max-memory",
+        required=False,
+        default=None,
+        type=click.IntRange(min=1),
+        help=HELP_MAX_MEMORY,
+    )
+    @optgroup_perf.option(
+        "--mismatch-index",
+        required=False,
+        default=False,
+        type=bool,
+        help=HELP_MISMATCH_INDEX,
+        show_default=True,
+        is_flag=True,
+    )
+    @optgroup_perf.option(
+        "--strict-headers",
+        required=False,
+        default=False,
+        type=bool,
+        help=HELP_STRICT_HEADERS,
+        show_default=True,
+        is_flag=True,
+    )
+    @optgroup_perf.option(
+        "--collapse-alignments",
+        required=False,
+        default=False,
+        type=bool,
+        help=HELP_COLLAPSE,
+        show_default=True,
+        is_flag=True,
+    )
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def read_pass_params(f):
+    @optgroup_perf.option(
+        "--single-pass",
+        required=False,
+        default=False,
+        type=bool,
+        help=HELP_SINGLE_PASS,
+        show_default=True,
+        is_flag=True,
+    )
+    @optgroup_perf.option(
+        "--cache-reads",
+        required=False,
+        default=False,
+        type=bool,
+        help=HELP_CACHE_READS,
+        show_default=True,
+        is_flag=True,
+    )
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if kwargs["single_pass"] and kwargs["cache_reads"]:
+            # single pass never reads the input again so has nothing to cache for
+            raise click.UsageError("--cache-reads can not be used with --single-pass")
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+optgroup_hts = OptionGroup(
+    "\nAlignment output options", help="Options for the format and encoding of the alignment file"
+)
+
+
+def hts_params(f):
+    @optgroup_hts.option(
+        "--output-format",
+        required=False,
+        default="cram",
+        show_default=True,
+        type=click.Choice(("cram", "bam", "unsorted"), case_sensitive=False),
+        help=HELP_OUTPUT_FORMAT,
+    )
+    @optgroup_hts.option(
+        "--compression",
+        required=False,
+        default=None,
+        type=click.IntRange(min=0, max=9),
+        help=HELP_COMPRESSION,
+    )
+    @optgroup_hts.option(
+        "--cram-profile",
+        required=False,
+        default=None,
+        type=click.Choice(("fast", "normal", "small", "archive"), case_sensitive=False),
+        help=HELP_CRAM_PROFILE,
+    )
+    @optgroup_hts.option(
+        "--bucket-compression",
+        required=False,
+        default=1,
+        show_default=True,
+        type=click.IntRange(min=0, max=9),
+        help=HELP_BUCKET_COMPRESSION,
+    )
+    @optgroup_hts.option(
+        "--write-threads",
+        required=False,
+        default=0,
+        show_default=True,
+        type=click.IntRange(min=0),
+        help=HELP_WRITE_THREADS,
+    )
+    @optgroup_hts.option(
+        "--unmapped",
+        required=False,
+        default="keep",
+        show_default=True,
+        type=click.Choice(("keep", "drop", "separate"), case_sensitive=False),
+        help=HELP_UNMAPPED,
+    )
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
 optgroup_debug = OptionGroup("\nDebug options", help="Options specific to troubleshooting, testing and debugging")
 
 
@@ -258,6 +450,9 @@ def cli():  # pragma: no cover
     show_default=True,
     is_flag=True,
 )
+@perf_params
+@read_pass_params
+@hts_params
 @debug_params
 def single_guide(*args, **kwargs):
     """
@@ -278,6 +473,19 @@ def single_guide(*args, **kwargs):
     show_default=True,
     help=HELP_TRIMSEQ,
 )
+@click.option(
+    "-n",
+    "--no-alignment",
+    required=False,
+    default=False,
+    type=bool,
+    help=HELP_DG_NO_ALIGNMENT,
+    show_default=True,
+    is_flag=True,
+)
+@click.option("--queries-r2", required=False, default=None, type=_file_exists(), help=HELP_QUERIES_R2)
+@perf_params
+@hts_params
 @debug_params
 def dual_guide(*args, **kwargs):
     """
@@ -289,6 +497,9 @@ def dual_guide(*args, **kwargs):
 @cli.command(epilog=HELP_EPILOG)
 @common_params
 @sge_extra
+@perf_params
+@read_pass_params
+@hts_params
 @debug_params
 def long_read(*args, **kwargs):
     """
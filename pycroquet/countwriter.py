@@ -39,6 +39,7 @@ from pycroquet.classes import Guide
 from pycroquet.classes import Library
 from pycroquet.classes import Stats
 from pycroquet.constants import COLS_REQ
+from pycroquet.readparser import sorted_counts
 
 
 def _fmt_counts(guide: Guide, inc_unique: bool = True, reverse_sgrna_seqs: bool = False) -> str:
@@ -129,5 +130,5 @@ def query_counts(
         print("##Command: " + stats.command, file=cout)
         print("##Version: " + stats.version, file=cout)
         print("#QUERY\tCOUNT", file=cout)
-        for k in sorted(query_dict.keys()):
-            print(f"{k}\t{query_dict[k]}", file=cout)
+        for (seq, count) in sorted_counts(query_dict):
+            print(f"{seq}\t{count}", file=cout)
@@ -32,9 +32,12 @@ import json
 import logging
 import os
 import shutil
+from functools import partial
+from itertools import islice
 from time import time
 from typing import Dict
 from typing import Final
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -44,27 +47,40 @@ from pygas.alignercpu import AlignerCpu
 from pygas.classes import AlignmentBatch
 from pygas.classes import Backtrack
 
-import pycroquet.tools as ctools
 from pycroquet import cli
 from pycroquet import libparser
 from pycroquet import readparser
 from pycroquet.classes import Classification
 from pycroquet.classes import Guide
+from pycroquet.classes import HtsOptions
 from pycroquet.classes import Library
+from pycroquet.classes import Seqread
 from pycroquet.classes import Stats
 from pycroquet.constants import COLS_REQ
+from pycroquet.constants import EXT_TO_HTS
 from pycroquet.countwriter import _fmt_counts
 from pycroquet.countwriter import _header
-from pycroquet.htscomm import hts_sort_n_index
+from pycroquet.htscomm import buckets_to_cram
+from pycroquet.htscomm import BucketWriter
 from pycroquet.main import map_reads
-from pycroquet.main import sg_select_alignment
+from pycroquet.main import mapping_pool
+from pycroquet.main import select_alignments
+from pycroquet.readwriter import collapsed_seqread
+from pycroquet.readwriter import COUNT_TAG
 from pycroquet.readwriter import guide_header
 from pycroquet.readwriter import read_iter
+from pycroquet.readwriter import sharded_writes
 from pycroquet.readwriter import to_alignment
 from pycroquet.readwriter import to_mapped_reads
+from pycroquet.seqpack import key_function
+from pycroquet.seqpack import unpack
 
 CLASSIFICATION: Final = Classification()
 
+SHARD_PAIRS = 25000
+# read stats updated by _pair_alignments(), summed over shards
+SHARD_STATS = ("mapped_to_guide_reads", "multimap_reads", "unmapped_reads")
+
 READCLASS_HEADER = [
     "## hit_l and hit_r: Y/N/M",
     "## Where:",
@@ -81,32 +97,20 @@ def best_unique_l_mm_r(
     """
     find the pairing that is most likely to be the real item
     """
-    guides_f_r = {}
+    best = None
     bt_l = bt_set_l[0]
-    guide_idxs_l = set(library.target_to_guides[bt_l.sm.target])
-    good_idx = None
+    if bt_l.sm.reversed is not False:
+        return None
+    t_id_l = library.target_ids[bt_l.sm.target]
     for bt_r in bt_set_r:
-        guide_idxs_r = set(library.target_to_guides[bt_r.sm.target])
-        guide_intersect = guide_idxs_l.intersection(guide_idxs_r)
-        for gidx in guide_intersect:
-            guide = library.guides[gidx]
-            if (
-                guide.sgrna_seqs[0] == bt_l.sm.target
-                and guide.sgrna_seqs[1] == bt_r.sm.target
-                and bt_l.sm.reversed is False
-                and bt_r.sm.reversed is True
-            ):
-                guides_f_r[gidx] = (gidx, bt_l, bt_r)
-                good_idx = gidx
-    if guides_f_r:
-        hits = []
-        if len(guides_f_r) > 1:
-            # logging.error("Multiple guides appear to equally match query pair, guides are:")
-            for gidx in guides_f_r:
-                hits.append(guides_f_r[gidx])
-        else:
-            hits.append(guides_f_r[good_idx])
-        return [guides_f_r[good_idx]]
+        if bt_r.sm.reversed is not True:
+            continue
+        # guides with bt_l then bt_r as the sgrna pair
+        guide_idx = library.guide_by_target_ids(t_id_l, library.target_ids[bt_r.sm.target])
+        if guide_idx:
+            best = (guide_idx[-1], bt_l, bt_r)
+    if best:
+        return [best]
     return None
 
 
@@ -116,32 +120,20 @@ def best_mm_l_unique_r(
     """
     find the pairing that is most likely to be the real item
     """
-    guides_f_r = {}
+    best = None
     bt_r = bt_set_r[0]
-    guide_idxs_r = set(library.target_to_guides[bt_r.sm.target])
-    good_idx = None
+    if bt_r.sm.reversed is not True:
+        return None
+    t_id_r = library.target_ids[bt_r.sm.target]
     for bt_l in bt_set_l:
-        guide_idxs_l = set(library.target_to_guides[bt_l.sm.target])
-        guide_intersect = guide_idxs_r.intersection(guide_idxs_l)
-        for gidx in guide_intersect:
-            guide = library.guides[gidx]
-            if (
-                guide.sgrna_seqs[0] == bt_l.sm.target
-                and guide.sgrna_seqs[1] == bt_r.sm.target
-                and bt_l.sm.reversed is False
-                and bt_r.sm.reversed is True
-            ):
-                guides_f_r[gidx] = (gidx, bt_l, bt_r)
-                good_idx = gidx
-    if guides_f_r:
-        hits = []
-        if len(guides_f_r) > 1:
-            # logging.error("Multiple guides appear to equally match query pair, guides are:")
-            for gidx in guides_f_r:
-                hits.append(guides_f_r[gidx])
-        else:
-            hits.append(guides_f_r[good_idx])
-        return [guides_f_r[good_idx]]
+        if bt_l.sm.reversed is not False:
+            continue
+        # guides with bt_l then bt_r as the sgrna pair
+        guide_idx = library.guide_by_target_ids(library.target_ids[bt_l.sm.target], t_id_r)
+        if guide_idx:
+            best = (guide_idx[-1], bt_l, bt_r)
+    if best:
+        return [best]
     return None
 
 
@@ -152,26 +144,26 @@ def best_multimatch_set(library: Library, bt_set_l: List[Backtrack], bt_set_r: L
     guides = {}  # to hold matches
     last_key = None  # makes getting the single entry far lower impact
     for bt_l in bt_set_l:
-        guide_idxs_l = set(library.target_to_guides[bt_l.sm.target])
+        if bt_l.sm.reversed is not False:
+            continue
+        guide_idxs_l = library.target_guides(bt_l.sm.target)
         for bt_r in bt_set_r:
-            guide_idxs_r = set(library.target_to_guides[bt_r.sm.target])
-            guide_intersect = guide_idxs_l.intersection(guide_idxs_r)
+            if bt_r.sm.reversed is not True:
+                continue
+            guide_intersect = guide_idxs_l & library.target_guides(bt_r.sm.target)
             if len(guide_intersect) == 1:
-                gidx = guide_intersect.pop()
-                if bt_l.sm.reversed is False and bt_r.sm.reversed is True:
-                    guides[gidx] = (gidx, bt_l, bt_r)
-                    last_key = gidx
-                    # on multi we don't try to deal with everything
+                (gidx,) = guide_intersect
+                guides[gidx] = (gidx, bt_l, bt_r)
+                last_key = gidx
+                # on multi we don't try to deal with everything
     if len(guides) == 1:
         return guides[last_key]
     return None
 
 
 def intersect_guide_targets(library, tseq_l, tseq_r):
-    guide_idxs_l = set(library.target_to_guides[tseq_l])
-    guide_idxs_r = set(library.target_to_guides[tseq_r])
     # gives the common guides
-    return guide_idxs_l.intersection(guide_idxs_r)
+    return library.target_guides(tseq_l) & library.target_guides(tseq_r)
 
 
 def classify_read_pair(
@@ -192,14 +184,15 @@ def classify_read_pair(
     (mtype_r, mdata_r) = map_r
     if mtype_l == "unique" and mtype_l == mtype_r:
         (bt_l, bt_r) = (mdata_l[0], mdata_r[0])
-        gidx = library.guide_by_sgrna_set(bt_l.sm.target, bt_r.sm.target)
+        (t_id_l, t_id_r) = (library.target_ids[bt_l.sm.target], library.target_ids[bt_r.sm.target])
+        gidx = library.guide_by_target_ids(t_id_l, t_id_r)
         if gidx is not None:
             if bt_l.sm.reversed is False and bt_r.sm.reversed is True:
                 return (CLASSIFICATION.match, gidx, bt_l, bt_r, mtype_l, mtype_r)
             # other orientations will be an abberant match as we are in unique/unique
             return (CLASSIFICATION.aberrant_match, None, bt_l, bt_r, mtype_l, mtype_r)
         # what about r1/r2 order swap
-        gidx = library.guide_by_sgrna_set(bt_r.sm.target, bt_l.sm.target)
+        gidx = library.guide_by_target_ids(t_id_r, t_id_l)
         if gidx is not None:
             return (CLASSIFICATION.aberrant_match, None, bt_l, bt_r, mtype_l, mtype_r)
         # which leaves swap (as both are unique but to different guide sets)
@@ -211,14 +204,15 @@ def classify_read_pair(
         if best_pair:
             # this will impact how we write out alignments
             (gidx, bt_l, bt_r) = best_pair
-            gidx = library.guide_by_sgrna_set(bt_l.sm.target, bt_r.sm.target)
+            (t_id_l, t_id_r) = (library.target_ids[bt_l.sm.target], library.target_ids[bt_r.sm.target])
+            gidx = library.guide_by_target_ids(t_id_l, t_id_r)
             if gidx is not None:
                 if bt_l.sm.reversed is False and bt_r.sm.reversed is True:
                     return (CLASSIFICATION.match, gidx, bt_l, bt_r, mtype_l, mtype_r)
                 # other orientations will be an abberant match as we are in unique/unique
                 return (CLASSIFICATION.aberrant_match, None, bt_l, bt_r, mtype_l, mtype_r)
             # what about r1/r2 order swap
-            gidx = library.guide_by_sgrna_set(bt_r.sm.target, bt_l.sm.target)
+            gidx = library.guide_by_target_ids(t_id_r, t_id_l)
             if gidx is not None:
                 return (CLASSIFICATION.aberrant_match, None, bt_l, bt_r, mtype_l, mtype_r)
         # which leaves ambiguous (as both map to "things")
@@ -237,11 +231,12 @@ def classify_read_pair(
             (gidx, bt_l, bt_r) = best_pairs[0]
             if len(best_pairs) > 1:
                 return (CLASSIFICATION.f_multi_3p, None, bt_l, None, mtype_l, "multimap")
-            gidx = library.guide_by_sgrna_set(bt_l.sm.target, bt_r.sm.target)
+            (t_id_l, t_id_r) = (library.target_ids[bt_l.sm.target], library.target_ids[bt_r.sm.target])
+            gidx = library.guide_by_target_ids(t_id_l, t_id_r)
             if gidx:
                 return (CLASSIFICATION.match, gidx, bt_l, bt_r, mtype_l, mtype_r)
             # what about r1/r2 order swap
-            gidx = library.guide_by_sgrna_set(bt_r.sm.target, bt_l.sm.target)
+            gidx = library.guide_by_target_ids(t_id_r, t_id_l)
             if gidx:
                 return (CLASSIFICATION.aberrant_match, gidx, bt_l, bt_r, mtype_l, mtype_r)
         if bt_l.sm.reversed:
@@ -261,11 +256,12 @@ def classify_read_pair(
             (gidx, bt_l, bt_r) = best_pairs[0]
             if len(best_pairs) > 1:
                 return (CLASSIFICATION.f_multi_5p, None, None, bt_r, "multimap", mtype_r)
-            gidx = library.guide_by_sgrna_set(bt_l.sm.target, bt_r.sm.target)
+            (t_id_l, t_id_r) = (library.target_ids[bt_l.sm.target], library.target_ids[bt_r.sm.target])
+            gidx = library.guide_by_target_ids(t_id_l, t_id_r)
             if gidx:
                 return (CLASSIFICATION.match, gidx, bt_l, bt_r, mtype_l, mtype_r)
             # what about r1/r2 order swap
-            gidx = library.guide_by_sgrna_set(bt_r.sm.target, bt_l.sm.target)
+            gidx = library.guide_by_target_ids(t_id_r, t_id_l)
             if gidx:
                 return (CLASSIFICATION.aberrant_match, gidx, bt_l, bt_r, mtype_l, mtype_r)
         if bt_r.sm.reversed:
@@ -293,6 +289,179 @@ def _init_class_counts():
     return counts
 
 
+def _classify_pair(read_l, read_r, aligned_results, to_key, library: Library, class_cache):
+    """
+    Returns (pair_lookup, class_type, guide_idx, hits_l, hits_r, orig_l, orig_r), cached by pair_lookup
+    """
+    if library.header.reverse_read_order:
+        pair_lookup = f"{read_r}|{read_l}"
+    else:
+        pair_lookup = f"{read_l}|{read_r}"
+
+    if pair_lookup in class_cache:
+        return (pair_lookup, *class_cache[pair_lookup])
+
+    (map_l, map_r) = (aligned_results[to_key(read_l)], aligned_results[to_key(read_r)])
+    # try to order from most likely to least
+    (
+        class_type,
+        guide_idx,
+        bt_l,
+        bt_r,
+        orig_l,
+        orig_r,
+    ) = classify_read_pair(map_l, map_r, library)
+
+    hits_l = order_hits(map_l[1], bt_l)
+    hits_r = order_hits(map_r[1], bt_r)
+
+    class_cache[pair_lookup] = (
+        class_type,
+        guide_idx,
+        hits_l,
+        hits_r,
+        orig_l,
+        orig_r,
+    )
+    return (pair_lookup, *class_cache[pair_lookup])
+
+
+def _tally_pair(classified, library: Library, counts, pair_type_info, count=1):
+    """
+    Add count read pairs of a classified pair to the guide, classification and pair type counts, only the leading
+    (pair_lookup, class_type, guide_idx) of classified are used.
+    """
+    (pair_lookup, class_type, guide_idx) = classified[0:3]
+    if guide_idx is not None:
+        for gidx in guide_idx:
+            library.guides[gidx].count += count
+
+    if class_type == CLASSIFICATION.match:
+        counts[class_type] += len(guide_idx) * count
+    else:
+        counts[class_type] += count
+
+    if pair_lookup not in pair_type_info:
+        pair_type_info[pair_lookup] = classify_readpair(class_type)
+    pair_type_info[pair_lookup]["count"] += count
+
+
+def _tally_read(stats: Stats, hits, multi, unmapped_multi, count):
+    if hits:
+        if multi:
+            stats.multimap_reads += count
+        stats.mapped_to_guide_reads += count
+    elif unmapped_multi:
+        stats.multimap_reads += count
+    else:
+        stats.unmapped_reads += count
+
+
+def _pair_alignments(
+    seqread_l: Seqread, seqread_r: Seqread, classified, ref_ids, library: Library, stats: Stats, templates, count=1
+) -> List[pysam.AlignedSegment]:
+    """
+    Alignment records of a classified pair, left then right.  Updates the read stats for count read pairs.
+    """
+    (_, class_type, guide_idx, hits_l, hits_r, orig_l, orig_r) = classified
+    alignments = []
+    for (seqread, hits, orig, multi_class) in (
+        (seqread_l, hits_l, orig_l, CLASSIFICATION.r_multi_5p),
+        (seqread_r, hits_r, orig_r, CLASSIFICATION.r_multi_3p),
+    ):
+        multi = False
+        if hits:
+            (a_lst, multi) = to_mapped_reads(
+                seqread, ref_ids, library, hits, guide_idx=guide_idx, dual=True, templates=templates
+            )
+            alignments.extend(a_lst)
+        else:
+            alignments.append(to_alignment(seqread, False, [], unmapped=True))
+        _tally_read(stats, hits, multi, class_type == multi_class or orig == "multimap", count)
+    return alignments
+
+
+def _tally_pair_reads(classified, library: Library, stats: Stats, count=1):
+    """
+    The read stats of _pair_alignments() without building the records, a read is multimapped when its hits cover
+    more than one sgRNA id (see readwriter._mapped_template()).
+    """
+    (_, class_type, _, hits_l, hits_r, orig_l, orig_r) = classified
+    for (hits, orig, multi_class) in (
+        (hits_l, orig_l, CLASSIFICATION.r_multi_5p),
+        (hits_r, orig_r, CLASSIFICATION.r_multi_3p),
+    ):
+        multi = len({sgrna_id for hit in hits for sgrna_id in library.sgrna_ids_by_seq(hit.sm.target)}) > 1
+        _tally_read(stats, hits, multi, class_type == multi_class or orig == "multimap", count)
+
+
+def _read_pairs(seqreads: Iterator[Seqread]) -> Iterator[Tuple[Seqread, Seqread]]:
+    for seqread_l in seqreads:
+        seqread_r = next(seqreads, None)
+        if seqread_r is None:
+            raise ValueError("Collated BAM exhausted between records")
+        if seqread_l.qname != seqread_r.qname:
+            raise ValueError(f"Paired reads require collation, mates of {seqread_l.qname} are not adjacent")
+        yield (seqread_l, seqread_r)
+
+
+def _pair_shard(af: BucketWriter, first_order: int, read_pairs: List[Tuple[Seqread, Seqread]], shard_args, caches):
+    """
+    Classifies a chunk of read pairs and writes the records, both reads of a pair share the input ordinal.  Returns
+    the pair tallies as {pair_lookup: (class_type, guide_idx, count)} and the Stats partial for the read stats, see
+    SHARD_STATS.
+    """
+    (aligned_results, to_key, library, ref_ids) = shard_args
+    # classification and template caches are per worker, kept between chunks
+    (class_cache, templates) = caches
+    tallies = {}
+    stats = Stats()
+    for (order, (seqread_l, seqread_r)) in enumerate(read_pairs, start=first_order):
+        classified = _classify_pair(
+            seqread_l.sequence, seqread_r.sequence, aligned_results, to_key, library, class_cache
+        )
+        (pair_lookup, class_type, guide_idx) = classified[0:3]
+        if pair_lookup in tallies:
+            tallies[pair_lookup][2] += 1
+        else:
+            tallies[pair_lookup] = [class_type, guide_idx, 1]
+        for a in _pair_alignments(seqread_l, seqread_r, classified, ref_ids, library, stats, templates):
+            af.write(a, order=order)
+    return (tallies, stats)
+
+
+def _reduce_pair_shard(shard_result, library: Library, stats: Stats, counts, pair_type_info):
+    (tallies, shard_stats) = shard_result
+    for (pair_lookup, (class_type, guide_idx, count)) in tallies.items():
+        _tally_pair((pair_lookup, class_type, guide_idx), library, counts, pair_type_info, count=count)
+    for field in SHARD_STATS:
+        setattr(stats, field, getattr(stats, field) + getattr(shard_stats, field))
+
+
+def _pairs_sharded(
+    bucket_dir, header, guide_fa, cpus, read_pairs, shard_args, library, stats, counts, pair_type_info, hts_opts=None
+) -> List[BucketWriter]:
+    """
+    Chunks of read pairs are classified and converted to alignments by worker processes, see
+    readwriter.sharded_writes().  Results are reduced in input order so counts, stats and output are identical to a
+    serial write.
+    """
+    chunks = iter(lambda: list(islice(read_pairs, SHARD_PAIRS)), [])
+    writers = sharded_writes(
+        os.path.join(bucket_dir, "pairs"),
+        header,
+        guide_fa,
+        cpus,
+        chunks,
+        _pair_shard,
+        (shard_args, ({}, {})),
+        partial(_reduce_pair_shard, library=library, stats=stats, counts=counts, pair_type_info=pair_type_info),
+        hts_opts=hts_opts,
+    )
+    logging.debug(f"Pair alignments written by {len(writers)} workers")
+    return writers
+
+
 def read_pairs_to_guides(
     workspace: str,
     aligned_results: Dict[str, Tuple[str, List[Backtrack]]],
@@ -305,110 +474,139 @@ def read_pairs_to_guides(
     stats: Stats,
     cpus=1,
     trim_len=0,
+    packed=False,
+    strict_headers=False,
+    hts_opts: HtsOptions = None,
+    mate_file=None,
 ):
+    """
+    Returns the classification counts, the bucket writers in input order (for buckets_to_cram()) and the pair type
+    info.  When cpus > 1 pairs are classified and written by worker processes, see _pairs_sharded().
+    """
     start = time()
-    class_cache = {}
+    to_key = key_function(packed)
     # initialise counts
     counts = _init_class_counts()
-    align_file = os.path.join(workspace, "tmp.bam")
+    bucket_dir = os.path.join(workspace, "align_buckets")
+    os.makedirs(bucket_dir, exist_ok=True)
 
     pair_type_info = {}
 
-    with pysam.AlignmentFile(align_file, "wb", header=header, reference_filename=guide_fa, threads=cpus) as af:
-        iter = read_iter(seq_file, default_rgid=default_rgid, cpus=cpus, trim_len=trim_len)
-        for seqread_l in iter:
-            seqread_r = next(iter, None)
-            if seqread_r is None:
-                raise ValueError("Collated BAM exhausted between records")
+    read_pairs = _read_pairs(
+        read_iter(
+            seq_file,
+            offset=stats.phred_offset,
+            default_rgid=default_rgid,
+            cpus=cpus,
+            trim_len=trim_len,
+            strict_headers=strict_headers,
+            paired=True,
+            mate_file=mate_file,
+        )
+    )
+    if cpus > 1:
+        shard_args = (aligned_results, to_key, library, ref_ids)
+        writers = _pairs_sharded(
+            bucket_dir,
+            header,
+            guide_fa,
+            cpus,
+            read_pairs,
+            shard_args,
+            library,
+            stats,
+            counts,
+            pair_type_info,
+            hts_opts=hts_opts,
+        )
+        logging.info(f"Alignment grouping took: {int(time() - start)}s")
+        return (counts, writers, pair_type_info)
 
-            (read_l, read_r) = (seqread_l.sequence, seqread_r.sequence)
+    class_cache = {}
+    templates = {}
+    with BucketWriter(os.path.join(bucket_dir, "pairs"), header, guide_fa, hts_opts=hts_opts) as af:
+        for (seqread_l, seqread_r) in read_pairs:
+            classified = _classify_pair(
+                seqread_l.sequence, seqread_r.sequence, aligned_results, to_key, library, class_cache
+            )
+            _tally_pair(classified, library, counts, pair_type_info)
+            for a in _pair_alignments(seqread_l, seqread_r, classified, ref_ids, library, stats, templates):
+                af.write(a)
+
+    logging.info(f"Alignment grouping took: {int(time() - start)}s")
+    return (counts, [af], pair_type_info)
 
-            if library.header.reverse_read_order:
-                pair_lookup = f"{read_r}|{read_l}"
-            else:
-                pair_lookup = f"{read_l}|{read_r}"
 
-            a_l, a_r = None, None
+def collapsed_pairs_to_guides(
+    workspace: str,
+    aligned_results: Dict[str, Tuple[str, List[Backtrack]]],
+    library: Library,
+    pairs: Dict[str, int],
+    guide_fa,
+    header,
+    ref_ids,
+    default_rgid,
+    stats: Stats,
+    packed=False,
+    hts_opts: HtsOptions = None,
+):
+    """
+    Alternative to read_pairs_to_guides() built from the unique pair counts of the first pass, the reads are not
+    parsed again.  Writes one alignment set per unique read pair with the number of pairs in COUNT_TAG.
+    """
+    start = time()
+    to_key = key_function(packed)
+    class_cache = {}
+    templates = {}
+    counts = _init_class_counts()
+    bucket_dir = os.path.join(workspace, "align_buckets")
+    os.makedirs(bucket_dir, exist_ok=True)
 
-            class_type, hits_l, hits_r, orig_l, orig_r = None, None, None, None, None
-            guide_idx = None
+    pair_type_info = {}
 
-            if pair_lookup in class_cache:
-                (class_type, guide_idx, hits_l, hits_r, orig_l, orig_r) = class_cache[pair_lookup]
-            else:
-                (map_l, map_r) = (aligned_results[read_l], aligned_results[read_r])
-                # try to order from most likely to least
-                (
-                    class_type,
-                    guide_idx,
-                    bt_l,
-                    bt_r,
-                    orig_l,
-                    orig_r,
-                ) = classify_read_pair(map_l, map_r, library)
-
-                hits_l = order_hits(map_l[1], bt_l)
-                hits_r = order_hits(map_r[1], bt_r)
-
-                class_cache[pair_lookup] = (
-                    class_type,
-                    guide_idx,
-                    hits_l,
-                    hits_r,
-                    orig_l,
-                    orig_r,
-                )
-
-            if guide_idx is not None:
-                for gidx in guide_idx:
-                    library.guides[gidx].count += 1
-
-            if hits_l:
-                (a_lst, multi) = to_mapped_reads(seqread_l, ref_ids, library, hits_l, guide_idx=guide_idx, dual=True)
-                for a in a_lst:
-                    af.write(a)
-                if multi:
-                    stats.multimap_reads += 1
-                stats.mapped_to_guide_reads += 1
-            else:
-                a = to_alignment(seqread_l, False, [], unmapped=True)
-                if class_type == CLASSIFICATION.r_multi_5p:
-                    stats.multimap_reads += 1
-                else:
-                    if orig_l == "multimap":
-                        stats.multimap_reads += 1
-                    else:
-                        stats.unmapped_reads += 1
-                af.write(a)
-            if hits_r:
-                (a_lst, multi) = to_mapped_reads(seqread_r, ref_ids, library, hits_r, guide_idx=guide_idx, dual=True)
-                for a in a_lst:
-                    af.write(a)
-                if multi:
-                    stats.multimap_reads += 1
-                stats.mapped_to_guide_reads += 1
-            else:
-                a = to_alignment(seqread_r, False, [], unmapped=True)
+    with BucketWriter(os.path.join(bucket_dir, "collapsed"), header, guide_fa, hts_opts=hts_opts) as af:
+        for pair_seq in sorted(pairs.keys()):
+            count = pairs[pair_seq]
+            (read_l, read_r) = pair_seq.split("|")
+            classified = _classify_pair(read_l, read_r, aligned_results, to_key, library, class_cache)
+            _tally_pair(classified, library, counts, pair_type_info, count=count)
+            seqread_l = collapsed_seqread(pair_seq, read_l, default_rgid, member=1)
+            seqread_r = collapsed_seqread(pair_seq, read_r, default_rgid, member=2)
+            for a in _pair_alignments(
+                seqread_l, seqread_r, classified, ref_ids, library, stats, templates, count=count
+            ):
+                a.set_tag(COUNT_TAG, count)
                 af.write(a)
-                if class_type == CLASSIFICATION.r_multi_3p:
-                    stats.multimap_reads += 1
-                else:
-                    if orig_r == "multimap":
-                        stats.multimap_reads += 1
-                    else:
-                        stats.unmapped_reads += 1
-
-            if class_type == CLASSIFICATION.match:
-                counts[class_type] += len(guide_idx)
-            else:
-                counts[class_type] += 1
 
-            if pair_lookup not in pair_type_info:
-                pair_type_info[pair_lookup] = classify_readpair(class_type)
-            pair_type_info[pair_lookup]["count"] += 1
+    logging.info(f"Collapsed pair grouping took: {int(time() - start)}s")
+    return (counts, [af], pair_type_info)
 
-    logging.info(f"Alignment grouping took: {int(time() - start)}s")
-    return (counts, align_file, pair_type_info)
+
+def count_pairs_to_guides(
+    aligned_results: Dict[str, Tuple[str, List[Backtrack]]],
+    library: Library,
+    pairs: Dict[str, int],
+    stats: Stats,
+    packed=False,
+):
+    """
+    Count only alternative to read_pairs_to_guides(), each unique read pair of the first pass is classified once and
+    tallied by its count.  No alignments are generated and the reads are not parsed again.
+    """
+    start = time()
+    to_key = key_function(packed)
+    class_cache = {}
+    counts = _init_class_counts()
+    pair_type_info = {}
+    for pair_seq in sorted(pairs.keys()):
+        count = pairs[pair_seq]
+        (read_l, read_r) = pair_seq.split("|")
+        classified = _classify_pair(read_l, read_r, aligned_results, to_key, library, class_cache)
+        _tally_pair(classified, library, counts, pair_type_info, count=count)
+        _tally_pair_reads(classified, library, stats, count=count)
+
+    logging.info(f"Pair counting took: {int(time() - start)}s")
+    return (counts, pair_type_info)
 
 
 def classify_readpair(class_type: Classification) -> Dict[str, str]:
@@ -449,34 +647,20 @@ def classify_readpair(class_type: Classification) -> Dict[str, str]:
     return classify
 
 
-def pickles_to_mapset(pickles: List[str], reads: Dict[str, int], aligner: AlignerCpu):
+def batches_to_mapset(
+    batches: Iterator[AlignmentBatch], reads: Dict[str, int], aligner: AlignerCpu, packed: bool = False
+):
+    to_key = key_function(packed)
     (aligned_results, multi_map, unique_map, unmap) = ({}, 0, 0, 0)
-    for p in pickles:
-        logging.info(f"Collating data from {p}")
-        batches = ctools.unpickle(p)
-        ab: AlignmentBatch
-        for ab in batches:
-            # unmapped is a simple list
-            for s in ab.unmapped:
-                aligned_results[s] = ("unmapped", None)
-                unmap += reads[s]
-            for hits in ab.mapped:
-                # function will need to be split out to work via:
-                #  library.header.is_single
-                best_bt = sg_select_alignment(hits, aligner.rules)
-                # for ease of access, common to all hits
-                original_seq = hits[0].sm.original_seq
-                if len(best_bt) == 0:
-                    aligned_results[original_seq] = ("unmapped", None)
-                    unmap += reads[original_seq]
-                    continue
-                elif len(best_bt) > 1:
-                    aligned_results[original_seq] = ("multimap", best_bt)
-                    multi_map += reads[original_seq]
-                    continue
-                # don't need to check for existence on this one
-                aligned_results[original_seq] = ("unique", best_bt)
-                unique_map += reads[original_seq]
+    for (original_seq, hit_type, best_bt) in select_alignments(batches, aligner.rules):
+        key = to_key(original_seq)
+        aligned_results[key] = (hit_type, best_bt)
+        if hit_type == "unmapped":
+            unmap += reads[key]
+        elif hit_type == "multimap":
+            multi_map += reads[key]
+        else:
+            unique_map += reads[key]
     return (aligned_results, multi_map, unique_map, unmap)
 
 
@@ -514,20 +698,37 @@ def run(
     trimseq,
     chunks,
     loglevel,
+    pack_seqs=False,
+    max_memory=None,
+    strict_headers=False,
+    collapse_alignments=False,
+    output_format="cram",
+    compression=None,
+    cram_profile=None,
+    bucket_compression=1,
+    write_threads=0,
+    unmapped="keep",
+    no_alignment=False,
+    queries_r2=None,
+    mismatch_index=False,
 ):
     (usable_cpu, work_tmp, workspace, boundary_mode) = cli.common_setup(
         loglevel, cpus, workspace, output, boundary_mode
     )
+    hts_opts = HtsOptions(output_format, compression, cram_profile, bucket_compression, write_threads, unmapped)
     library = libparser.load(guidelib)
     mark_uniq_guides(library)
     # returning a list of all guides in a single list
     # this allows us to map reads to both orientations at the same time (set reverse_comp)
 
+    if queries_r2 and os.path.splitext(queries)[1] in EXT_TO_HTS:
+        raise ValueError("--queries-r2 is only valid with fastq input")
+
     ###
-    # input data has to be samtools-collated if hts
-    seq_file = readparser.collate(queries, workspace, usable_cpu)
+    # hts input has to be grouped by name (samtools collate when not already), fastq is interleaved or read 1/read 2
+    seq_file = readparser.collate(queries, workspace, usable_cpu, reference=reference)
     # read loading needs to return both the unique list of read sequences, and the unique pairs (r1|r2)
-    (unique, stats, reads, _) = readparser.parse_reads(
+    (unique, stats, reads, pairs) = readparser.parse_reads(
         seq_file,
         sample=sample,
         cpus=usable_cpu,
@@ -535,6 +736,11 @@ def run(
         exclude_qcfail=excludeqcf,
         paired=True,
         trim_len=trimseq,
+        packed=pack_seqs,
+        workspace=workspace,
+        max_memory=max_memory,
+        strict_headers=strict_headers,
+        mate_file=queries_r2,
     )
 
     # map the uniq list or individual reads and then use the r1|r2 info to bring the events back together
@@ -545,28 +751,68 @@ def run(
         rev_comp=True,  # as some reads can be reversed in DG
         match_type=boundary_mode,
     )
-    pickles = map_reads(aligner, unique, chunks, cpus, workspace, list(reads.keys()))
     """
     Need to convert alignment batches into a dict by sequence, containing the possible mappings
     """
-    (aligned_results, multi_map, unique_map, unmap) = pickles_to_mapset(pickles, reads, aligner)
+    (aligned_results, multi_map, unique_map, unmap) = ({}, 0, 0, 0)
+    # a single partition unless the unique reads were spilled to disk, all share one pool
+    # results of every partition are kept as a pair needs those of both mates, even with no_alignment
+    with mapping_pool(aligner, cpus) as pool:
+        for counts in readparser.partitions(reads):
+            batches = map_reads(
+                aligner,
+                len(counts),
+                chunks,
+                cpus,
+                [unpack(k) for k in counts],
+                mismatch_index=mismatch_index,
+                pool=pool,
+            )
+            (part_results, part_multi, part_unique, part_unmap) = batches_to_mapset(
+                batches, counts, aligner, packed=pack_seqs
+            )
+            aligned_results.update(part_results)
+            multi_map += part_multi
+            unique_map += part_unique
+            unmap += part_unmap
     logging.info(f"Unique: {unique_map}, Multimap: {multi_map}, Unmapped: {unmap}")
-    # * generate the fasta for the guides in workspace
-    (guide_fa, header, ref_ids, default_rgid) = guide_header(workspace, library, stats, seq_file)
-
-    (raw_counts, unsorted, pair_type_info) = read_pairs_to_guides(
-        workspace,
-        aligned_results,
-        library,
-        seq_file,
-        guide_fa,
-        header,
-        ref_ids,
-        default_rgid,
-        stats,
-        cpus=usable_cpu,
-        trim_len=trimseq,
-    )
+    if no_alignment:
+        (raw_counts, pair_type_info) = count_pairs_to_guides(aligned_results, library, pairs, stats, packed=pack_seqs)
+    else:
+        # * generate the fasta for the guides in workspace
+        (guide_fa, header, ref_ids, default_rgid) = guide_header(workspace, library, stats, seq_file)
+        if collapse_alignments:
+            (raw_counts, bucket_writers, pair_type_info) = collapsed_pairs_to_guides(
+                workspace,
+                aligned_results,
+                library,
+                pairs,
+                guide_fa,
+                header,
+                ref_ids,
+                default_rgid,
+                stats,
+                packed=pack_seqs,
+                hts_opts=hts_opts,
+            )
+        else:
+            (raw_counts, bucket_writers, pair_type_info) = read_pairs_to_guides(
+                workspace,
+                aligned_results,
+                library,
+                seq_file,
+                guide_fa,
+                header,
+                ref_ids,
+                default_rgid,
+                stats,
+                cpus=usable_cpu,
+                trim_len=trimseq,
+                packed=pack_seqs,
+                strict_headers=strict_headers,
+                hts_opts=hts_opts,
+                mate_file=queries_r2,
+            )
     count_output = f"{output}.counts.tsv.gz"
 
     # initialise
@@ -614,7 +860,8 @@ def run(
                 file=scot,
             )
 
-    hts_sort_n_index(unsorted, guide_fa, output, workspace, cpus=usable_cpu)
+    if not no_alignment:
+        buckets_to_cram(bucket_writers, header, guide_fa, output, cpus=usable_cpu, hts_opts=hts_opts)
 
     if not work_tmp:
         shutil.rmtree(workspace)
@@ -0,0 +1,227 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+"""
+Binary read handles for gzip compressed FastQ that move decompression off the parsing thread.
+
+Both classes only provide read() and close(), as used by readparser.fq_records().  Decompressed data is returned in
+file order, record boundaries are left to the consumer.
+"""
+import logging
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+from queue import Queue
+from threading import Event
+from threading import Thread
+from typing import Iterator
+from typing import List
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_HEADER_LEN = 12
+# compressed bytes handed to each inflate task, ~64 BGZF blocks
+TASK_SIZE = 64 * 65536
+GZIP_WBITS = 31
+READAHEAD_CHUNK = 4 * 1024 * 1024
+READAHEAD_DEPTH = 4
+
+
+def is_bgzf(seq_file) -> bool:
+    """
+    First block has the BGZF extra subfield ('BC', block size)
+    """
+    with open(seq_file, "rb") as fh:
+        header = fh.read(18)
+    return len(header) == 18 and header[0:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+def _bgzf_block_size(data, offset: int) -> int:
+    """
+    Total length of the BGZF block starting at offset, -1 when the header is not complete in data
+    """
+    if len(data) - offset < BGZF_HEADER_LEN:
+        return -1
+    if data[offset : offset + 4] != BGZF_MAGIC:
+        raise ValueError(f"Invalid BGZF block header at offset {offset} of buffer")
+    (xlen,) = struct.unpack_from("<H", data, offset + 10)
+    pos = offset + BGZF_HEADER_LEN
+    end = pos + xlen
+    if len(data) < end:
+        return -1
+    while pos < end:
+        (si1, si2, slen) = struct.unpack_from("<ccH", data, pos)
+        if si1 == b"B" and si2 == b"C":
+            return struct.unpack_from("<H", data, pos + 4)[0] + 1
+        pos += 4 + slen
+    raise ValueError(f"BGZF block size not found in header at offset {offset} of buffer")
+
+
+def _inflate(blocks: List[bytes]) -> bytes:
+    return b"".join([zlib.decompress(block, GZIP_WBITS) for block in blocks])
+
+
+class BgzfReader:
+    """
+    Inflates BGZF blocks in a thread pool (zlib releases the GIL), block boundaries are read from the headers so no
+    decompression is needed to split the work.
+    """
+
+    def __init__(self, seq_file: str, threads: int):
+        self._fh = open(seq_file, "rb")
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._depth = threads * 2
+        self._tasks = self._block_sets()
+        self._pending = deque()
+        self._buffer = b""
+        self._offset = 0
+        logging.debug(f"BGZF input, decompressing with {threads} threads")
+
+    def _block_sets(self) -> Iterator[List[bytes]]:
+        carry = b""
+        while True:
+            raw = self._fh.read(TASK_SIZE)
+            if not raw:
+                break
+            data = carry + raw
+            (offset, blocks) = (0, [])
+            while (size := _bgzf_block_size(data, offset)) != -1 and offset + size <= len(data):
+                blocks.append(data[offset : offset + size])
+                offset += size
+            carry = data[offset:]
+            if blocks:
+                yield blocks
+        if carry:
+            raise ValueError("BGZF input is truncated, final block is incomplete")
+
+    def _fill(self):
+        while len(self._pending) < self._depth:
+            blocks = next(self._tasks, None)
+            if blocks is None:
+                break
+            self._pending.append(self._pool.submit(_inflate, blocks))
+
+    def read(self, size=-1) -> bytes:
+        while self._offset == len(self._buffer):
+            self._fill()
+            if not self._pending:
+                return b""
+            self._buffer = self._pending.popleft().result()
+            self._offset = 0
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[self._offset : self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+        self._fh.close()
+
+
+class ReadaheadGzipReader:
+    """
+    For gzip that isn't BGZF the member boundaries can't be found without inflating, decompression is performed by a
+    single background thread so it overlaps parsing.
+    """
+
+    def __init__(self, seq_file: str):
+        self._queue = Queue(maxsize=READAHEAD_DEPTH)
+        self._stop = Event()
+        self._buffer = b""
+        self._offset = 0
+        self._eof = False
+        self._thread = Thread(target=self._produce, args=(seq_file,), daemon=True)
+        self._thread.start()
+        logging.debug("gzip input, decompressing in background thread")
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _produce(self, seq_file):
+        try:
+            with open(seq_file, "rb") as fh:
+                inflater = zlib.decompressobj(GZIP_WBITS)
+                in_member = False
+                while not self._stop.is_set():
+                    raw = fh.read(READAHEAD_CHUNK)
+                    if not raw:
+                        break
+                    while raw:
+                        if not in_member:
+                            # gzip allows zero padding between/after members
+                            raw = raw.lstrip(b"\x00")
+                            if not raw:
+                                break
+                            in_member = True
+                        chunk = inflater.decompress(raw)
+                        if chunk:
+                            self._put(chunk)
+                        raw = b""
+                        if inflater.eof:
+                            # next member
+                            raw = inflater.unused_data
+                            inflater = zlib.decompressobj(GZIP_WBITS)
+                            in_member = False
+                if in_member and not self._stop.is_set():
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def read(self, size=-1) -> bytes:
+        while self._offset == len(self._buffer):
+            if self._eof:
+                return b""
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return b""
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._buffer = item
+            self._offset = 0
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[self._offset : self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -30,12 +30,23 @@
 """
 For common hts file actions
 """
+import heapq
 import logging
 import os
-from tempfile import TemporaryDirectory
+from typing import Iterator
+from typing import List
 
 import pysam
 
+from pycroquet.classes import HtsOptions
+
+# bucket files per writer for the mapped records, references are split into contiguous ranges
+REF_BUCKETS = 256
+# records of a bucket sorted in memory, larger buckets are spilled as sorted runs and merged
+SORT_RECORDS = 500000
+# input ordinal of a record, set when writers receive reads out of order (see BucketWriter.write), removed on output
+ORDER_TAG = "YO"
+
 
 def hts_reader(seq_file, mode, cpus, reference=None) -> pysam.AlignmentFile:
     hts_cpus = cpus if cpus < 4 else 4
@@ -52,26 +63,250 @@ def hts_reader(seq_file, mode, cpus, reference=None) -> pysam.AlignmentFile:
     return sam
 
 
-def hts_sort_n_index(unsorted, guide_fa, output_stub, workspace, cpus=1):
-    sam_threads = 4
-    if cpus < sam_threads:
-        sam_threads = cpus
-    aligned_cram = f"{output_stub}.cram"
-    logging.info(f"Sorting alignments to: {aligned_cram}")
-    with TemporaryDirectory(prefix="sort_to_cram", dir=workspace) as td:
-        pysam.sort(
-            "--no-PG",
-            "-@",
-            str(sam_threads),
-            "--reference",
-            guide_fa,
-            "--output-fmt",
-            "CRAM,no_ref=1",
-            "-T",
-            os.path.join(td, "samsort"),
-            "-o",
-            aligned_cram,
-            unsorted,
-        )
-    logging.info(f"Generating alignment index: {aligned_cram}.crai")
-    pysam.index(aligned_cram)
+def hts_output(output_stub: str, hts_opts: HtsOptions) -> str:
+    return f"{output_stub}.{'cram' if hts_opts.output_format == 'cram' else 'bam'}"
+
+
+def _format_options(hts_opts: HtsOptions) -> List[bytes]:
+    options = []
+    if hts_opts.output_format == "cram":
+        options.append(b"no_ref=1")
+        if hts_opts.profile:
+            # before level, an explicit level is kept
+            options.append(hts_opts.profile.encode())
+    level = 0 if hts_opts.output_format == "unsorted" else hts_opts.level
+    if level is not None:
+        options.append(f"level={level}".encode())
+    return options
+
+
+def _unmapped_writer(output_stub: str, header: dict, hts_opts: HtsOptions, threads: int) -> pysam.AlignmentFile:
+    unmapped_bam = f"{output_stub}.unmapped.bam"
+    logging.info(f"Writing unmapped reads to: {unmapped_bam}")
+    unsorted_header = {**header, "HD": {**header["HD"], "SO": "unsorted"}}
+    level = 0 if hts_opts.output_format == "unsorted" else hts_opts.level
+    return pysam.AlignmentFile(
+        unmapped_bam,
+        "wb",
+        header=unsorted_header,
+        format_options=None if level is None else [f"level={level}".encode()],
+        threads=threads,
+    )
+
+
+def _input_order(a: pysam.AlignedSegment) -> int:
+    return a.get_tag(ORDER_TAG) if a.has_tag(ORDER_TAG) else 0
+
+
+def _coordinate_key(a: pysam.AlignedSegment):
+    return (a.reference_id, a.reference_start, a.is_reverse, _input_order(a))
+
+
+class BucketWriter:
+    """
+    Writes alignments to BAM files bucketed by ranges of reference id, unmapped records go to a final bucket.  Files
+    are only created when a record is written to the bucket, see buckets_to_cram().
+
+    Each bucket file header only holds the @SQ lines of its range (libraries can have 100k+ guides, and a writer has up
+    to REF_BUCKETS + 1 files open) and the records are rebased to it, see _output_record() for the restore.
+
+    hts_opts sets the compression of the bucket files, unmapped records are discarded on write when dropped.
+
+    A writer that receives reads out of input order (e.g. one per worker process) gives the input ordinal of each
+    read to write(), buckets_to_cram() then restores the input order of ties across all writers.
+    """
+
+    def __init__(
+        self, prefix: str, header: dict, guide_fa: str, buckets: int = REF_BUCKETS, hts_opts: HtsOptions = None
+    ):
+        n_refs = len(header["SQ"])
+        self.refs_per_bucket = max(1, -(-n_refs // buckets))
+        self.unmapped_idx = -(-n_refs // self.refs_per_bucket)
+        self.prefix = prefix
+        self.bucket_files = [f"{prefix}.{i:04d}.bam" for i in range(0, self.unmapped_idx + 1)]
+        self._header = header
+        self._guide_fa = guide_fa
+        # the files are deleted once read, compression is only worth the disk saved
+        self._format_options = None
+        self._drop_unmapped = False
+        if hts_opts is not None:
+            self._format_options = [f"level={hts_opts.bucket_level}".encode()]
+            self._drop_unmapped = hts_opts.unmapped == "drop"
+        self._hts = [None] * len(self.bucket_files)
+
+    def _open(self, idx: int) -> pysam.AlignmentFile:
+        start = idx * self.refs_per_bucket
+        header = dict(self._header)
+        header["SQ"] = [] if idx == self.unmapped_idx else self._header["SQ"][start : start + self.refs_per_bucket]
+        af = pysam.AlignmentFile(self.bucket_files[idx], "wb", header=header, format_options=self._format_options)
+        self._hts[idx] = af
+        return af
+
+    def write(self, a: pysam.AlignedSegment, order: int = None):
+        """
+        a.reference_id is modified, do not reuse the record after writing.  order is the input ordinal of the read,
+        see ORDER_TAG.
+        """
+        if order is not None:
+            a.set_tag(ORDER_TAG, order, value_type="I")
+        ref_id = a.reference_id
+        if ref_id < 0:
+            if self._drop_unmapped:
+                return
+            idx = self.unmapped_idx
+        else:
+            idx = ref_id // self.refs_per_bucket
+            a.reference_id = ref_id - idx * self.refs_per_bucket
+        af = self._hts[idx]
+        if af is None:
+            af = self._open(idx)
+        af.write(a)
+
+    def close(self):
+        for af in self._hts:
+            if af is not None:
+                af.close()
+        self._hts = [None] * len(self.bucket_files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _spill_run(run_file: str, header: pysam.AlignmentHeader, records: List[pysam.AlignedSegment], format_options):
+    records.sort(key=_coordinate_key)
+    with pysam.AlignmentFile(run_file, "wb", header=header, format_options=format_options) as af:
+        for a in records:
+            af.write(a)
+    return run_file
+
+
+def _sorted_bucket(writers: List[BucketWriter], idx: int, max_records: int) -> Iterator[pysam.AlignedSegment]:
+    """
+    Records of a mapped bucket from all writers sorted by _coordinate_key(), at most max_records are held in memory.
+    Larger buckets are spilled as sorted runs alongside the bucket files and merged, runs are merged in the order
+    they were written so ties keep their write order.
+
+    The records keep the reference ids of the bucket header, all writers share the same header for a bucket.
+    """
+    (records, runs) = ([], [])
+    run_stub = writers[0].bucket_files[idx]
+    for writer in writers:
+        bucket_file = writer.bucket_files[idx]
+        if not os.path.exists(bucket_file):
+            continue
+        with pysam.AlignmentFile(bucket_file, "rb", check_sq=False) as af:
+            for a in af:
+                records.append(a)
+                if len(records) >= max_records:
+                    run_file = f"{run_stub}.run{len(runs):04d}.bam"
+                    runs.append(_spill_run(run_file, af.header, records, writer._format_options))
+                    records = []
+        os.remove(bucket_file)
+    records.sort(key=_coordinate_key)
+    if not runs:
+        yield from records
+        return
+    logging.debug(f"Bucket {idx} merged from {len(runs)} sorted runs")
+    run_hts = [pysam.AlignmentFile(run_file, "rb", check_sq=False) for run_file in runs]
+    yield from heapq.merge(*run_hts, records, key=_coordinate_key)
+    for (af, run_file) in zip(run_hts, runs):
+        af.close()
+        os.remove(run_file)
+
+
+def _bucket_records(writers: List[BucketWriter], idx: int) -> Iterator[pysam.AlignedSegment]:
+    """
+    Records of a bucket from all writers in the order given, as written
+    """
+    for writer in writers:
+        bucket_file = writer.bucket_files[idx]
+        if not os.path.exists(bucket_file):
+            continue
+        with pysam.AlignmentFile(bucket_file, "rb", check_sq=False) as af:
+            yield from af
+        os.remove(bucket_file)
+
+
+def _ordered_records(writers: List[BucketWriter], idx: int) -> Iterator[pysam.AlignedSegment]:
+    """
+    Records of a bucket from all writers in input order, the records of each writer are in input order so are merged
+    by ORDER_TAG without sorting.  Records without the tag are merged as _bucket_records().
+    """
+    bucket_files = [writer.bucket_files[idx] for writer in writers if os.path.exists(writer.bucket_files[idx])]
+    bucket_hts = [pysam.AlignmentFile(bucket_file, "rb", check_sq=False) for bucket_file in bucket_files]
+    yield from heapq.merge(*bucket_hts, key=_input_order)
+    for (af, bucket_file) in zip(bucket_hts, bucket_files):
+        af.close()
+        os.remove(bucket_file)
+
+
+def _output_record(a: pysam.AlignedSegment, header: pysam.AlignmentHeader) -> pysam.AlignedSegment:
+    """
+    pysam validates reference_id against the header bound to a record (which can't be replaced) so the bucket id can
+    not be offset in place, the record is rebuilt against the output header.  The SAM text is formatted and parsed by
+    htslib, copying the fields and tags to a new record through the pysam setters is ~4x slower (tags are converted
+    via python objects).  Buckets holding every @SQ line would need no rebuild but each open bucket file then holds a
+    copy of the full header, see BucketWriter.
+    """
+    a.set_tag(ORDER_TAG, None)
+    return pysam.AlignedSegment.fromstring(a.to_string(), header)
+
+
+def buckets_to_cram(
+    writers: List[BucketWriter],
+    header: dict,
+    guide_fa,
+    output_stub,
+    cpus=1,
+    hts_opts: HtsOptions = None,
+    max_records: int = SORT_RECORDS,
+) -> str:
+    """
+    Replaces a full sort of the intermediate alignments.  Buckets are visited in reference order, for each the files
+    of all writers are read in the order given and the records sorted by (reference, start, strand), see
+    _sorted_bucket() for how memory is bounded by max_records.  The sort is stable so ties keep the order they were
+    written, as with samtools sort.  Unmapped records are appended in write order, or written to
+    output_stub.unmapped.bam when hts_opts.unmapped is "separate".  Ties and unmapped records are in input order when
+    the writers were given it, see BucketWriter.
+
+    The format, compression and threads of the final file are set by hts_opts (CRAM by default), the "unsorted"
+    format skips the sort and index.  Returns the path of the file written.
+    """
+    if hts_opts is None:
+        hts_opts = HtsOptions()
+    sam_threads = hts_opts.write_threads
+    if not sam_threads:
+        sam_threads = cpus if cpus < 4 else 4
+    do_sort = hts_opts.output_format != "unsorted"
+    aligned_hts = hts_output(output_stub, hts_opts)
+    # only HD changes, the SQ lines are shared
+    sorted_header = {**header, "HD": {**header["HD"], "SO": "coordinate" if do_sort else "unsorted"}}
+    logging.info(f"Writing {'sorted' if do_sort else 'unsorted'} alignments to: {aligned_hts}")
+    with pysam.AlignmentFile(
+        aligned_hts,
+        "wc" if hts_opts.output_format == "cram" else "wb",
+        header=sorted_header,
+        reference_filename=guide_fa,
+        format_options=_format_options(hts_opts),
+        threads=sam_threads,
+    ) as cram:
+        unmapped_out = cram
+        if hts_opts.unmapped == "separate":
+            unmapped_out = _unmapped_writer(output_stub, header, hts_opts, sam_threads)
+        unmapped_idx = writers[0].unmapped_idx
+        for idx in range(0, unmapped_idx):
+            records = _sorted_bucket(writers, idx, max_records) if do_sort else _bucket_records(writers, idx)
+            for a in records:
+                cram.write(_output_record(a, cram.header))
+        for a in _ordered_records(writers, unmapped_idx):
+            a.set_tag(ORDER_TAG, None)
+            unmapped_out.write(a)
+        if unmapped_out is not cram:
+            unmapped_out.close()
+    if do_sort:
+        logging.info(f"Generating alignment index for: {aligned_hts}")
+        pysam.index(aligned_hts)
+    return aligned_hts
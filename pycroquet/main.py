@@ -30,18 +30,26 @@
 import logging
 import multiprocessing as mp
 import random
-from functools import partial
+from contextlib import nullcontext
+from itertools import chain
+from queue import SimpleQueue
 from time import time
 from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import Tuple
 
 from pygas.alignercpu import AlignerCpu
 from pygas.classes import AlignmentBatch
 from pygas.classes import Backtrack
+from pygas.classes import ScoreMatrix
+from pygas.matrix import revcomp
 
 import pycroquet.tools as ctools
+from pycroquet import mismatch
 from pycroquet import readparser
+from pycroquet import seqpack
 from pycroquet.classes import Library
 from pycroquet.classes import Stats
 from pycroquet.countwriter import guide_counts_single
@@ -50,43 +58,137 @@ READ_CHUNK_INT = 20000
 READ_CHUNK_SGE_INT = 1000
 
 
-def map_thread(query_seqs: List[str], aligner: AlignerCpu) -> AlignmentBatch:
+# set once per worker process by _init_worker, avoids pickling the aligner with every chunk
+_WORKER_ALIGNER: AlignerCpu = None
+
+
+def _init_worker(aligner: AlignerCpu):
+    global _WORKER_ALIGNER
+    _WORKER_ALIGNER = aligner
+
+
+def map_thread(query_seqs: List[str], aligner: AlignerCpu = None) -> AlignmentBatch:
+    if aligner is None:
+        aligner = _WORKER_ALIGNER
     return aligner.align_queries(query_seqs, keep_matrix=False)
 
 
-def mapping_by_chunk(aligner: AlignerCpu, query_seqs, read_chunk, workspace, usable_cpu) -> List[str]:
+def _completed(result):
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def mapping_pool(aligner: AlignerCpu, usable_cpu: int):
+    """
+    Context for the pool used by mapping_by_chunk(), created once per run so every partition of the unique reads
+    shares the same workers.  Gives None when a single CPU is available.
+    """
+    if usable_cpu == 1:
+        return nullcontext()
+    if __name__ == "__main__" and mp.get_start_method(allow_none=True) is None:
+        mp.set_start_method("spawn")
+    # the aligner is handed to each worker once at start-up
+    return mp.Pool(processes=usable_cpu, initializer=_init_worker, initargs=(aligner,))
+
+
+def mapping_by_chunk(aligner: AlignerCpu, query_seqs, read_chunk, usable_cpu, pool=None) -> Iterator[AlignmentBatch]:
+    """
+    Yields each AlignmentBatch as soon as it is complete, in no particular order.
+
+    Chunks are mapped via pool (see mapping_pool()) when given, otherwise in this process.  The number of chunks
+    queued to the pool is bounded so only a few batches are ever held in memory.
+    """
     # randomizes read order to distribute harder tasks, result is still reproducible
     random.Random().shuffle(query_seqs)
     # library.targets  # the targets for pygas
     # query_seqs  # the queries for pygas
-    seq_sets = ctools.chunks(query_seqs, read_chunk * usable_cpu)
-    del query_seqs  # make sure that it is removed as it's been duplicated
+    total = len(query_seqs)
+    seq_sets = ctools.chunks(query_seqs, read_chunk)
 
-    # setup for multi-process
+    start = time()
+    processed = 0
+    if pool is None or total <= read_chunk:  # save overhead
+        for seq_set in seq_sets:
+            batch = map_thread(seq_set, aligner)
+            processed += batch.total_reads
+            yield batch
+    else:
+        done = SimpleQueue()
+        (in_flight, max_in_flight) = (0, usable_cpu * 2)
+        for seq_set in seq_sets:
+            pool.apply_async(map_thread, (seq_set,), callback=done.put, error_callback=done.put)
+            in_flight += 1
+            while in_flight >= max_in_flight:
+                batch = _completed(done.get())
+                in_flight -= 1
+                processed += batch.total_reads
+                yield batch
+        while in_flight:
+            batch = _completed(done.get())
+            in_flight -= 1
+            processed += batch.total_reads
+            yield batch
+    logging.info(f"{usable_cpu} CPUs processed {processed} of {total} reads in {int(time() - start)}s (wall)")
 
-    if __name__ == "__main__" and mp.get_start_method(allow_none=True) is None:
-        mp.set_start_method("spawn")
 
-    start = time()
-    was = start
-    pickled_files = []
-    for seq_set in seq_sets:
-        this_seq_set = list(ctools.chunks(seq_set, read_chunk))
-        results = None
-        if usable_cpu == 1 or len(this_seq_set) == 1:  # save overhead
-            results = [map_thread(this_seq_set[0], aligner)]
-        else:
-            with mp.Pool(processes=usable_cpu) as pool:
-                results = pool.map(partial(map_thread, aligner=aligner), this_seq_set)
-        now = time()
-        logging.info(f"{usable_cpu} CPUs processed {len(seq_set)} reads in {int(now - was)}s (wall)")
-        was = now
+def exact_fast_path(aligner: AlignerCpu, query_seqs: List[str]) -> Tuple[AlignmentBatch, List[str]]:
+    """
+    Resolves queries identical to a target (or the reverse complement when aligner.rev_comp) by hash lookup,
+    giving the same hits as the aligner would.
+
+    Only queries of the longest target length can be resolved, a shorter query may also be contained within a
+    longer target so is left for the aligner.
+
+    Returns:
+        AlignmentBatch of the resolved queries
+        list of queries still requiring alignment
+    """
+    targets_by_seq = {}
+    for t_idx, target in enumerate(aligner.targets):
+        targets_by_seq.setdefault(target, []).append(t_idx)
+    max_t_len = len(max(aligner.targets, key=len))
 
-        pickled_files.append(ctools.pickle_this(workspace, "pre_matrix_{:05d}".format(len(pickled_files) + 1), results))
-        del results
-        # logging.warning("exiting loop early for development purposes")
-        # break
-    return pickled_files
+    (mapped, unmapped, residue) = ([], [], [])
+    for query in query_seqs:
+        q_len = len(query)
+        if q_len < aligner.score_min:
+            # aligner rejects these before any matching
+            unmapped.append(query)
+            continue
+        if q_len != max_t_len:
+            residue.append(query)
+            continue
+        hits = []
+        for t_idx in targets_by_seq.get(query, []):
+            sm = ScoreMatrix(
+                query=query,
+                target=query,
+                target_id=t_idx,
+                score=q_len,
+                reversed=False,
+                original_seq=query,
+                exact=True,
+            )
+            hits.append(Backtrack(sm, aligner.match_type))
+        if aligner.rev_comp:
+            rev_query = revcomp(query)
+            for t_idx in targets_by_seq.get(rev_query, []):
+                sm = ScoreMatrix(
+                    query=rev_query,
+                    target=rev_query,
+                    target_id=t_idx,
+                    score=q_len,
+                    reversed=True,
+                    original_seq=query,
+                    exact=True,
+                )
+                hits.append(Backtrack(sm, aligner.match_type))
+        if hits:
+            mapped.append(hits)
+        else:
+            residue.append(query)
+    return (AlignmentBatch(unmapped=unmapped, mapped=mapped), residue)
 
 
 def map_reads(
@@ -94,16 +196,30 @@ def map_reads(
     unique: int,
     read_chunk: int,
     cpus: int,
-    workspace: str,
     query_seqs: List[str],
-):
+    mismatch_index: bool = False,
+    pool=None,
+) -> Iterator[AlignmentBatch]:
+    """
+    mismatch_index resolves substitution only rules by Hamming distance rather than alignment when usable, see
+    mismatch.MismatchIndex for how results differ from the aligner.  pool is passed to mapping_by_chunk().
+    """
+    (exact_batch, query_seqs) = exact_fast_path(aligner, query_seqs)
+    unique = len(query_seqs)
+    if mismatch_index and mismatch.usable(aligner):
+        logging.info(f"{exact_batch.total_reads} unique sequences resolved exactly, {unique} via mismatch index")
+        mm_index = mismatch.MismatchIndex(aligner.targets, aligner.max_penalty)
+        return iter([exact_batch, mm_index.map_queries(aligner, query_seqs)])
+    logging.info(f"{exact_batch.total_reads} unique sequences resolved without alignment, {unique} to align")
+    if unique == 0:
+        return iter([exact_batch])
+
     if unique < read_chunk * cpus:
         new_chunk = int(unique / cpus) + 1
         logging.warning(f"--chunks value {read_chunk} rescaled to {new_chunk} to utilise all CPUs")
         read_chunk = new_chunk
 
-    pickles = mapping_by_chunk(aligner, query_seqs, read_chunk, workspace, cpus)
-    return pickles
+    return chain([exact_batch], mapping_by_chunk(aligner, query_seqs, read_chunk, cpus, pool=pool))
 
 
 def sg_select_alignment(hits: List[Backtrack], rules: List[str]) -> List[Backtrack]:
@@ -125,6 +241,36 @@ def sg_select_alignment(hits: List[Backtrack], rules: List[str]) -> List[Backtra
     return best
 
 
+def select_alignments(
+    batches: Iterator[AlignmentBatch], rules: List[str]
+) -> Iterator[Tuple[str, str, Optional[List[Backtrack]]]]:
+    """
+    Reduces alignment batches to the selected hits for each query sequence
+
+    Yields:
+        original query sequence
+        hit type (unique/multimap/unmapped)
+        None|list of best Backtrack
+    """
+    ab: AlignmentBatch
+    for ab in batches:
+        # unmapped is a simple list
+        for s in ab.unmapped:
+            yield (s, "unmapped", None)
+        for hits in ab.mapped:
+            # function will need to be split out to work via:
+            #  library.header.is_single
+            best_bt = sg_select_alignment(hits, rules)
+            # for ease of access, common to all hits
+            original_seq = hits[0].sm.original_seq
+            if len(best_bt) == 0:
+                yield (original_seq, "unmapped", None)
+            elif len(best_bt) > 1:
+                yield (original_seq, "multimap", best_bt)
+            else:
+                yield (original_seq, "unique", best_bt)
+
+
 def process_reads(
     library: Library,
     seqfile: str,
@@ -139,7 +285,17 @@ def process_reads(
     reverse=False,
     exclude_by_len=None,
     boundary_mode=3,
-) -> Tuple[Dict[str, int], Dict[str, Tuple[str, List[Backtrack]]], Stats]:
+    packed=False,
+    max_memory=None,
+    strict_headers=False,
+    meta_file=None,
+    mismatch_index=False,
+    keep_alignments=True,
+) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, Tuple[str, List[Backtrack]]], Stats]:
+    """
+    Parses and maps the unique reads, one partition at a time when spilled by max_memory.  Without keep_alignments
+    the selected hits are discarded once counted so only the current partition is held, aligned_results is empty.
+    """
     (unique, stats, query_dict, _) = readparser.parse_reads(
         seqfile,
         sample=sample,
@@ -147,6 +303,11 @@ def process_reads(
         reference=reference,
         exclude_qcfail=exclude_qcfail,
         exclude_by_len=exclude_by_len,
+        packed=packed,
+        workspace=workspace,
+        max_memory=max_memory,
+        strict_headers=strict_headers,
+        meta_file=meta_file,
     )
     aligner = AlignerCpu(
         targets=library.targets,
@@ -156,44 +317,41 @@ def process_reads(
         match_type=boundary_mode,
     )
 
-    pickles = map_reads(aligner, unique, read_chunk, cpus, workspace, list(query_dict.keys()))
+    to_key = seqpack.key_function(packed)
 
     # here we are collecting the results into a dict so we can assess them as we pass over the read file again
+    # (only when alignments are to be written)
     aligned_results = {}
     guide_results = {}
     (mapped, multimap, unmapped) = (0, 0, 0)
-    for p in pickles:
-        logging.info(f"Collating data from {p}")
-        batches = ctools.unpickle(p)
-        ab: AlignmentBatch
-        for ab in batches:
-            # unmapped is a simple list
-            for s in ab.unmapped:
-                aligned_results[s] = ("unmapped", None)
-                unmapped += query_dict[s]
-            for hits in ab.mapped:
-                # function will need to be split out to work via:
-                #  library.header.is_single
-                best_bt = sg_select_alignment(hits, aligner.rules)
-                # for ease of access, common to all hits
-                original_seq = hits[0].sm.original_seq
-                if len(best_bt) == 0:
-                    aligned_results[original_seq] = ("unmapped", None)
-                    unmapped += query_dict[original_seq]
+    # a single partition unless the unique reads were spilled to disk, all share one pool
+    with mapping_pool(aligner, cpus) as pool:
+        for counts in readparser.partitions(query_dict):
+            batches = map_reads(
+                aligner,
+                len(counts),
+                read_chunk,
+                cpus,
+                [seqpack.unpack(k) for k in counts],
+                mismatch_index=mismatch_index,
+                pool=pool,
+            )
+            for (original_seq, hit_type, best_bt) in select_alignments(batches, aligner.rules):
+                key = to_key(original_seq)
+                if keep_alignments:
+                    aligned_results[key] = (hit_type, best_bt)
+                if hit_type == "unmapped":
+                    unmapped += counts[key]
                     continue
-                elif len(best_bt) > 1:
-                    aligned_results[original_seq] = ("multimap", best_bt)
-                    multimap += query_dict[original_seq]
+                elif hit_type == "multimap":
+                    multimap += counts[key]
                     continue
-
-                # don't need to check for existence on this one
-                aligned_results[original_seq] = ("unique", best_bt)
                 best_align = best_bt[0]
                 # but do here as read with mm/d/i can map to the guide
                 if best_align.sm.target not in guide_results:
                     guide_results[best_align.sm.target] = 0
-                guide_results[best_align.sm.target] += query_dict[original_seq]
-                mapped += query_dict[original_seq]
+                guide_results[best_align.sm.target] += counts[key]
+                mapped += counts[key]
 
     logging.info(f"Mapped: {mapped}, Multimap: {multimap} , Unmapped: {unmapped}")
     stats.mapped_to_guide_reads = mapped
@@ -0,0 +1,167 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+"""
+Hash based resolution of queries for substitution only rules (e.g. '--rules MM') in exact boundary mode, enabled by
+'--mismatch-index'.
+
+Targets are indexed by the pigeonhole principle, splitting each into max_mm + 1 segments. Any target within
+max_mm substitutions of a query must share at least one segment exactly, so candidates are found by lookup and only
+those are compared.
+
+Hits are ranked by Hamming distance, the full length alignments with the fewest substitutions are retained.  This is
+not identical to the aligner, which ranks by local alignment score over all targets:
+
+- a mismatch at either end of a read is soft clipped by the local alignment, failing exact boundary mode
+- a higher local score from a shifted alignment to any target resets the aligner's best score
+
+These reads can be unmapped, or mapped to a hit with more mismatches, by the aligner.  Where the aligner maps a read
+the index maps it to hits with the same or fewer mismatches.
+"""
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+
+from pygas.alignercpu import AlignerCpu
+from pygas.classes import AlignmentBatch
+from pygas.classes import Backtrack
+from pygas.classes import ScoreMatrix
+from pygas.matrix import revcomp
+
+# boundary mode exact, see tools.boundary_mode
+MATCH_TYPE_EXACT = 0
+
+
+def usable(aligner: AlignerCpu) -> bool:
+    """
+    Rules must only allow mismatches, and query/target boundaries must be equal
+    """
+    if aligner.match_type != MATCH_TYPE_EXACT or aligner.exact_only:
+        return False
+    for rule in aligner.rules:
+        if rule.upper().strip("M") != "":
+            return False
+    return True
+
+
+def _segments(seq_len: int, parts: int) -> List[Tuple[int, int]]:
+    """
+    Split a length into contiguous (start, end) segments of near equal size
+    """
+    bounds = [int(i * seq_len / parts) for i in range(0, parts + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(0, parts)]
+
+
+def _hamming(seq_a: str, seq_b: str) -> int:
+    return sum(1 for a, b in zip(seq_a, seq_b) if a != b)
+
+
+def substitution_hit(
+    query: str, target: str, target_id: int, reversed: bool, original_seq: str, match_type: int
+) -> Backtrack:
+    """
+    Backtrack of the full length alignment of equal length sequences.  Backtrack only derives this from a local
+    alignment matrix, where terminal mismatches are clipped, so the exact form is completed with the substitutions.
+    The score is the number of matching bases, as pygas scores a mismatch as 0.
+    """
+    md_ops = ["M" if q == t else t for (q, t) in zip(query, target)]
+    mismatches = len(md_ops) - md_ops.count("M")
+    sm = ScoreMatrix(
+        query=query,
+        target=target,
+        target_id=target_id,
+        score=len(query) - mismatches,
+        reversed=reversed,
+        original_seq=original_seq,
+        exact=True,
+    )
+    bt = Backtrack(sm, match_type)
+    if mismatches:
+        bt.md = bt._opt_to_md(md_ops)
+        bt.nm = mismatches
+        bt.events["M"] = mismatches
+        bt.align_target = target
+        bt.align_match = "".join(["|" if op == "M" else " " for op in md_ops])
+    return bt
+
+
+class MismatchIndex:
+    def __init__(self, targets: List[str], max_mm: int):
+        self.targets = targets
+        self.max_mm = max_mm
+        # target length -> [(start, end, {segment_seq: [target_idx,...]}), ...]
+        self._index: Dict[int, List[Tuple[int, int, Dict[str, List[int]]]]] = {}
+        for t_idx, target in enumerate(targets):
+            t_len = len(target)
+            if t_len not in self._index:
+                self._index[t_len] = [(s, e, {}) for (s, e) in _segments(t_len, max_mm + 1)]
+            for (s, e, lookup) in self._index[t_len]:
+                lookup.setdefault(target[s:e], []).append(t_idx)
+
+    def candidates(self, query: str) -> Set[int]:
+        """
+        Target indexes within max_mm substitutions of the query
+        """
+        found = set()
+        for (s, e, lookup) in self._index.get(len(query), []):
+            found.update(lookup.get(query[s:e], ()))
+        return {t_idx for t_idx in found if _hamming(query, self.targets[t_idx]) <= self.max_mm}
+
+    def map_queries(self, aligner: AlignerCpu, queries: List[str]) -> AlignmentBatch:
+        """
+        Candidates in both orientations when aligner.rev_comp are ranked by Hamming distance, all hits with the fewest
+        substitutions are retained in target order (forward before reverse).  Hits scoring below aligner.score_min are
+        discarded.
+        """
+        (hard_min, match_type) = (aligner.score_min, aligner.match_type)
+        (mapped, unmapped) = ([], [])
+        for query in queries:
+            if len(query) < hard_min:
+                unmapped.append(query)
+                continue
+            orientations = [(query, False)]
+            if aligner.rev_comp:
+                orientations.append((revcomp(query), True))
+            ranked = []
+            for (o_query, is_reversed) in orientations:
+                for t_idx in self.candidates(o_query):
+                    ranked.append((_hamming(o_query, self.targets[t_idx]), t_idx, is_reversed, o_query))
+            best_mm = min([r[0] for r in ranked], default=None)
+            if best_mm is None or len(query) - best_mm < hard_min:
+                unmapped.append(query)
+                continue
+            mapped.append(
+                [
+                    substitution_hit(o_query, self.targets[t_idx], t_idx, is_reversed, query, match_type)
+                    for (mm, t_idx, is_reversed, o_query) in sorted(ranked)
+                    if mm == best_mm
+                ]
+            )
+        return AlignmentBatch(unmapped=unmapped, mapped=mapped)
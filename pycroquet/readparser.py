@@ -29,11 +29,22 @@
 # 2009, 2010, 2011, 2012’.
 import gzip
 import logging
+import mmap
+import multiprocessing as mp
 import os
 import re
+import shutil
+import struct
+import sys
+from heapq import merge
+from itertools import islice
+from itertools import zip_longest
 from time import time
+from typing import BinaryIO
+from typing import Callable
 from typing import Dict
-from typing import TextIO
+from typing import Iterator
+from typing import List
 from typing import Tuple
 
 import magic
@@ -42,7 +53,12 @@ from pygas.matrix import revcomp
 
 from pycroquet.classes import Stats
 from pycroquet.constants import EXT_TO_HTS
+from pycroquet.gzreader import BgzfReader
+from pycroquet.gzreader import is_bgzf
+from pycroquet.gzreader import ReadaheadGzipReader
 from pycroquet.htscomm import hts_reader
+from pycroquet.seqpack import key_function
+from pycroquet.seqpack import unpack
 
 
 ILLUMINA_SINGLE_FASTQ_HEADER_PATTERN = re.compile(r"^@([^\s/]+)$")
@@ -50,8 +66,119 @@ ILLUMINA_FASTQ_HEADER_PATTERN = re.compile(r"^@(\S+)/([12])$")
 CASAVA_FASTQ_HEADER_PATTERN = re.compile(r"^@(\S+)\s([012]):([YN])+:[\d+]+:\S+$")
 
 LOAD_INFO_THRESHOLD = 1000000
+# fastq records checked by input_stats() to decide the phred offset
+PHRED_SAMPLE_READS = 10000
+# primary hts records checked by name_grouped() when the header doesn't declare the order
+GROUPED_SAMPLE_READS = 10000
+# ReadMetaWriter record header: flags, pair member, then lengths of read group, qname, sequence and quality (uint32 as
+# long-read sequences can exceed 65,535 b.p.)
+META_RECORD = struct.Struct("<BBIIII")
+META_QC_FAIL = 1
+META_NO_QUAL = 2
+FQ_BLOCK_SIZE = 4 * 1024 * 1024
 OFFSET_ILLUMINA = 64
 OFFSET_CASAVA = 33
+# quality bytes that can't be phred+64
+PHRED64_INVALID = bytes(range(0, OFFSET_ILLUMINA))
+# decoded value of quality bytes below the offset, see phred_table()
+PHRED_INVALID = 255
+
+SPILL_BUCKETS = 64
+# approximate cost of a dict entry and its count, beyond the key itself
+DICT_ENTRY_BYTES = 100
+
+
+def _read_counts(count_file: str) -> Iterator[Tuple[str, int]]:
+    with open(count_file, "rt") as ifh:
+        for line in ifh:
+            (seq, count) = line.rstrip("\n").split("\t")
+            yield (seq, int(count))
+
+
+class SpilledReads:
+    """
+    Unique read counts held on disk as hash partitions, each file sorted by sequence with no duplicates
+    """
+
+    def __init__(self, count_files: List[str], unique: int, packed: bool = False):
+        self.count_files = count_files
+        self.unique = unique
+        self.packed = packed
+
+    def __len__(self):
+        return self.unique
+
+    def partitions(self) -> Iterator[Dict[str, int]]:
+        to_key = key_function(self.packed)
+        for count_file in self.count_files:
+            yield {to_key(seq): count for (seq, count) in _read_counts(count_file)}
+
+    def sorted_items(self) -> Iterator[Tuple[str, int]]:
+        return merge(*[_read_counts(count_file) for count_file in self.count_files])
+
+
+class ReadSpill:
+    """
+    Hash partitions the unique read table into bucket files in the workspace whenever the estimated size exceeds
+    max_memory (MB).  The same sequence may be dumped several times, finalise() merges the counts.
+    """
+
+    def __init__(self, workspace: str, max_memory: int, packed: bool = False, buckets: int = SPILL_BUCKETS):
+        self.limit = max_memory * 1024 * 1024
+        self.used = 0
+        self.packed = packed
+        self.count_files = [os.path.join(workspace, f"unique_reads_{i:03d}.tsv") for i in range(0, buckets)]
+        self.spills = 0
+
+    def account(self, key) -> bool:
+        """
+        Record a new key, True when the budget is exceeded
+        """
+        self.used += sys.getsizeof(key) + DICT_ENTRY_BYTES
+        return self.used > self.limit
+
+    def dump(self, reads: Dict[str, int]):
+        fhs = [open(count_file, "at") for count_file in self.count_files]
+        buckets = len(fhs)
+        for key, count in reads.items():
+            print(f"{unpack(key)}\t{count}", file=fhs[hash(key) % buckets])
+        for fh in fhs:
+            fh.close()
+        self.spills += 1
+        logging.info(f"Unique read table exceeded memory budget, spill {self.spills} wrote {len(reads)} sequences")
+        reads.clear()
+        self.used = 0
+
+    def finalise(self, reads: Dict[str, int]) -> SpilledReads:
+        self.dump(reads)
+        unique = 0
+        for count_file in self.count_files:
+            merged = {}
+            for (seq, count) in _read_counts(count_file):
+                merged[seq] = merged.get(seq, 0) + count
+            with open(count_file, "wt") as ofh:
+                for seq in sorted(merged.keys()):
+                    print(f"{seq}\t{merged[seq]}", file=ofh)
+            unique += len(merged)
+        return SpilledReads(self.count_files, unique, packed=self.packed)
+
+
+def partitions(reads) -> Iterator[Dict[str, int]]:
+    """
+    Iterate the unique read table in parts that fit in memory
+    """
+    if isinstance(reads, SpilledReads):
+        return reads.partitions()
+    return iter([reads])
+
+
+def sorted_counts(reads) -> Iterator[Tuple[str, int]]:
+    """
+    (sequence, count) ordered by sequence
+    """
+    if isinstance(reads, SpilledReads):
+        return reads.sorted_items()
+    return iter(sorted((unpack(k), v) for k, v in reads.items()))
 
 
 def parse_fq_header(header: str):
@@ -80,6 +207,134 @@ def parse_fq_header(header: str):
     return (name, pair_member, qc_fail, phred_offset)
 
 
+def _illumina_single_header(header: str):
+    return (header[1:], None, False, OFFSET_ILLUMINA)
+
+
+def _illumina_header(header: str):
+    return (header[1:-2], int(header[-1]), False, OFFSET_ILLUMINA)
+
+
+def _casava_header(header: str):
+    (name, comment) = header[1:].split(maxsplit=1)
+    # comment is "member:filtered:control:index"
+    return (name, int(comment[0]), comment[2] == "Y", OFFSET_CASAVA)
+
+
+def phred_table(offset: int) -> bytes:
+    """
+    bytes.translate() table decoding a quality line with offset, bytes below the offset decode to PHRED_INVALID
+    """
+    return bytes([b - offset if b >= offset else PHRED_INVALID for b in range(0, 256)])
+
+
+def fq_header_parser(header: str, strict=False) -> Callable[[str], Tuple[str, int, bool, int]]:
+    """
+    Detects the header format from the first record of a file (raising if unsupported) and returns a function
+    producing the same result as parse_fq_header() for the remaining records without regex validation.
+
+    When strict, parse_fq_header() is returned so every header is validated.
+    """
+    (_, pair_member, _, phred_offset) = parse_fq_header(header)
+    if strict:
+        return parse_fq_header
+    if phred_offset == OFFSET_CASAVA:
+        return _casava_header
+    if pair_member is None:
+        return _illumina_single_header
+    return _illumina_header
+
+
+def fq_records(ifh: BinaryIO, block_size=FQ_BLOCK_SIZE) -> Iterator[Tuple[bytes, bytes, bytes]]:
+    """
+    Yields (header, sequence, quality) as bytes from a binary fastq handle, decoding is left to the caller.
+
+    Data is read in large blocks and split on newlines, only complete records are emitted from each block.
+    """
+    remainder = b""
+    strip = None
+    while True:
+        block = ifh.read(block_size)
+        if not block:
+            break
+        lines = (remainder + block).split(b"\n")
+        if strip is None and len(lines) > 1:
+            strip = lines[0].endswith(b"\r")
+        # the last line may be partial, also carry any incomplete record to the next block
+        end = (len(lines) - 1) // 4 * 4
+        remainder = b"\n".join(lines[end:])
+        if strip:
+            lines = [line.rstrip() for line in lines[0:end]]
+        yield from zip(lines[0:end:4], lines[1:end:4], lines[3:end:4])
+
+    lines = remainder.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError("FastQ input is truncated, final record is incomplete")
+    if strip:
+        lines = [line.rstrip() for line in lines]
+    yield from zip(lines[0::4], lines[1::4], lines[3::4])
+
+
+def fq_pair_records(ifh_r1: BinaryIO, ifh_r2: BinaryIO) -> Iterator[Tuple[bytes, bytes, bytes]]:
+    """
+    Yields the records of synchronised read 1 and read 2 fastq handles interleaved, as fq_records().
+    """
+    for (rec_1, rec_2) in zip_longest(fq_records(ifh_r1), fq_records(ifh_r2)):
+        if rec_1 is None or rec_2 is None:
+            raise ValueError("Paired fastq files have different numbers of records")
+        yield rec_1
+        yield rec_2
+
+
+class ReadMetaWriter:
+    """
+    Compact binary side file of the reads kept while parsing, allows alignments to be written without decoding the
+    input again.  Each record is a META_RECORD header followed by the read group, qname, sequence and quality bytes.
+    Sequence and quality are as in the input, forward orientation and untrimmed.  Fastq qualities are left phred+offset
+    encoded as the offset is only known once parsing completes, hts qualities are phred values.
+    """
+
+    def __init__(self, meta_file: str):
+        self.meta_file = meta_file
+        self._fh = open(meta_file, "wb")
+
+    def write(self, qname: str, seq: bytes, qual: bytes, qc_fail: bool, member: int = None, rgid: str = None):
+        qname = qname.encode()
+        rgid = rgid.encode() if rgid else b""
+        flags = META_QC_FAIL if qc_fail else 0
+        if qual is None:
+            (flags, qual) = (flags | META_NO_QUAL, b"")
+        self._fh.write(
+            META_RECORD.pack(flags, member or 0, len(rgid), len(qname), len(seq), len(qual)) + rgid + qname + seq + qual
+        )
+
+    def close(self):
+        self._fh.close()
+
+
+def meta_records(meta_file: str) -> Iterator[Tuple[str, bytes, bytes, bool, int, str]]:
+    """
+    Yields (qname, sequence, quality, qc_fail, member, rgid) from a ReadMetaWriter file, quality is None when the
+    input had none, member and rgid are None when not set.
+    """
+    (head_size, unpack_head) = (META_RECORD.size, META_RECORD.unpack)
+    with open(meta_file, "rb", buffering=FQ_BLOCK_SIZE) as ifh:
+        while head := ifh.read(head_size):
+            (flags, member, rg_len, qname_len, seq_len, qual_len) = unpack_head(head)
+            body = ifh.read(rg_len + qname_len + seq_len + qual_len)
+            pos = rg_len + qname_len
+            yield (
+                body[rg_len:pos].decode(),
+                body[pos : pos + seq_len],
+                None if flags & META_NO_QUAL else body[pos + seq_len :],
+                bool(flags & META_QC_FAIL),
+                member or None,
+                body[0:rg_len].decode() if rg_len else None,
+            )
+
+
 def is_gzip(seq_file):
     magic_types = magic.from_file(seq_file)
     if "gzip compressed data" in magic_types or "gzip compatible" in magic_types:
@@ -87,6 +342,19 @@ def is_gzip(seq_file):
     return False
 
 
+def open_fastq(seq_file, cpus=1) -> BinaryIO:
+    """
+    Binary handle for fastq input, when cpus > 1 gzip input is inflated in parallel (BGZF) or by a background thread
+    """
+    if not is_gzip(seq_file):
+        return open(seq_file, "rb")
+    if cpus > 1:
+        if is_bgzf(seq_file):
+            return BgzfReader(seq_file, cpus)
+        return ReadaheadGzipReader(seq_file)
+    return gzip.open(seq_file, "rb")
+
+
 def parse_reads(
     seq_file: str,
     sample,
@@ -97,10 +365,26 @@ def parse_reads(
     exclude_by_len=None,
     paired=False,
     trim_len=0,
+    packed=False,
+    workspace=None,
+    max_memory=None,
+    strict_headers=False,
+    meta_file=None,
+    mate_file=None,
 ) -> Tuple[int, Stats, Dict[str, int]]:
     """
     This function is for the initial collation of unique read sequences in the original orientation only (hts will do revcomp).
-    The is no chunking of data so this relies on large memory lookups at present.
+
+    When packed the unique read sequences are keyed by seqpack.pack() to reduce memory.
+
+    When max_memory (MB) is set the unique read table is spilled to workspace as hash partitions once it exceeds the
+    budget, the returned table is then a SpilledReads object, see partitions().  Pairs are never spilled.
+
+    The fastq header format is detected from the first record, strict_headers validates every record.
+
+    When meta_file is set the reads kept are also written to it, see ReadMetaWriter (not for paired).
+
+    Paired fastq is either interleaved in seq_file or read 1 in seq_file with read 2 in mate_file.
 
     Selecting correct underlying parser is via file extension:
     - cram/bam/sam -> htslib processing
@@ -114,6 +398,14 @@ def parse_reads(
     ext = os.path.splitext(seq_file)[1]
 
     response = None
+    spill = None
+    if max_memory:
+        spill = ReadSpill(workspace, max_memory, packed=packed)
+    by_ranges = ext not in EXT_TO_HTS and cpus > 1 and not paired and spill is None and not is_gzip(seq_file)
+    meta = None
+    if meta_file and not by_ranges:
+        # parse_fastq_ranges() writes and joins a file per range
+        meta = ReadMetaWriter(meta_file)
 
     if ext in EXT_TO_HTS:
         logging.info(f"Sequence input detected as *{ext}")
@@ -128,15 +420,31 @@ def parse_reads(
             exclude_by_len=exclude_by_len,
             paired=paired,
             trim_len=trim_len,
+            packed=packed,
+            spill=spill,
+            meta=meta,
+        )
+    elif by_ranges:
+        logging.info("uncompressed data (assume fastq)")
+        response = parse_fastq_ranges(
+            seq_file,
+            sample,
+            cpus,
+            exclude_qcfail=exclude_qcfail,
+            reverse=reverse,
+            exclude_by_len=exclude_by_len,
+            trim_len=trim_len,
+            packed=packed,
+            strict_headers=strict_headers,
+            meta_file=meta_file,
         )
     else:
-        fq_fh = None
         if is_gzip(seq_file):
             logging.info("Sequence input detected as gzip (assume fastq)")
-            fq_fh = gzip.open(seq_file, "rt")
         else:
             logging.info("uncompressed data (assume fastq)")
-            fq_fh = open(seq_file)
+        fq_fh = open_fastq(seq_file, cpus=cpus)
+        mate_fh = open_fastq(mate_file, cpus=cpus) if mate_file else None
         response = parse_fastq(
             fq_fh,
             sample,
@@ -145,7 +453,14 @@ def parse_reads(
             exclude_by_len=exclude_by_len,
             paired=paired,
             trim_len=trim_len,
+            packed=packed,
+            spill=spill,
+            strict_headers=strict_headers,
+            meta=meta,
+            mate_ifh=mate_fh,
         )
+    if meta is not None:
+        meta.close()
     if paired:
         logging.info(f"Parsed {response[1].total_pairs} pairs, {len(response[3])} were unique...")
     else:
@@ -170,6 +485,35 @@ def _hts_sample(sam: pysam.AlignmentFile, sample=None):
     return sample
 
 
+def input_stats(seq_file: str, sample=None, reference=None) -> Stats:
+    """
+    Stats for consumers that don't pass over the input before writing alignments, see singlepass.  The sample name is
+    checked as by parse_reads() and for fastq the phred offset is decided from the first PHRED_SAMPLE_READS records.
+    """
+    ext = os.path.splitext(seq_file)[1]
+    if ext in EXT_TO_HTS:
+        sam = hts_reader(seq_file, EXT_TO_HTS[ext], 1, reference)
+        stats = Stats(sample_name=_hts_sample(sam, sample=sample))
+        sam.close()
+        if stats.sample_name is None:
+            raise ValueError("No sample name found in input file header, please provide via '--sample'")
+        return stats
+
+    stats = Stats(sample_name=sample)
+    if stats.sample_name is None:
+        raise ValueError("--sample must be provided for fastq inputs")
+    ifh = open_fastq(seq_file)
+    (phred_offset, low_qual) = (None, False)
+    for (header, _, qual) in islice(fq_records(ifh), PHRED_SAMPLE_READS):
+        (_, _, _, phred_offset) = parse_fq_header(header.decode())
+        if len(qual.translate(None, PHRED64_INVALID)) != len(qual):
+            low_qual = True
+            break
+    ifh.close()
+    stats.phred_offset = OFFSET_CASAVA if low_qual else phred_offset
+    return stats
+
+
 def parse_htsfile(
     seq_file: str,
     mode: str,
@@ -181,6 +525,9 @@ def parse_htsfile(
     exclude_by_len=None,
     paired=False,
     trim_len=0,
+    packed=False,
+    spill: ReadSpill = None,
+    meta: ReadMetaWriter = None,
 ) -> Tuple[int, Stats, Dict[str, int]]:
     sam = hts_reader(seq_file, mode, cpus, reference)
 
@@ -188,6 +535,7 @@ def parse_htsfile(
     if stats.sample_name is None:
         raise ValueError("No sample name found in input file header, please provide via '--sample'")
 
+    to_key = key_function(packed)
     reads = {}
     (unique, total, len_ex, total_pairs, unique_pairs) = (0, 0, 0, 0, 0)
     last_read = None
@@ -203,6 +551,16 @@ def parse_htsfile(
             stats.vendor_failed_reads += 1
 
         seq = read.get_forward_sequence()
+        if meta is not None:
+            qual = read.get_forward_qualities()
+            meta.write(
+                read.query_name,
+                seq.encode(),
+                None if qual is None else qual.tobytes(),
+                read.is_qcfail,
+                member=(1 if read.is_read1 else 2) if read.is_paired else None,
+                rgid=read.get_tag("RG") if read.has_tag("RG") else None,
+            )
         if trim_len:
             seq = seq[0:trim_len]
         if exclude_by_len and len(seq) < exclude_by_len:
@@ -218,7 +576,9 @@ def parse_htsfile(
                 last_seq = seq
             else:
                 if last_read != read.query_name:
-                    raise ValueError("Paired reads require collation before parsing")
+                    raise ValueError(
+                        f"Paired reads require collation before parsing, mates of {read.query_name} are not adjacent"
+                    )
                 pair_seq = f"{last_seq}|{seq}"
                 total_pairs += 1
                 if pair_seq in pairs:
@@ -226,11 +586,14 @@ def parse_htsfile(
                 else:
                     pairs[pair_seq] = 1
                     unique_pairs += 1
-        if seq in reads:
-            reads[seq] += 1
+        key = to_key(seq)
+        if key in reads:
+            reads[key] += 1
         else:
-            reads[seq] = 1
+            reads[key] = 1
             unique += 1
+            if spill is not None and spill.account(key):
+                spill.dump(reads)
         total += 1
         if total % LOAD_INFO_THRESHOLD == 0:  # pragma: no cover
             if paired:
@@ -238,6 +601,9 @@ def parse_htsfile(
             else:
                 logging.debug(f"Parsed {total_pairs} pairs, {unique_pairs} were unique...")
     sam.close()
+    if spill is not None and spill.spills:
+        reads = spill.finalise(reads)
+        unique = len(reads)
     stats.total_reads = total
     stats.total_pairs = total_pairs
     stats.reversed_reads = reverse
@@ -247,41 +613,59 @@ def parse_htsfile(
 
 
 def parse_fastq(
-    ifh: TextIO,
+    ifh: BinaryIO,
     sample,
     exclude_qcfail=False,
     reverse=False,
     exclude_by_len=None,
     paired=False,
     trim_len=0,
+    packed=False,
+    spill: ReadSpill = None,
+    strict_headers=False,
+    meta: ReadMetaWriter = None,
+    mate_ifh: BinaryIO = None,
 ) -> Tuple[int, Stats, Dict[str, int]]:
     """
-    Closes received file handle
+    Closes received file handle(s), must be opened in binary mode
     Only used for the reads seq minimization process
+
+    When paired the records must alternate read 1 then read 2, either interleaved in ifh or from the synchronised
+    ifh/mate_ifh.  The pair member is taken from the header, or from the position when the header lacks it.
+
+    The phred offset is taken from the header format unless a quality byte below phred+64 is seen, see
+    Stats.phred_offset.
     """
     stats = Stats(sample_name=sample)
     if stats.sample_name is None:
         raise ValueError("--sample must be provided for fastq inputs")
 
-    if paired:
-        raise ValueError("fastq doesn't support paired processing yet")
-
+    to_key = key_function(packed)
     reads = {}
-    (unique, total, len_ex) = (0, 0, 0)
+    (unique, total, len_ex, total_pairs, unique_pairs) = (0, 0, 0, 0, 0)
+    last_read = None
+    last_seq = None
     pairs = {} if paired else None
-    header = ifh.readline()
-    while header:
-        seq = ifh.readline().strip()
-        _ = ifh.readline()  # throw away separator
-        _ = ifh.readline()  # throw away qual at this point
-        (_, _, qc_fail, _) = parse_fq_header(header.strip())  # for validation only here
-        # looks odd, but best way to handle end of file
-        header = ifh.readline()
+    header_parser = None
+    (phred_offset, low_qual) = (None, False)
+    records = fq_records(ifh) if mate_ifh is None else fq_pair_records(ifh, mate_ifh)
+    for (rec_idx, (header, seq, qual)) in enumerate(records):
+        if header_parser is None:
+            header_parser = fq_header_parser(header.decode(), strict=strict_headers)
+        (qname, member, qc_fail, phred_offset) = header_parser(header.decode())
+        if paired and member is None:
+            member = rec_idx % 2 + 1
+        # qual is only checked while phred+64 is possible
+        if phred_offset == OFFSET_ILLUMINA and not low_qual and len(qual.translate(None, PHRED64_INVALID)) != len(qual):
+            low_qual = True
         if qc_fail:
             if exclude_qcfail:
                 continue
             # only count them if we keep them
             stats.vendor_failed_reads += 1
+        if meta is not None:
+            meta.write(qname, seq, qual, qc_fail, member=member)
+        seq = seq.decode()
         if trim_len:
             seq = seq[0:trim_len]
         if exclude_by_len and len(seq) < exclude_by_len:
@@ -289,25 +673,221 @@ def parse_fastq(
             continue
         if reverse:
             seq = revcomp(seq)
-        if seq in reads:
-            reads[seq] += 1
+        if paired:
+            if member == 1:
+                last_read = qname
+                last_seq = seq
+            else:
+                if last_read != qname:
+                    raise ValueError("Paired fastq must be interleaved or synchronised read 1/read 2 files")
+                pair_seq = f"{last_seq}|{seq}"
+                last_read = None
+                total_pairs += 1
+                if pair_seq in pairs:
+                    pairs[pair_seq] += 1
+                else:
+                    pairs[pair_seq] = 1
+                    unique_pairs += 1
+        key = to_key(seq)
+        if key in reads:
+            reads[key] += 1
         else:
-            reads[seq] = 1
+            reads[key] = 1
             unique += 1
+            if spill is not None and spill.account(key):
+                spill.dump(reads)
         total += 1
         if total % LOAD_INFO_THRESHOLD == 0:  # pragma: no cover
             logging.debug(f"Parsed {total} reads, {unique} were unique...")
     ifh.close()
+    if mate_ifh is not None:
+        mate_ifh.close()
+    if spill is not None and spill.spills:
+        reads = spill.finalise(reads)
+        unique = len(reads)
     stats.total_reads = total
+    stats.total_pairs = total_pairs
     stats.reversed_reads = reverse
+    stats.phred_offset = OFFSET_CASAVA if low_qual else phred_offset
     if exclude_by_len:
         stats.length_excluded_reads = len_ex
     return (unique, stats, reads, pairs)
 
 
-def collate(seq_file, workspace, cpus):
+class _MmapRange:
+    """
+    Binary read handle over a byte range of a memory mapped file
+    """
+
+    def __init__(self, seq_file, start: int, end: int):
+        self._fh = open(seq_file, "rb")
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = start
+        self._end = end
+
+    def read(self, size=-1) -> bytes:
+        if size < 0:
+            size = self._end - self._pos
+        data = self._mm[self._pos : min(self._pos + size, self._end)]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._mm.close()
+        self._fh.close()
+
+
+def _next_record(mm, offset: int) -> int:
+    """
+    Offset of the first record starting at or after offset.  A record starts with an '@' line followed two lines later
+    by a '+' line, checking both avoids quality lines starting with '@'.
+    """
+    size = len(mm)
+    if offset <= 0:
+        return 0
+    pos = mm.find(b"\n", offset - 1) + 1
+    while 0 < pos < size:
+        if mm[pos : pos + 1] == b"@":
+            seq_end = mm.find(b"\n", mm.find(b"\n", pos) + 1)
+            if seq_end != -1 and mm[seq_end + 1 : seq_end + 2] == b"+":
+                return pos
+        pos = mm.find(b"\n", pos) + 1
+    return size
+
+
+def fq_ranges(seq_file, parts: int) -> List[Tuple[int, int]]:
     """
-    collates reads into pairs IF input is a hts file
+    Split an uncompressed fastq into at most parts byte ranges, each starting on a record boundary
+    """
+    with open(seq_file, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return [(0, 0)]
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            bounds = sorted({_next_record(mm, size * i // parts) for i in range(0, parts)} | {size})
+    return list(zip(bounds[0:-1], bounds[1:]))
+
+
+def _parse_fastq_range(
+    seq_file, start, end, sample, exclude_qcfail, reverse, exclude_by_len, trim_len, packed, strict, meta_file
+):
+    meta = None if meta_file is None else ReadMetaWriter(meta_file)
+    response = parse_fastq(
+        _MmapRange(seq_file, start, end),
+        sample,
+        exclude_qcfail=exclude_qcfail,
+        reverse=reverse,
+        exclude_by_len=exclude_by_len,
+        trim_len=trim_len,
+        packed=packed,
+        strict_headers=strict,
+        meta=meta,
+    )
+    if meta is not None:
+        meta.close()
+    return response
+
+
+def parse_fastq_ranges(
+    seq_file,
+    sample,
+    cpus,
+    exclude_qcfail=False,
+    reverse=False,
+    exclude_by_len=None,
+    trim_len=0,
+    packed=False,
+    strict_headers=False,
+    meta_file=None,
+) -> Tuple[int, Stats, Dict[str, int]]:
+    """
+    Uncompressed fastq is split into byte ranges on record boundaries that are parsed by worker processes via mmap.
+    The partial count tables and Stats are merged in file order, giving the same result as parse_fastq.  Each range
+    writes its own meta_file part, these are joined in file order.
+    """
+    stats = Stats(sample_name=sample)
+    if stats.sample_name is None:
+        raise ValueError("--sample must be provided for fastq inputs")
+    ranges = fq_ranges(seq_file, cpus)
+    meta_parts = [None] * len(ranges)
+    if meta_file:
+        meta_parts = [f"{meta_file}.{i:03d}" for i in range(0, len(ranges))]
+    args = [
+        (seq_file, start, end, sample, exclude_qcfail, reverse, exclude_by_len, trim_len, packed, strict_headers, part)
+        for ((start, end), part) in zip(ranges, meta_parts)
+    ]
+    logging.info(f"Parsing uncompressed fastq as {len(args)} byte ranges")
+    if len(args) == 1:
+        partials = [_parse_fastq_range(*args[0])]
+    else:
+        with mp.Pool(len(args)) as pool:
+            partials = pool.starmap(_parse_fastq_range, args)
+    if meta_file:
+        with open(meta_file, "wb") as ofh:
+            for part in meta_parts:
+                with open(part, "rb") as ifh:
+                    shutil.copyfileobj(ifh, ofh)
+                os.remove(part)
+
+    reads = {}
+    len_ex = 0
+    offsets = set()
+    for (_, part_stats, part_reads, _) in partials:
+        if part_stats.phred_offset is not None:
+            offsets.add(part_stats.phred_offset)
+        stats.total_reads += part_stats.total_reads
+        stats.vendor_failed_reads += part_stats.vendor_failed_reads
+        if exclude_by_len:
+            len_ex += part_stats.length_excluded_reads
+        if not reads:
+            reads = part_reads
+            continue
+        for key, count in part_reads.items():
+            if key in reads:
+                reads[key] += count
+            else:
+                reads[key] = count
+    stats.reversed_reads = reverse
+    # any range with qualities below phred+64 applies to the whole file
+    stats.phred_offset = min(offsets) if offsets else None
+    if exclude_by_len:
+        stats.length_excluded_reads = len_ex
+    return (len(reads), stats, reads, None)
+
+
+def name_grouped(seq_file, reference=None, sample_reads=GROUPED_SAMPLE_READS) -> bool:
+    """
+    True when the mates of a hts file are adjacent (read 1 then read 2), as declared by header SO:queryname.  Without it
+    (and not SO:coordinate) the first sample_reads primary records are checked instead, e.g. unaligned BAM direct from
+    the sequencer.  GO:query is checked too, it neither orders read 1 before read 2 nor excludes secondary and
+    supplementary records from the groups.
+
+    Only a cheap check, pair parsing verifies every pair and raises on the first mates that are not adjacent.
+    """
+    sam = hts_reader(seq_file, EXT_TO_HTS[os.path.splitext(seq_file)[1]], 1, reference)
+    hd = sam.header.to_dict().get("HD", {})
+    grouped = hd.get("SO") == "queryname"
+    if not grouped and hd.get("SO") != "coordinate":
+        primary = (r for r in sam.fetch(until_eof=True) if not (r.is_secondary or r.is_supplementary))
+        last_read = None
+        grouped = True
+        for read in islice(primary, sample_reads):
+            if not read.is_paired:
+                continue
+            if read.is_read1 and last_read is None:
+                last_read = read.query_name
+            elif read.is_read2 and last_read == read.query_name:
+                last_read = None
+            else:
+                grouped = False
+                break
+    sam.close()
+    return grouped
+
+
+def collate(seq_file, workspace, cpus, reference=None):
+    """
+    collates reads into pairs IF input is a hts file and mates are not already adjacent, see name_grouped()
     """
     start = time()
     hts_cpus = cpus
@@ -316,6 +896,9 @@ def collate(seq_file, workspace, cpus):
     ext = os.path.splitext(seq_file)[1]
     if ext not in EXT_TO_HTS:
         return seq_file
+    if name_grouped(seq_file, reference=reference):
+        logging.info(f"Pairs in {seq_file} are grouped by name, collation not required")
+        return seq_file
     tmp_hts = os.path.join(workspace, "collated.reads.bam")
     logging.info(f"Collating pairs from {seq_file} to {tmp_hts}")
     collate_opts = ["-f", "-l", "1", "--no-PG", "-@", str(hts_cpus), "-o", tmp_hts, seq_file]
@@ -28,11 +28,14 @@
 # identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
 # 2009, 2010, 2011, 2012’.
 import copy
-import gzip
 import hashlib
 import logging
+import multiprocessing as mp
 import os
+import shutil
 from array import array
+from collections import deque
+from itertools import islice
 from typing import Dict
 from typing import Iterator
 from typing import List
@@ -42,14 +45,29 @@ import pysam
 from pygas.classes import Backtrack
 from pygas.matrix import revcomp
 
+from pycroquet.classes import HtsOptions
 from pycroquet.classes import Library
 from pycroquet.classes import Seqread
 from pycroquet.classes import Stats
 from pycroquet.constants import EXT_TO_HTS
+from pycroquet.htscomm import buckets_to_cram
+from pycroquet.htscomm import BucketWriter
 from pycroquet.htscomm import hts_reader
-from pycroquet.htscomm import hts_sort_n_index
-from pycroquet.readparser import is_gzip
-from pycroquet.readparser import parse_fq_header
+from pycroquet.readparser import fq_header_parser
+from pycroquet.readparser import fq_pair_records
+from pycroquet.readparser import fq_records
+from pycroquet.readparser import meta_records
+from pycroquet.readparser import open_fastq
+from pycroquet.readparser import PHRED_INVALID
+from pycroquet.readparser import phred_table
+from pycroquet.readparser import sorted_counts
+from pycroquet.seqpack import key_function
+
+SHARD_READS = 50000
+# read count of a collapsed alignment record
+COUNT_TAG = "YC"
+TEMPLATE_CACHE_SIZE = 100000
+_SHARD_ARGS = None
 
 
 def _hts_iter(
@@ -89,36 +107,86 @@ def _hts_iter(
     sam.close()
 
 
-def _fq_iter(ifh, exclude_qcfail, reverse, offset_override=None, default_rgid=None, trim_len=0) -> Iterator[Seqread]:
-    header = ifh.readline()
-    while header:
-        seq = ifh.readline().strip()
-        _ = ifh.readline()  # throw away separator
-        qual_str = ifh.readline().strip()
-        if trim_len:
-            seq = seq[0:trim_len]
-            qual_str = qual_str[0:trim_len]
-        (qname, member, qc_fail, phred_offset) = parse_fq_header(header.strip())  # for validation only here
+def _fq_iter(
+    ifh,
+    exclude_qcfail,
+    reverse,
+    offset_override=None,
+    default_rgid=None,
+    trim_len=0,
+    strict_headers=False,
+    paired=False,
+    mate_ifh=None,
+) -> Iterator[Seqread]:
+    """
+    When paired the records alternate read 1 then read 2 (interleaved, or from synchronised ifh/mate_ifh), the member
+    is set from the position when the header lacks it.
+    """
+    header_parser = None
+    tables = {}
+    records = fq_records(ifh) if mate_ifh is None else fq_pair_records(ifh, mate_ifh)
+    for (rec_idx, (header, seq, qual)) in enumerate(records):
+        if header_parser is None:
+            header_parser = fq_header_parser(header.decode(), strict=strict_headers)
+        (qname, member, qc_fail, phred_offset) = header_parser(header.decode())
+        if paired and member is None:
+            member = rec_idx % 2 + 1
         if qc_fail and exclude_qcfail:
-            header = ifh.readline()
             continue
+        if trim_len:
+            seq = seq[0:trim_len]
+            qual = qual[0:trim_len]
+        seq = seq.decode()
         if offset_override:
             phred_offset = offset_override
-        phred_arr = [i - phred_offset for i in map(ord, qual_str)]
+        if phred_offset not in tables:
+            tables[phred_offset] = phred_table(phred_offset)
+        # decoded in bulk, array('B') is taken as is by pysam
+        qual = qual.translate(tables[phred_offset])
+        if PHRED_INVALID in qual:
+            raise ValueError(f"Quality below phred offset {phred_offset} for read {qname}, please set '--qual_offset'")
 
         if reverse:
-            phred_arr.reverse()
+            qual = qual[::-1]
             seq = revcomp(seq)
         yield Seqread(
             qname=qname,
             member=member,
             sequence=seq,
-            qual=array("i", phred_arr),
+            qual=array("B", qual),
             qc_fail=qc_fail,
             rgid=default_rgid,
         )
-        header = ifh.readline()
     ifh.close()
+    if mate_ifh is not None:
+        mate_ifh.close()
+
+
+def _meta_iter(meta_file, hts, reverse, offset, default_rgid=None, trim_len=0) -> Iterator[Seqread]:
+    """
+    Reads from the ReadMetaWriter file of parse_reads(), exclusions were applied when it was written.
+    """
+    table = None if hts else phred_table(offset)
+    for (qname, seq, qual, qc_fail, member, rgid) in meta_records(meta_file):
+        if trim_len:
+            seq = seq[0:trim_len]
+            qual = None if qual is None else qual[0:trim_len]
+        seq = seq.decode()
+        if table is not None:
+            qual = qual.translate(table)
+            if PHRED_INVALID in qual:
+                raise ValueError(f"Quality below phred offset {offset} for read {qname}, please set '--qual_offset'")
+        if reverse:
+            seq = revcomp(seq)
+            qual = None if qual is None else qual[::-1]
+        yield Seqread(
+            qname=qname,
+            member=member,
+            sequence=seq,
+            qual=None if qual is None else array("B", qual),
+            qc_fail=qc_fail,
+            rgid=rgid or default_rgid,
+        )
 
 
 def read_iter(
@@ -130,10 +198,18 @@ def read_iter(
     default_rgid=None,
     cpus=1,
     trim_len=0,
+    strict_headers=False,
+    read_meta=None,
+    paired=False,
+    mate_file=None,
 ) -> Iterator[Seqread]:
     base_iter = None
     ext = os.path.splitext(seq_file)[1]
-    if ext in EXT_TO_HTS:
+    if read_meta:
+        base_iter = _meta_iter(
+            read_meta, ext in EXT_TO_HTS, reverse, offset, default_rgid=default_rgid, trim_len=trim_len
+        )
+    elif ext in EXT_TO_HTS:
         base_iter = _hts_iter(
             seq_file,
             EXT_TO_HTS[ext],
@@ -145,29 +221,29 @@ def read_iter(
             trim_len=trim_len,
         )
     else:
-        fq_fo = None
-        if is_gzip(seq_file):
-            fq_fo = gzip.open(seq_file, "rt")
-        else:
-            fq_fo = open(seq_file, "rt")
         base_iter = _fq_iter(
-            fq_fo,
+            open_fastq(seq_file, cpus=cpus),
             exclude_qcfail,
             reverse,
             offset_override=offset,
             default_rgid=default_rgid,
             trim_len=trim_len,
+            strict_headers=strict_headers,
+            paired=paired,
+            mate_ifh=open_fastq(mate_file, cpus=cpus) if mate_file else None,
         )
     return base_iter
 
 
 def to_alignment(seqread: Seqread, reverse: bool, tags: List[Tuple[str, str]], unmapped=False) -> pysam.AlignedSegment:
-    tags.append(("RG", seqread.rgid))
+    if seqread.rgid is not None:
+        tags.append(("RG", seqread.rgid))
     a = pysam.AlignedSegment()
+    # collapsed records have no qualities, seqread.qual is shared by all records of a read so is not reversed in place
     if reverse:
         a.query_sequence = revcomp(seqread.sequence)
-        seqread.qual.reverse()
-        a.query_qualities = seqread.qual
+        if seqread.qual is not None:
+            a.query_qualities = seqread.qual[::-1]
         a.is_reverse = True
     else:
         a.query_sequence = seqread.sequence
@@ -272,16 +348,13 @@ def sm_from_guide_hit(library: Library, hit: Backtrack, strand: str, mapq: int =
     return sa_set
 
 
-def to_mapped_reads(
-    seqread,
-    ref_ids,
-    library: Library,
-    hits: List[Backtrack],
-    reverse_in=None,
-    strand_in=None,
-    guide_idx=None,
-    dual=False,
-) -> Tuple[List[pysam.AlignedSegment], bool]:
+def _mapped_template(
+    ref_ids, library: Library, hits: List[Backtrack], reverse_in=None, strand_in=None, guide_idx=None, dual=False
+) -> Tuple[List[Tuple[bool, List[Tuple[str, str]], bool, int, int, str]], int, bool]:
+    """
+    The parts of to_mapped_reads() that only depend on the hits, one entry per record:
+    (reverse, tags, is_secondary, reference_id, reference_start, cigarstring)
+    """
     mapq = 60
     if len(hits) > 1:
         mapq = 0
@@ -294,7 +367,7 @@ def to_mapped_reads(
         this_sa_set = sm_from_guide_hit(library, hit, strand, mapq)
         sa_set = sa_set | this_sa_set  # merge 2 dicts requires >=3.9
     is_secondary = False
-    alignments = []
+    records = []
     sa_set_len = len(sa_set)
     for hit in hits:
         ref_names = library.sgrna_ids_by_seq(hit.sm.target)
@@ -317,24 +390,176 @@ def to_mapped_reads(
             if reverse_in is None:
                 reverse = hit.sm.reversed
 
-            a = to_alignment(seqread, reverse, local_tags)
-            # complete mapped info
-            a.is_secondary = is_secondary
-            a.reference_id = ref_ids[ref_name]
-            a.reference_start = hit.t_pos - 1  # zero based
-            a.cigarstring = hit.cigar
-            a.mapping_quality = mapq
-            alignments.append(a)
+            records.append((reverse, local_tags, is_secondary, ref_ids[ref_name], hit.t_pos - 1, hit.cigar))
             if dual:
                 break
             is_secondary = True
         if dual:
             break
-    return (alignments, sa_set_len > 1)
+    return (records, mapq, sa_set_len > 1)
+
+
+def to_mapped_reads(
+    seqread,
+    ref_ids,
+    library: Library,
+    hits: List[Backtrack],
+    reverse_in=None,
+    strand_in=None,
+    guide_idx=None,
+    dual=False,
+    templates: Dict = None,
+) -> Tuple[List[pysam.AlignedSegment], bool]:
+    """
+    templates is an optional dict caching _mapped_template() by the identity of hits (and guide_idx), it must only be
+    shared between calls using the same reverse_in, strand_in and dual.  Bounded by TEMPLATE_CACHE_SIZE.
+    """
+    if templates is None:
+        (records, mapq, multi) = _mapped_template(ref_ids, library, hits, reverse_in, strand_in, guide_idx, dual)
+    else:
+        key = (id(hits), None if guide_idx is None else tuple(guide_idx))
+        if key in templates:
+            (_, records, mapq, multi) = templates[key]
+        else:
+            (records, mapq, multi) = _mapped_template(ref_ids, library, hits, reverse_in, strand_in, guide_idx, dual)
+            if len(templates) >= TEMPLATE_CACHE_SIZE:
+                # drop the oldest entry
+                del templates[next(iter(templates))]
+            # holding hits ensures the id is not reused while cached
+            templates[key] = (hits, records, mapq, multi)
+    alignments = []
+    for (reverse, tags, is_secondary, reference_id, reference_start, cigarstring) in records:
+        a = to_alignment(seqread, reverse, list(tags))
+        # complete mapped info
+        a.is_secondary = is_secondary
+        a.reference_id = reference_id
+        a.reference_start = reference_start  # zero based
+        a.cigarstring = cigarstring
+        a.mapping_quality = mapq
+        alignments.append(a)
+    return (alignments, multi)
+
+
+def _read_alignments(
+    seqread: Seqread, aligned_results, to_key, library, ref_ids, reverse, strand, allow_missing, templates
+) -> Tuple[List[pysam.AlignedSegment], bool]:
+    """
+    Alignment records for a read, missing is True when the read is not in aligned_results (excluded by length)
+    """
+    # * Pair the sequence to the mapped records
+    key = to_key(seqread.sequence)
+    if key not in aligned_results:
+        if allow_missing:
+            return ([to_alignment(seqread, False, [], unmapped=True)], True)
+        raise ValueError("Source read not found in aligned data, has input been modified during execution?")
+    (hit_type, hits) = aligned_results[key]
+
+    if hit_type in ("unique", "multimap"):
+        (a_lst, _) = to_mapped_reads(seqread, ref_ids, library, hits, reverse, strand_in=strand, templates=templates)
+        return (a_lst, False)
+    return ([to_alignment(seqread, reverse, [], unmapped=True)], False)
+
+
+def _check_skipped(skipped_reads, skipped):
+    if skipped is not None and skipped_reads > skipped:
+        raise ValueError(
+            "Source read not found in aligned data and number of reads skipped due to length has beed exceeded. Has input been modified during execution?"
+        )
+
+
+def _init_shard_worker(shard_prefix, header, guide_fa, hts_opts, barrier, worker_args):
+    global _SHARD_ARGS
+    writer = BucketWriter(f"{shard_prefix}_{os.getpid()}", header, guide_fa, hts_opts=hts_opts)
+    _SHARD_ARGS = (writer, barrier, worker_args)
+
+
+def _run_shard(shard_fn, first_order: int, chunk: list):
+    (writer, _, worker_args) = _SHARD_ARGS
+    return shard_fn(writer, first_order, chunk, *worker_args)
+
+
+def _close_shard_worker() -> str:
+    (writer, barrier, _) = _SHARD_ARGS
+    writer.close()
+    # holds this worker until every worker has taken a close task, so each closes exactly once
+    barrier.wait()
+    return writer.prefix
+
+
+def sharded_writes(
+    shard_prefix, header, guide_fa, cpus, chunks: Iterator[list], shard_fn, worker_args, reduce_fn, hts_opts=None
+) -> List[BucketWriter]:
+    """
+    Chunks are converted to alignments by worker processes calling shard_fn(writer, first_order, chunk, *worker_args),
+    first_order being the input ordinal of the first item in the chunk.  Each worker keeps one BucketWriter for the
+    whole run, records are written with their input ordinal so buckets_to_cram() restores the input order.  The
+    results of shard_fn are given to reduce_fn in input order.
+
+    Requires the fork start method, worker_args (e.g. aligned_results) are inherited by the workers rather than
+    pickled to each of them.
+    """
+    ctx = mp.get_context("fork")
+    barrier = ctx.Barrier(cpus)
+    (pending, first_order) = (deque(), 0)
+    initargs = (shard_prefix, header, guide_fa, hts_opts, barrier, worker_args)
+    with ctx.Pool(cpus, initializer=_init_shard_worker, initargs=initargs) as pool:
+        for chunk in chunks:
+            pending.append(pool.apply_async(_run_shard, (shard_fn, first_order, chunk)))
+            first_order += len(chunk)
+            # bound the number of chunks held in memory
+            while len(pending) > cpus * 2:
+                reduce_fn(pending.popleft().get())
+        while pending:
+            reduce_fn(pending.popleft().get())
+        closing = [pool.apply_async(_close_shard_worker) for _ in range(0, cpus)]
+        prefixes = sorted([result.get() for result in closing])
+    return [BucketWriter(prefix, header, guide_fa, hts_opts=hts_opts) for prefix in prefixes]
+
+
+def _write_shard(af: BucketWriter, first_order: int, seqreads: List[Seqread], read_args) -> int:
+    """
+    Writes the records for a chunk of reads, returns the number of reads not found in aligned_results
+    """
+    missing_reads = 0
+    for (order, seqread) in enumerate(seqreads, start=first_order):
+        (alignments, missing) = _read_alignments(seqread, *read_args)
+        missing_reads += missing
+        for a in alignments:
+            af.write(a, order=order)
+    return missing_reads
+
+
+def _write_sharded(
+    bucket_dir, header, guide_fa, cpus, seqreads: Iterator[Seqread], read_args, skipped, hts_opts=None
+) -> List[BucketWriter]:
+    """
+    Chunks of reads are converted to alignments by worker processes, see sharded_writes().
+    """
+    skipped_reads = 0
+
+    def _reduce(missing_reads):
+        nonlocal skipped_reads
+        skipped_reads += missing_reads
+        _check_skipped(skipped_reads, skipped)
+
+    chunks = iter(lambda: list(islice(seqreads, SHARD_READS)), [])
+    writers = sharded_writes(
+        os.path.join(bucket_dir, "worker"),
+        header,
+        guide_fa,
+        cpus,
+        chunks,
+        _write_shard,
+        (read_args,),
+        _reduce,
+        hts_opts=hts_opts,
+    )
+    logging.debug(f"Alignments written by {len(writers)} workers")
+    return writers
 
 
 def write_alignments(
-    align_file,
+    bucket_dir,
     header,
     guide_fa,
     cpus,
@@ -349,48 +574,101 @@ def write_alignments(
     strand,
     default_rgid,
     skipped=None,
+    packed=False,
+    strict_headers=False,
+    read_meta=None,
+    hts_opts: HtsOptions = None,
 ):
     """
-    own function to allow try due to incorrect qual threshold use
+    qual_offset overrides the offset implied by each FastQ header, see Stats.phred_offset.
+    When read_meta is set the reads are taken from the file written by parse_reads(), seq_file is not decoded again.
+
+    Alignments are written to bucket files under bucket_dir, returns the writers in input order for buckets_to_cram().
+    When cpus > 1 the records are built and written by worker processes, see _write_sharded().
     """
-    with pysam.AlignmentFile(align_file, "wb", header=header, reference_filename=guide_fa, threads=cpus) as af:
-        # get the common-iterator
-        iter = read_iter(
-            seq_file,
-            reverse,
-            exclude_qcfail,
-            reference,
-            offset=qual_offset,
-            default_rgid=default_rgid,
-        )
+    os.makedirs(bucket_dir, exist_ok=True)
+    to_key = key_function(packed)
+    # templates are per process, workers inherit an empty dict
+    read_args = (aligned_results, to_key, library, ref_ids, reverse, strand, skipped is not None, {})
+    # get the common-iterator
+    iter = read_iter(
+        seq_file,
+        reverse,
+        exclude_qcfail,
+        reference,
+        offset=qual_offset,
+        default_rgid=default_rgid,
+        cpus=cpus,
+        strict_headers=strict_headers,
+        read_meta=read_meta,
+    )
+    if cpus > 1:
+        return _write_sharded(bucket_dir, header, guide_fa, cpus, iter, read_args, skipped, hts_opts=hts_opts)
+
+    with BucketWriter(os.path.join(bucket_dir, "serial"), header, guide_fa, hts_opts=hts_opts) as af:
         skipped_reads = 0
         for seqread in iter:
-            # * Pair the sequence to the mapped records
-            if seqread.sequence not in aligned_results:
-                if skipped is not None:
-                    skipped_reads += 1
-                    if skipped_reads > skipped:
-                        raise ValueError(
-                            "Source read not found in aligned data and number of reads skipped due to length has beed exceeded. Has input been modified during execution?"
-                        )
-                    a = to_alignment(seqread, False, [], unmapped=True)
-                    af.write(a)
-                    continue
+            (alignments, missing) = _read_alignments(seqread, *read_args)
+            if missing:
+                skipped_reads += 1
+                _check_skipped(skipped_reads, skipped)
+            for a in alignments:
+                af.write(a)
+    return [af]
+
 
-                raise ValueError("Source read not found in aligned data, has input been modified during execution?")
-            (hit_type, hits) = aligned_results[seqread.sequence]
+def collapsed_seqread(key: str, sequence: str, default_rgid, member=None) -> Seqread:
+    """
+    Stand-in read for a collapsed alignment, the qname is a digest of key (the read sequence or pair) so is stable
+    between samples.  Reads are only merged by sequence so a read group is only applied if there is a single one.
+    """
+    return Seqread(
+        qname=hashlib.md5(key.encode("utf-8")).hexdigest(),
+        sequence=sequence,
+        member=member,
+        qual=None,
+        rgid=default_rgid,
+    )
 
-            # add the basics to the alignment
 
-            a = None
-            if hit_type in ("unique", "multimap"):
-                (a_lst, _) = to_mapped_reads(seqread, ref_ids, library, hits, reverse, strand_in=strand)
-                for a in a_lst:
-                    af.write(a)
-            elif hit_type == "unmapped":
-                a = to_alignment(seqread, reverse, [], unmapped=True)
+def collapsed_to_hts(
+    library: Library,
+    aligned_results: Dict[str, Tuple[str, List[Backtrack]]],
+    query_dict,
+    seq_file: str,
+    workspace: str,
+    stats: Stats,
+    output: str,
+    cpus: int,
+    packed: bool = False,
+    hts_opts: HtsOptions = None,
+):
+    """
+    Alternative to reads_to_hts(), writes one alignment set per unique read sequence with the number of reads in
+    COUNT_TAG.  Built from the counts collected in the first pass, the reads are not parsed again.
+    """
+    to_key = key_function(packed)
+    hts_opts = hts_opts or HtsOptions()
+    # * generate the fasta for the guides in workspace
+    (guide_fa, header, ref_ids, default_rgid) = guide_header(workspace, library, stats, seq_file)
+
+    bucket_dir = os.path.join(workspace, "align_buckets")
+    os.makedirs(bucket_dir, exist_ok=True)
+    logging.info(f"Writing collapsed alignment buckets: {bucket_dir} (intermediate)")
+    templates = {}
+    with BucketWriter(os.path.join(bucket_dir, "collapsed"), header, guide_fa, hts_opts=hts_opts) as af:
+        for (sequence, count) in sorted_counts(query_dict):
+            seqread = collapsed_seqread(sequence, sequence, default_rgid)
+            (alignments, _) = _read_alignments(
+                seqread, aligned_results, to_key, library, ref_ids, False, "+", True, templates
+            )
+            for a in alignments:
+                a.set_tag(COUNT_TAG, count)
                 af.write(a)
 
+    buckets_to_cram([af], header, guide_fa, output, cpus=cpus, hts_opts=hts_opts)
+    shutil.rmtree(bucket_dir)
+
 
 def reads_to_hts(
     library: Library,
@@ -404,63 +682,46 @@ def reads_to_hts(
     reverse: bool = False,
     exclude_qcfail: bool = False,
     reference: str = None,
+    packed: bool = False,
+    strict_headers: bool = False,
+    read_meta: str = None,
+    hts_opts: HtsOptions = None,
 ):
-    if qual_offset:
-        qual_offset = int(qual_offset)
+    # detected while parsing unless provided
+    qual_offset = int(qual_offset) if qual_offset else stats.phred_offset
+    hts_opts = hts_opts or HtsOptions()
     strand = "-" if reverse else "+"
     # * generate the fasta for the guides in workspace
     (guide_fa, header, ref_ids, default_rgid) = guide_header(workspace, library, stats, seq_file)
 
-    # * Create an AlignmentFile with relevant "sequences"
-    align_file = os.path.join(workspace, "temp.bam")
-
-    logging.info(f"Writing alignment file: {align_file} (intermediate)")
-
-    sam_threads = cpus if cpus < 4 else 4
-
-    try:
-        write_alignments(
-            align_file,
-            header,
-            guide_fa,
-            sam_threads,
-            seq_file,
-            reverse,
-            exclude_qcfail,
-            reference,
-            qual_offset,
-            aligned_results,
-            library,
-            ref_ids,
-            strand,
-            default_rgid,
-            skipped=stats.length_excluded_reads,
-        )
-    except OverflowError as e:
-        seq_extn = os.path.splitext(seq_file)[1].lower
-        if str(e) != "unsigned byte integer is less than minimum" and seq_extn in (
-            ".sam",
-            ".bam",
-            ".cram",
-        ):
-            raise e
-        logging.error("FASTQ: phred offset not deduced correctly from readname, attempting to handle internally")
-        write_alignments(
-            align_file,
-            header,
-            guide_fa,
-            sam_threads,
-            seq_file,
-            reverse,
-            exclude_qcfail,
-            reference,
-            33,
-            aligned_results,
-            library,
-            ref_ids,
-            strand,
-            default_rgid,
-            skipped=stats.length_excluded_reads,
-        )
-
-    hts_sort_n_index(align_file, guide_fa, output, workspace, cpus=sam_threads)
+    # * Write the alignments bucketed by reference
+    bucket_dir = os.path.join(workspace, "align_buckets")
+
+    logging.info(f"Writing alignment buckets: {bucket_dir} (intermediate)")
+
+    writers = write_alignments(
+        bucket_dir,
+        header,
+        guide_fa,
+        cpus,
+        seq_file,
+        reverse,
+        exclude_qcfail,
+        reference,
+        qual_offset,
+        aligned_results,
+        library,
+        ref_ids,
+        strand,
+        default_rgid,
+        skipped=stats.length_excluded_reads,
+        packed=packed,
+        strict_headers=strict_headers,
+        read_meta=read_meta,
+        hts_opts=hts_opts,
+    )
+
+    buckets_to_cram(writers, header, guide_fa, output, cpus=cpus, hts_opts=hts_opts)
+    shutil.rmtree(bucket_dir)
+    if read_meta:
+        os.remove(read_meta)
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+"""
+Compact keys for read sequence lookups.
+
+ACGT sequences are held as an int of 2 bits per base with a leading 1 to retain the length, any sequence including
+other characters (e.g. N) is kept as the original str.  Both types can be held in the same dict without collision.
+"""
+from typing import Union
+
+BASES = "ACGT"
+PACK_TABLE = str.maketrans(BASES, "0123")
+# each hex digit of the packed int is 2 bases
+UNPACK_TABLE = str.maketrans({f"{i:x}": BASES[i >> 2] + BASES[i & 3] for i in range(0, 16)})
+
+SeqKey = Union[int, str]
+
+
+def pack(seq: str) -> SeqKey:
+    try:
+        return int("1" + seq.translate(PACK_TABLE), 4)
+    except ValueError:
+        return seq
+
+
+def unpack(key: SeqKey) -> str:
+    if isinstance(key, str):
+        return key
+    hexed = format(key, "x")
+    lead = int(hexed[0], 16)
+    # odd length sequences share the leading hex digit with the length marker
+    head = "" if lead == 1 else BASES[lead & 3]
+    return head + hexed[1:].translate(UNPACK_TABLE)
+
+
+def no_pack(seq: str) -> SeqKey:
+    return seq
+
+
+def key_function(packed: bool):
+    return pack if packed else no_pack
@@ -27,6 +27,7 @@
 # statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
 # identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
 # 2009, 2010, 2011, 2012’.
+import os
 import shutil
 
 from pycroquet import cli
@@ -34,6 +35,8 @@ from pycroquet import countwriter
 from pycroquet import libparser
 from pycroquet import main
 from pycroquet import readwriter
+from pycroquet import singlepass
+from pycroquet.classes import HtsOptions
 
 
 def run(
@@ -53,30 +56,89 @@ def run(
     no_alignment,
     boundary_mode,
     loglevel,
+    pack_seqs=False,
+    max_memory=None,
+    strict_headers=False,
+    collapse_alignments=False,
+    single_pass=False,
+    cache_reads=False,
+    output_format="cram",
+    compression=None,
+    cram_profile=None,
+    bucket_compression=1,
+    write_threads=0,
+    unmapped="keep",
+    mismatch_index=False,
 ):
     (usable_cpu, work_tmp, workspace, boundary_mode) = cli.common_setup(
         loglevel, cpus, workspace, output, boundary_mode
     )
+    hts_opts = HtsOptions(output_format, compression, cram_profile, bucket_compression, write_threads, unmapped)
 
     library = libparser.load(guidelib)
     reverse = False
-    (_, guide_results, aligned_results, stats) = main.process_reads(
-        library,
-        queries,
-        workspace,
-        rules,
-        minscore,
-        usable_cpu,
-        chunks,
-        sample=sample,
-        reference=reference,
-        exclude_qcfail=excludeqcf,
-        reverse=reverse,
-        boundary_mode=boundary_mode,
-    )
+    read_meta = None
+    if cache_reads and no_alignment is False and not (collapse_alignments or single_pass):
+        # reads kept while parsing are used for the alignment pass
+        read_meta = os.path.join(workspace, "read_meta.bin")
+    if single_pass and no_alignment is False and not collapse_alignments:
+        # alignments are written while mapping
+        (query_dict, guide_results, aligned_results, stats) = singlepass.process_reads(
+            library,
+            queries,
+            workspace,
+            rules,
+            minscore,
+            usable_cpu,
+            chunks,
+            output,
+            sample=sample,
+            reference=reference,
+            exclude_qcfail=excludeqcf,
+            boundary_mode=boundary_mode,
+            qual_offset=qual_offset,
+            packed=pack_seqs,
+            strict_headers=strict_headers,
+            mismatch_index=mismatch_index,
+            hts_opts=hts_opts,
+        )
+    else:
+        (query_dict, guide_results, aligned_results, stats) = main.process_reads(
+            library,
+            queries,
+            workspace,
+            rules,
+            minscore,
+            usable_cpu,
+            chunks,
+            sample=sample,
+            reference=reference,
+            exclude_qcfail=excludeqcf,
+            reverse=reverse,
+            boundary_mode=boundary_mode,
+            packed=pack_seqs,
+            max_memory=max_memory,
+            strict_headers=strict_headers,
+            mismatch_index=mismatch_index,
+            meta_file=read_meta,
+            keep_alignments=no_alignment is False,
+        )
 
     countwriter.guide_counts_single(library, guide_results, output, stats, low_count)
-    if no_alignment is False:
+    if no_alignment is False and collapse_alignments:
+        readwriter.collapsed_to_hts(
+            library,
+            aligned_results,
+            query_dict,
+            queries,
+            workspace,
+            stats,
+            output,
+            usable_cpu,
+            packed=pack_seqs,
+            hts_opts=hts_opts,
+        )
+    elif no_alignment is False and not single_pass:
         readwriter.reads_to_hts(
             library,
             aligned_results,
@@ -89,6 +151,10 @@ def run(
             exclude_qcfail=excludeqcf,
             reference=reference,
             reverse=reverse,
+            packed=pack_seqs,
+            strict_headers=strict_headers,
+            read_meta=read_meta,
+            hts_opts=hts_opts,
         )
 
     # TODO: write everything out and then if mapped count is a very low fraction repeat.  If the revcomp result is a higher
@@ -0,0 +1,321 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+import logging
+import multiprocessing as mp
+import os
+import shutil
+from collections import deque
+from time import time
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from pygas.alignercpu import AlignerCpu
+from pygas.classes import AlignmentBatch
+from pygas.classes import Backtrack
+
+from pycroquet import mismatch
+from pycroquet import readparser
+from pycroquet.classes import HtsOptions
+from pycroquet.classes import Library
+from pycroquet.classes import Stats
+from pycroquet.htscomm import buckets_to_cram
+from pycroquet.htscomm import BucketWriter
+from pycroquet.main import exact_fast_path
+from pycroquet.main import select_alignments
+from pycroquet.readwriter import _read_alignments
+from pycroquet.readwriter import guide_header
+from pycroquet.readwriter import read_iter
+from pycroquet.seqpack import key_function
+
+# reads held while waiting for their sequence to be mapped, output is written in input order
+REORDER_READS = 100000
+
+# set once per worker process by _init_worker
+_WORKER_RESOLVER = None
+
+
+class Resolver:
+    """
+    Maps a batch of new query sequences as map_reads() would: exact lookup, then the mismatch index when enabled and
+    usable or the aligner.
+    """
+
+    def __init__(self, aligner: AlignerCpu, mismatch_index: bool = False):
+        self.aligner = aligner
+        self.mm_index = None
+        if mismatch_index and mismatch.usable(aligner):
+            self.mm_index = mismatch.MismatchIndex(aligner.targets, aligner.max_penalty)
+
+    def __call__(self, query_seqs: List[str]) -> List[AlignmentBatch]:
+        (exact_batch, query_seqs) = exact_fast_path(self.aligner, query_seqs)
+        if not query_seqs:
+            return [exact_batch]
+        if self.mm_index is not None:
+            return [exact_batch, self.mm_index.map_queries(self.aligner, query_seqs)]
+        return [exact_batch, self.aligner.align_queries(query_seqs, keep_matrix=False)]
+
+
+def _init_worker(aligner: AlignerCpu, mismatch_index: bool):
+    global _WORKER_RESOLVER
+    _WORKER_RESOLVER = Resolver(aligner, mismatch_index)
+
+
+def _resolve(query_seqs: List[str]) -> List[AlignmentBatch]:
+    return _WORKER_RESOLVER(query_seqs)
+
+
+def _single_pass(
+    seq_file: str,
+    bucket_stub: str,
+    header,
+    guide_fa: str,
+    aligner: AlignerCpu,
+    resolver,
+    pool,
+    to_key,
+    library: Library,
+    ref_ids,
+    aligned_results: Dict,
+    read_chunk: int,
+    read_args: Dict,
+    exclude_by_len,
+    hts_opts: HtsOptions,
+) -> Tuple[Dict[str, int], BucketWriter, int, int, int]:
+    """
+    One pass over the input writing to the alignment buckets, see process_reads().  Sequences already in
+    aligned_results are not mapped again.
+
+    Returns (query_dict, writer, total, length excluded, vendor failed)
+    """
+    query_dict = {}
+    templates = {}
+    # (seqread, key) in input order, key is None for reads excluded by length
+    pending = deque()
+    # batches submitted for mapping, in order
+    in_flight = deque()
+    batch = []
+    (total, len_ex, vendor_failed) = (0, 0, 0)
+
+    def submit():
+        if pool is None:
+            in_flight.append(resolver(batch))
+        else:
+            in_flight.append(pool.apply_async(_resolve, (list(batch),)))
+        batch.clear()
+
+    def collect(block: bool):
+        while in_flight and (pool is None or block or in_flight[0].ready()):
+            batches = in_flight.popleft()
+            if pool is not None:
+                batches = batches.get()
+            for (original_seq, hit_type, best_bt) in select_alignments(batches, aligner.rules):
+                aligned_results[to_key(original_seq)] = (hit_type, best_bt)
+            # only wait for the oldest
+            block = False
+
+    def emit(af: BucketWriter):
+        while pending and (pending[0][1] is None or pending[0][1] in aligned_results):
+            (seqread, _) = pending.popleft()
+            (alignments, _) = _read_alignments(
+                seqread, aligned_results, to_key, library, ref_ids, False, "+", True, templates
+            )
+            for a in alignments:
+                af.write(a)
+
+    with BucketWriter(bucket_stub, header, guide_fa, hts_opts=hts_opts) as af:
+        for seqread in read_iter(seq_file, **read_args):
+            if seqread.qc_fail:
+                # only count them if we keep them
+                vendor_failed += 1
+            if exclude_by_len and len(seqread.sequence) < exclude_by_len:
+                len_ex += 1
+                pending.append((seqread, None))
+            else:
+                total += 1
+                key = to_key(seqread.sequence)
+                if key in query_dict:
+                    query_dict[key] += 1
+                else:
+                    query_dict[key] = 1
+                    if key not in aligned_results:
+                        batch.append(seqread.sequence)
+                pending.append((seqread, key))
+            if len(batch) >= read_chunk:
+                submit()
+            collect(False)
+            emit(af)
+            while len(pending) > REORDER_READS:
+                if batch:
+                    submit()
+                collect(True)
+                emit(af)
+        if batch:
+            submit()
+        while in_flight:
+            collect(True)
+        emit(af)
+    if pending:
+        raise ValueError("Reads remain unresolved after all sequences were mapped")
+    return (query_dict, af, total, len_ex, vendor_failed)
+
+
+def process_reads(
+    library: Library,
+    seq_file: str,
+    workspace: str,
+    rules: List[str],
+    minscore: int,
+    cpus: int,
+    read_chunk: int,
+    output: str,
+    sample=None,
+    reference=None,
+    exclude_qcfail=False,
+    exclude_by_len=None,
+    boundary_mode=3,
+    qual_offset=None,
+    packed=False,
+    strict_headers=False,
+    hts_opts: HtsOptions = None,
+    mismatch_index=False,
+) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, Tuple[str, List[Backtrack]]], Stats]:
+    """
+    Alternative to main.process_reads() followed by readwriter.reads_to_hts() reading the input once.
+
+    Sequences are mapped in batches of read_chunk when first seen and reads are written to the alignment buckets in
+    input order as soon as their sequence is resolved.  At most REORDER_READS are held waiting, beyond that the
+    partial batch is sent and the oldest batch waited for.  Output is identical to the two pass route.
+
+    For fastq without qual_offset the phred offset is decided from the first records (see readparser.input_stats()).
+    If that gives phred+64 and a later quality is below it the buckets are discarded and the input is read again from
+    the start as phred+33, sequences already mapped are kept.
+    """
+    start = time()
+    hts_opts = hts_opts or HtsOptions()
+    stats = readparser.input_stats(seq_file, sample=sample, reference=reference)
+    retry_offset = None
+    if qual_offset:
+        qual_offset = int(qual_offset)
+    else:
+        qual_offset = stats.phred_offset
+        if qual_offset == readparser.OFFSET_ILLUMINA:
+            retry_offset = readparser.OFFSET_CASAVA
+    aligner = AlignerCpu(
+        targets=library.targets,
+        rules=rules,
+        score_min=minscore,
+        rev_comp=False,
+        match_type=boundary_mode,
+    )
+    to_key = key_function(packed)
+    (guide_fa, header, ref_ids, default_rgid) = guide_header(workspace, library, stats, seq_file)
+    bucket_dir = os.path.join(workspace, "align_buckets")
+    os.makedirs(bucket_dir, exist_ok=True)
+    bucket_stub = os.path.join(bucket_dir, "single_pass")
+    read_args = {
+        "exclude_qcfail": exclude_qcfail,
+        "reference": reference,
+        "offset": qual_offset,
+        "default_rgid": default_rgid,
+        "cpus": cpus,
+        "strict_headers": strict_headers,
+    }
+    aligned_results = {}
+
+    pool = None
+    resolver = None
+    if cpus > 1:
+        pool = mp.Pool(cpus, initializer=_init_worker, initargs=(aligner, mismatch_index))
+    else:
+        resolver = Resolver(aligner, mismatch_index)
+
+    def read_pass():
+        return _single_pass(
+            seq_file,
+            bucket_stub,
+            header,
+            guide_fa,
+            aligner,
+            resolver,
+            pool,
+            to_key,
+            library,
+            ref_ids,
+            aligned_results,
+            read_chunk,
+            read_args,
+            exclude_by_len,
+            hts_opts,
+        )
+
+    try:
+        try:
+            (query_dict, af, total, len_ex, vendor_failed) = read_pass()
+        except ValueError as err:
+            if retry_offset is None or "Quality below phred offset" not in str(err):
+                raise
+            logging.warning(f"{err}, re-reading {seq_file} from the start as phred+{retry_offset}")
+            shutil.rmtree(bucket_dir)
+            os.makedirs(bucket_dir)
+            read_args["offset"] = retry_offset
+            stats.phred_offset = retry_offset
+            (query_dict, af, total, len_ex, vendor_failed) = read_pass()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    stats.vendor_failed_reads = vendor_failed
+    stats.total_reads = total
+    if exclude_by_len:
+        stats.length_excluded_reads = len_ex
+    logging.info(f"Parsed {total} reads, {len(query_dict)} were unique...")
+
+    guide_results = {}
+    (mapped, multimap, unmapped) = (0, 0, 0)
+    for key, (hit_type, best_bt) in aligned_results.items():
+        if hit_type == "unmapped":
+            unmapped += query_dict[key]
+        elif hit_type == "multimap":
+            multimap += query_dict[key]
+        else:
+            target = best_bt[0].sm.target
+            guide_results[target] = guide_results.get(target, 0) + query_dict[key]
+            mapped += query_dict[key]
+    logging.info(f"Mapped: {mapped}, Multimap: {multimap} , Unmapped: {unmapped}")
+    stats.mapped_to_guide_reads = mapped
+    stats.multimap_reads = multimap
+    stats.unmapped_reads = unmapped
+    stats.total_guides = len(library.guides)
+    logging.info(f"Single pass mapping took: {int(time() - start)}s")
+
+    buckets_to_cram([af], header, guide_fa, output, cpus=cpus, hts_opts=hts_opts)
+    shutil.rmtree(bucket_dir)
+    return (query_dict, guide_results, aligned_results, stats)
@@ -27,9 +27,6 @@
 # statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
 # identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
 # 2009, 2010, 2011, 2012’.
-import gzip
-import os
-import pickle
 import tempfile
 
 
@@ -39,20 +36,6 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
-def pickle_this(outdir: str, identifier: str, data):
-    filename = os.path.join(outdir, identifier + ".pickled.gz")
-    with gzip.open(filename, "wb", compresslevel=6) as cpfh:
-        pickle.dump(data, cpfh)
-    return filename
-
-
-def unpickle(filename: str):
-    data = None
-    with gzip.open(filename, "rb") as cpfh:
-        data = pickle.load(cpfh)
-    return data
-
-
 def boundary_mode(mode: str) -> int:
     mode = mode.lower()
     if mode == "exact":
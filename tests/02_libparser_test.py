@@ -292,3 +292,15 @@ def test_10_libparser_parse_data_rows_badseq(file, error):
 )
 def test_20_libparser_load(file, info):
     assert type(libparser.load(os.path.join(DATA_DIR, file))) is Library, info
+
+
+def test_21_libparser_target_index():
+    library = libparser.load(os.path.join(DATA_DIR, "cli", "input", "dual_lib.tsv.gz"))
+    assert [library.target_ids[t] for t in library.targets] == list(range(0, len(library.targets)))
+    for (g_idx, guide) in enumerate(library.guides):
+        (seq_l, seq_r) = guide.sgrna_seqs
+        t_ids = (library.target_ids[seq_l], library.target_ids[seq_r])
+        assert g_idx in library.guide_by_target_ids(*t_ids)
+        assert library.guide_by_sgrna_set(seq_l, seq_r) == library.guide_by_target_ids(*t_ids)
+        assert library.target_guides(seq_l) == frozenset(library.target_to_guides[seq_l])
+    assert library.guide_by_sgrna_set("ACGT", library.targets[0]) is None
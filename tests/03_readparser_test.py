@@ -109,7 +109,7 @@ def test_03_readparser_parse_fq_header():
             "fastq/unique.fq",
             (
                 3,
-                Stats(total_reads=3, sample_name="bob"),
+                Stats(total_reads=3, sample_name="bob", phred_offset=64),
                 {
                     "TTCACCGAGCTTCCGGGAG": 1,
                     "TTCANCGAGCTTCCGGGAG": 1,
@@ -123,7 +123,7 @@ def test_03_readparser_parse_fq_header():
             "fastq/non-unique.fq",
             (
                 3,
-                Stats(total_reads=4, sample_name="bob"),
+                Stats(total_reads=4, sample_name="bob", phred_offset=64),
                 {
                     "TTCACCGAGCTTCCGGGAG": 2,
                     "TTCANCGAGCTTCCGGGAG": 1,
@@ -136,7 +136,7 @@ def test_03_readparser_parse_fq_header():
     ],
 )
 def test_04_readparser_parse_fastq(file, result, info):
-    assert readparser.parse_fastq(open(os.path.join(DATA_DIR, file)), "bob") == result, info
+    assert readparser.parse_fastq(open(os.path.join(DATA_DIR, file), "rb"), "bob") == result, info
 
 
 @pytest.mark.parametrize(
@@ -174,7 +174,7 @@ def test_06_readparser_hts_multi_sample():
             False,
             (
                 3,
-                Stats(total_reads=3, sample_name="bob"),
+                Stats(total_reads=3, sample_name="bob", phred_offset=64),
                 {
                     "TTCACCGAGCTTCCGGGAG": 1,
                     "TTCANCGAGCTTCCGGGAG": 1,
@@ -189,7 +189,7 @@ def test_06_readparser_hts_multi_sample():
             False,
             (
                 3,
-                Stats(total_reads=3, sample_name="bob"),
+                Stats(total_reads=3, sample_name="bob", phred_offset=64),
                 {
                     "TTCACCGAGCTTCCGGGAG": 1,
                     "TTCANCGAGCTTCCGGGAG": 1,
@@ -318,13 +318,13 @@ def test_10_readparser_parse_reads(file, exclude_qcf, result, info):
         (
             "@HISEQ2500-01:110:H7AGVADXX:1:1101:10737:10436 1:N:0:GACGACGT\nACGT\n+\nMMMM\n",
             False,
-            (1, Stats(total_reads=1, sample_name="bob"), {"ACGT": 1}, None),
+            (1, Stats(total_reads=1, sample_name="bob", phred_offset=33), {"ACGT": 1}, None),
             "Good read, (qc keep)",
         ),
         (
             "@HISEQ2500-01:110:H7AGVADXX:1:1101:10737:10436 1:N:0:GACGACGT\nACGT\n+\nMMMM\n",
             True,
-            (1, Stats(total_reads=1, sample_name="bob"), {"ACGT": 1}, None),
+            (1, Stats(total_reads=1, sample_name="bob", phred_offset=33), {"ACGT": 1}, None),
             "Good read, (qc discard)",
         ),
         (
@@ -332,7 +332,7 @@ def test_10_readparser_parse_reads(file, exclude_qcf, result, info):
             False,
             (
                 1,
-                Stats(total_reads=1, vendor_failed_reads=1, sample_name="bob"),
+                Stats(total_reads=1, vendor_failed_reads=1, sample_name="bob", phred_offset=33),
                 {"ACGT": 1},
                 None,
             ),
@@ -341,10 +341,235 @@ def test_10_readparser_parse_reads(file, exclude_qcf, result, info):
         (
             "@HISEQ2500-01:110:H7AGVADXX:1:1101:10737:10436 1:Y:0:GACGACGT\nACGT\n+\nMMMM\n",
             True,
-            (0, Stats(total_reads=0, sample_name="bob"), {}, None),
+            (0, Stats(total_reads=0, sample_name="bob", phred_offset=33), {}, None),
             "Bad read, discard",
         ),
     ],
 )
 def test_11_readparser_qcreads(str_file, exclude_qcf, result, info):
-    assert readparser.parse_fastq(io.StringIO(str_file), "bob", exclude_qcfail=exclude_qcf) == result, info
+    assert readparser.parse_fastq(io.BytesIO(str_file.encode()), "bob", exclude_qcfail=exclude_qcf) == result, info
+
+
+@pytest.mark.parametrize("file", ["fastq/non-unique.fq", "htsfile/non-unique.sam"])
+@pytest.mark.parametrize("packed", [False, True])
+def test_12_readparser_spill(tmp_path, monkeypatch, file, packed):
+    (unique, _, reads, _) = readparser.parse_reads(os.path.join(DATA_DIR, file), "bob", 1)
+    # force a dump on every new sequence
+    monkeypatch.setattr(readparser, "DICT_ENTRY_BYTES", 1024 * 1024)
+    (s_unique, _, s_reads, _) = readparser.parse_reads(
+        os.path.join(DATA_DIR, file), "bob", 1, packed=packed, workspace=str(tmp_path), max_memory=1
+    )
+    assert isinstance(s_reads, readparser.SpilledReads)
+    assert s_unique == unique == len(s_reads)
+    merged = {}
+    for part in readparser.partitions(s_reads):
+        assert not set(merged).intersection(part)
+        merged.update(part)
+    assert len(merged) == unique
+    assert list(readparser.sorted_counts(s_reads)) == list(readparser.sorted_counts(reads))
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "@HISEQ2500-01:110:H7AGVADXX:1:1101:10737:10436 1:N:0:GACGACGT",
+        "@HISEQ2500-01:110:H7AGVADXX:1:1101:10737:10436 1:Y:0:GACGACGT",
+        "@A00471:89:HMTWVDMXX:1:1101:2871:1016 2:N:0:TTGGACGT+AGCACTTC",
+        "@HS27_17643:2:2110:8108:93084#6/1",
+        "@HS27_17643:2:2110:8108:93084#6/2",
+        "@HS27_17643:2:2110:8108:93084#6",
+    ],
+)
+def test_13_readparser_fq_header_parser(header):
+    parser = readparser.fq_header_parser(header)
+    assert parser is not readparser.parse_fq_header
+    assert parser(header) == readparser.parse_fq_header(header)
+    assert readparser.fq_header_parser(header, strict=True) is readparser.parse_fq_header
+
+
+def test_14_readparser_fq_header_parser_strict():
+    fq = "@HS27_17643:2:2110:8108:93084#6/1\nACGT\n+\nMMMM\n@HS27_17643:2:2110:8108:93084#6/9\nACGT\n+\nMMMM\n"
+    with pytest.raises(ValueError, match="^Unsupported FastQ header format: "):
+        readparser.parse_fastq(io.BytesIO(fq.encode()), "bob", strict_headers=True)
+    with pytest.raises(ValueError, match="^Unsupported FastQ header format: "):
+        readparser.fq_header_parser("@HS27_17643:2:2110:8108:93084#6/9")
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 50, readparser.FQ_BLOCK_SIZE])
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n"])
+def test_15_readparser_fq_records(block_size, newline):
+    records = [(b"@r%d/1" % i, b"ACGT%d" % i, b"IIII") for i in range(100)]
+    data = newline.join(newline.join((h, s, b"+", q)) for (h, s, q) in records)
+    assert list(readparser.fq_records(io.BytesIO(data + newline), block_size=block_size)) == records
+    # no final newline
+    assert list(readparser.fq_records(io.BytesIO(data), block_size=block_size)) == records
+    with pytest.raises(ValueError, match="truncated"):
+        list(readparser.fq_records(io.BytesIO(data[:-10]), block_size=block_size))
+
+
+@pytest.fixture
+def fastq_at_quals(tmp_path):
+    # quality lines starting with '@' must not be taken as record starts
+    fq = tmp_path / "reads.fq"
+    with open(fq, "wt") as ofh:
+        for i in range(0, 500):
+            seq = "ACGT" * (i % 6 + 3)
+            ofh.write(f"@r{i} 1:{'Y' if i % 7 == 0 else 'N'}:0:ACGT\n{seq}\n+\n{'@+' * (len(seq) // 2)}\n")
+    return str(fq)
+
+
+@pytest.mark.parametrize("parts", [1, 2, 3, 16])
+def test_16_readparser_fq_ranges(fastq_at_quals, parts):
+    ranges = readparser.fq_ranges(fastq_at_quals, parts)
+    with open(fastq_at_quals, "rb") as ifh:
+        data = ifh.read()
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (start, end) in ranges:
+        assert data[start : start + 2] == b"@r"
+        assert data[start:end].count(b"\n") % 4 == 0
+
+
+@pytest.mark.parametrize("exclude_qcfail, exclude_by_len", [(False, None), (True, 16)])
+def test_17_readparser_parse_fastq_ranges(fastq_at_quals, exclude_qcfail, exclude_by_len):
+    expected = readparser.parse_reads(
+        fastq_at_quals, "bob", 1, exclude_qcfail=exclude_qcfail, exclude_by_len=exclude_by_len
+    )
+    result = readparser.parse_fastq_ranges(
+        fastq_at_quals, "bob", 3, exclude_qcfail=exclude_qcfail, exclude_by_len=exclude_by_len
+    )
+    assert result[0:2] == expected[0:2]
+    assert list(result[2].items()) == list(expected[2].items())
+
+
+@pytest.mark.parametrize(
+    "quals, result",
+    [
+        (["IIII", "IIII"], readparser.OFFSET_ILLUMINA),
+        (["IIII", "II#I"], readparser.OFFSET_CASAVA),
+    ],
+)
+def test_18_readparser_phred_offset(tmp_path, quals, result):
+    # header format implies phred+64, low quality bytes override
+    records = "".join([f"@r{i}/1\nACGT\n+\n{q}\n" for i, q in enumerate(quals)])
+    (_, stats, _, _) = readparser.parse_fastq(io.BytesIO(records.encode()), "bob")
+    assert stats.phred_offset == result
+    # any range decides for the whole file
+    fq_file = os.path.join(tmp_path, "reads.fq")
+    with open(fq_file, "wt") as ofh:
+        print("@r/1\nACGT\n+\nIIII\n" * 100 + records, file=ofh, end="")
+    assert readparser.parse_fastq_ranges(fq_file, "bob", 3)[1].phred_offset == result
+
+
+@pytest.mark.parametrize("cpus", [1, 3])
+def test_19_readparser_meta_file_fastq(tmp_path, fastq_at_quals, cpus):
+    meta_file = os.path.join(tmp_path, "read_meta.bin")
+    readparser.parse_reads(fastq_at_quals, "bob", cpus, exclude_qcfail=True, meta_file=meta_file)
+    expected = []
+    with open(fastq_at_quals, "rb") as ifh:
+        for (header, seq, qual) in readparser.fq_records(ifh):
+            (qname, member, qc_fail, _) = readparser.parse_fq_header(header.decode())
+            if not qc_fail:
+                expected.append((qname, seq, qual, False, member, None))
+    assert list(readparser.meta_records(meta_file)) == expected
+
+
+def test_20_readparser_meta_file_hts(tmp_path):
+    seq_file = os.path.join(DATA_DIR, "htsfile", "non-unique.sam")
+    meta_file = os.path.join(tmp_path, "read_meta.bin")
+    readparser.parse_reads(seq_file, "bob", 1, meta_file=meta_file)
+    with pysam.AlignmentFile(seq_file) as af:
+        expected = [
+            (a.query_name, a.query_sequence.encode(), a.query_qualities.tobytes(), a.is_qcfail, None, None) for a in af
+        ]
+    assert list(readparser.meta_records(meta_file)) == expected
+
+
+@pytest.mark.parametrize("header_fmt", ["@p{i}", "@p{i}/{m}", "@p{i} {m}:N:0:ACGT"])
+def test_21_readparser_paired_fastq(tmp_path, header_fmt):
+    pairs = [("AAAA", "CCCC"), ("AAAA", "GGGG"), ("AAAA", "CCCC")]
+    (interleaved, r1, r2) = [os.path.join(tmp_path, f"{name}.fq") for name in ("interleaved", "r1", "r2")]
+    with open(interleaved, "wt") as ifh, open(r1, "wt") as r1fh, open(r2, "wt") as r2fh:
+        for (i, (seq_l, seq_r)) in enumerate(pairs):
+            rec_l = f"{header_fmt.format(i=i, m=1)}\n{seq_l}\n+\nIIII\n"
+            rec_r = f"{header_fmt.format(i=i, m=2)}\n{seq_r}\n+\nIIII\n"
+            print(rec_l + rec_r, file=ifh, end="")
+            print(rec_l, file=r1fh, end="")
+            print(rec_r, file=r2fh, end="")
+    for (seq_file, mate_file) in ((interleaved, None), (r1, r2)):
+        (unique, stats, reads, read_pairs) = readparser.parse_reads(
+            seq_file, "bob", 1, paired=True, mate_file=mate_file
+        )
+        assert (unique, stats.total_reads, stats.total_pairs) == (3, 6, 3)
+        assert reads == {"AAAA": 3, "CCCC": 2, "GGGG": 1}
+        assert read_pairs == {"AAAA|CCCC": 2, "AAAA|GGGG": 1}
+
+
+def test_22_readparser_paired_fastq_errors(tmp_path):
+    r1 = os.path.join(tmp_path, "r1.fq")
+    r2 = os.path.join(tmp_path, "r2.fq")
+    with open(r1, "wt") as ofh:
+        print("@a\nACGT\n+\nIIII\n@b\nACGT\n+\nIIII", file=ofh)
+    with open(r2, "wt") as ofh:
+        print("@a\nACGT\n+\nIIII", file=ofh)
+    with pytest.raises(ValueError, match="different numbers of records"):
+        readparser.parse_reads(r1, "bob", 1, paired=True, mate_file=r2)
+    # not interleaved
+    with pytest.raises(ValueError, match="interleaved"):
+        readparser.parse_reads(r1, "bob", 1, paired=True)
+
+
+def _paired_bam(tmp_path, hd, names):
+    bam = os.path.join(tmp_path, "pairs.bam")
+    with pysam.AlignmentFile(bam, "wb", header={"HD": hd}) as af:
+        for (name, member) in names:
+            a = pysam.AlignedSegment(af.header)
+            a.query_name = name
+            a.query_sequence = "ACGT"
+            a.flag = 77 if member == 1 else 141
+            af.write(a)
+    return bam
+
+
+@pytest.mark.parametrize(
+    "hd, names, grouped",
+    [
+        ({"VN": "1.6", "GO": "query"}, [("a", 1), ("a", 2), ("b", 1), ("b", 2)], True),
+        ({"VN": "1.6", "GO": "query"}, [("b", 1), ("a", 1), ("a", 2), ("b", 2)], False),
+        ({"VN": "1.6", "GO": "query"}, [("a", 2), ("a", 1), ("b", 2), ("b", 1)], False),
+        ({"VN": "1.6", "SO": "queryname"}, [("b", 1), ("a", 1), ("a", 2), ("b", 2)], True),
+        ({"VN": "1.6", "SO": "coordinate"}, [("a", 1), ("a", 2), ("b", 1), ("b", 2)], False),
+        ({"VN": "1.6", "SO": "unsorted"}, [("a", 1), ("a", 2), ("b", 1), ("b", 2)], True),
+        ({"VN": "1.6"}, [("a", 1), ("b", 1), ("a", 2), ("b", 2)], False),
+        ({"VN": "1.6"}, [("a", 2), ("a", 1), ("b", 1), ("b", 2)], False),
+    ],
+)
+def test_23_readparser_name_grouped(tmp_path, hd, names, grouped):
+    bam = _paired_bam(tmp_path, hd, names)
+    assert readparser.name_grouped(bam) == grouped
+    collated = readparser.collate(bam, str(tmp_path), 1)
+    assert (collated == bam) == grouped
+    if grouped and names[0][0] == names[1][0]:
+        assert readparser.parse_reads(collated, "bob", 1, paired=True)[3] == {"ACGT|ACGT": 2}
+
+
+def test_24_readparser_name_grouped_violation(tmp_path):
+    # the header is trusted, parsing raises on the first mates that are not adjacent
+    bam = _paired_bam(tmp_path, {"VN": "1.6", "SO": "queryname"}, [("a", 1), ("b", 1), ("a", 2), ("b", 2)])
+    assert readparser.collate(bam, str(tmp_path), 1) == bam
+    with pytest.raises(ValueError, match="mates of a are not adjacent"):
+        readparser.parse_reads(bam, "bob", 1, paired=True)
+
+
+def test_25_readparser_meta_file_long_read(tmp_path):
+    # lengths beyond uint16, and a read group beyond uint8
+    (seq, qual, rgid) = (b"ACGT" * 20000, b"I" * 80000, "rg" * 200)
+    fq_file = os.path.join(tmp_path, "long.fq")
+    with open(fq_file, "wb") as ofh:
+        ofh.write(b"@long/1\n" + seq + b"\n+\n" + qual + b"\n")
+    meta_file = os.path.join(tmp_path, "read_meta.bin")
+    readparser.parse_reads(fq_file, "bob", 1, meta_file=meta_file)
+    assert list(readparser.meta_records(meta_file)) == [("long", seq, qual, False, 1, None)]
+    meta = readparser.ReadMetaWriter(meta_file)
+    meta.write("long", seq, qual, False, rgid=rgid)
+    meta.close()
+    assert list(readparser.meta_records(meta_file)) == [("long", seq, qual, False, None, rgid)]
@@ -30,11 +30,8 @@
 import os
 import pathlib
 import shutil
-import tempfile
 import types
 
-import magic
-
 from pycroquet import tools
 
 
@@ -42,11 +39,3 @@ def test_01_tools_chunks():
     newlist = tools.chunks([1, 2, 3], 2)
     assert type(newlist) is types.GeneratorType
     assert list(newlist) == [[1, 2], [3]]
-
-
-def test_02_tools_pickle():
-    original_data = ["hello", "world"]
-    with tempfile.TemporaryDirectory() as tdir:
-        path = tools.pickle_this(tdir, "1", original_data)
-        assert magic.from_file(path).startswith("gzip compressed data")
-        assert tools.unpickle(path) == original_data
@@ -27,15 +27,22 @@
 # statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
 # identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
 # 2009, 2010, 2011, 2012’.
+import io
 import os
 import tempfile
 from array import array
 
+import pysam
 import pytest
 
 from pycroquet import readwriter
+from pycroquet.classes import HtsOptions
 from pycroquet.classes import Seqread
 from pycroquet.classes import Stats
+from pycroquet.htscomm import buckets_to_cram
+from pycroquet.htscomm import BucketWriter
+from pycroquet.htscomm import ORDER_TAG
+from pycroquet.htscomm import SORT_RECORDS
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
 
@@ -79,7 +86,7 @@ def test_01_readwriter_iter_hts(folder, file, qcfail, exp_count, info):
     ],
 )
 def test_02_readwriter_iter_fastq(folder, file, qual_offset, qcfail, exp_count, info):
-    ifh = open(os.path.join(DATA_DIR, folder, file), "rt")
+    ifh = open(os.path.join(DATA_DIR, folder, file), "rb")
     reads = 0
     for i in readwriter._fq_iter(ifh, exclude_qcfail=qcfail, reverse=False, offset_override=qual_offset):
         reads += 1
@@ -533,3 +540,125 @@ def test_06_readwriter_rg_pg(file, stats, exp_rgs, exp_pgs):
     (rgs, pgs) = readwriter.rg_pg(file, stats)
     assert len(rgs) == exp_rgs
     assert len(pgs) == exp_pgs
+
+
+def _bucket_writers(tmp_path, hts_opts=None, ordered=False):
+    refs = [f"g{i}" for i in range(0, 10)]
+    guide_fa = os.path.join(tmp_path, "guides.fa")
+    with open(guide_fa, "wt") as fa:
+        for r in refs:
+            print(f">{r}\nACGTACGTAC", file=fa)
+    header = {"HD": {"VN": "1.0", "SO": "unsorted"}, "SQ": [{"SN": r, "LN": 10} for r in refs]}
+    # (name, reference_id, reverse), -1 is unmapped
+    records = [("r1", 7, False), ("r2", 2, True), ("r3", -1, False), ("r4", 2, False), ("r5", 9, False)]
+    records += [("r6", 2, True), ("r7", 0, False), ("r8", -1, False), ("r9", 7, False)]
+    writers = []
+    shards = (records[0:4], records[4:])
+    if ordered:
+        # reads dealt to the writers out of order, as worker processes receive them, ties are split across writers
+        shards = ([records[i] for i in (0, 2, 5, 7)], [records[i] for i in (1, 3, 4, 6, 8)])
+    for shard, recs in enumerate(shards):
+        with BucketWriter(
+            os.path.join(tmp_path, f"shard_{shard}"), header, guide_fa, buckets=3, hts_opts=hts_opts
+        ) as bw:
+            for (name, ref_id, reverse) in recs:
+                a = pysam.AlignedSegment()
+                a.query_name = name
+                a.query_sequence = "ACGTACGTAC"
+                if ref_id < 0:
+                    a.is_unmapped = True
+                else:
+                    a.reference_id = ref_id
+                    a.reference_start = 0
+                    a.cigarstring = "10M"
+                    a.is_reverse = reverse
+                bw.write(a, order=int(name[1:]) if ordered else None)
+        writers.append(bw)
+    return (writers, header, guide_fa)
+
+
+# 2 forces the bucket of g0-g3 to be merged from sorted runs
+@pytest.mark.parametrize("max_records", [SORT_RECORDS, 2])
+def test_07_readwriter_bucket_cram(tmp_path, max_records):
+    (writers, header, guide_fa) = _bucket_writers(tmp_path)
+    aligned = buckets_to_cram(writers, header, guide_fa, os.path.join(tmp_path, "out"), max_records=max_records)
+    assert aligned == os.path.join(tmp_path, "out.cram")
+    with pysam.AlignmentFile(os.path.join(tmp_path, "out.cram"), "rc", reference_filename=guide_fa) as af:
+        assert af.header.to_dict()["HD"]["SO"] == "coordinate"
+        got = [(a.query_name, a.reference_name) for a in af.fetch(until_eof=True)]
+    # stable ordering by reference, start and strand, unmapped at the end in write order
+    assert got == [
+        ("r7", "g0"),
+        ("r4", "g2"),
+        ("r2", "g2"),
+        ("r6", "g2"),
+        ("r1", "g7"),
+        ("r9", "g7"),
+        ("r5", "g9"),
+        ("r3", None),
+        ("r8", None),
+    ]
+    assert os.path.exists(os.path.join(tmp_path, "out.cram.crai"))
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".bam")]
+
+
+def test_08_readwriter_fq_quals():
+    records = b"@r1\nACGT\n+\n#+5?\n@r2\nACGT\n+\n!!!!\n"
+    seqreads = list(readwriter._fq_iter(io.BytesIO(records), False, True, offset_override=33))
+    assert seqreads[0].qual == array("B", [30, 20, 10, 2])
+    assert seqreads[0].qual.typecode == "B"
+    # reversed records don't modify the shared qualities
+    for _ in range(0, 2):
+        assert list(readwriter.to_alignment(seqreads[0], True, []).query_qualities) == [2, 10, 20, 30]
+    with pytest.raises(ValueError, match="^Quality below phred offset 64 for read r1"):
+        list(readwriter._fq_iter(io.BytesIO(records), False, False, offset_override=64))
+
+
+@pytest.mark.parametrize(
+    "output_format, sort_order, index",
+    [
+        ("bam", "coordinate", "out.bam.bai"),
+        ("unsorted", "unsorted", None),
+    ],
+)
+def test_09_readwriter_bucket_formats(tmp_path, output_format, sort_order, index):
+    hts_opts = HtsOptions(output_format=output_format, level=1, bucket_level=0)
+    (writers, header, guide_fa) = _bucket_writers(tmp_path, hts_opts=hts_opts)
+    aligned = buckets_to_cram(writers, header, guide_fa, os.path.join(tmp_path, "out"), hts_opts=hts_opts)
+    assert aligned == os.path.join(tmp_path, "out.bam")
+    with pysam.AlignmentFile(aligned, "rb", check_sq=False) as af:
+        assert af.header.to_dict()["HD"]["SO"] == sort_order
+        got = [a.query_name for a in af.fetch(until_eof=True)]
+    assert sorted(got) == [f"r{i}" for i in range(1, 10)]
+    if index:
+        assert os.path.exists(os.path.join(tmp_path, index))
+    else:
+        # bucket order, records of a bucket in the order of the writers
+        assert got == ["r2", "r4", "r6", "r7", "r1", "r9", "r5", "r3", "r8"]
+
+
+@pytest.mark.parametrize("unmapped", ["drop", "separate"])
+def test_10_readwriter_bucket_unmapped(tmp_path, unmapped):
+    hts_opts = HtsOptions(output_format="bam", unmapped=unmapped)
+    (writers, header, guide_fa) = _bucket_writers(tmp_path, hts_opts=hts_opts)
+    aligned = buckets_to_cram(writers, header, guide_fa, os.path.join(tmp_path, "out"), hts_opts=hts_opts)
+    with pysam.AlignmentFile(aligned, "rb") as af:
+        assert [a.query_name for a in af.fetch(until_eof=True)] == ["r7", "r4", "r2", "r6", "r1", "r9", "r5"]
+    unmapped_bam = os.path.join(tmp_path, "out.unmapped.bam")
+    if unmapped == "drop":
+        assert not os.path.exists(unmapped_bam)
+    else:
+        with pysam.AlignmentFile(unmapped_bam, "rb", check_sq=False) as af:
+            assert af.header.to_dict()["HD"]["SO"] == "unsorted"
+            assert [a.query_name for a in af.fetch(until_eof=True)] == ["r3", "r8"]
+
+
+def test_11_readwriter_bucket_order(tmp_path):
+    hts_opts = HtsOptions(output_format="bam")
+    (writers, header, guide_fa) = _bucket_writers(tmp_path, hts_opts=hts_opts, ordered=True)
+    aligned = buckets_to_cram(writers, header, guide_fa, os.path.join(tmp_path, "out"), hts_opts=hts_opts)
+    with pysam.AlignmentFile(aligned, "rb") as af:
+        got = [a for a in af.fetch(until_eof=True)]
+    # ties and unmapped records in input order regardless of the writer
+    assert [a.query_name for a in got] == ["r7", "r4", "r2", "r6", "r1", "r9", "r5", "r3", "r8"]
+    assert not [a for a in got if a.has_tag(ORDER_TAG)]
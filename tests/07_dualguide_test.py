@@ -28,18 +28,19 @@
 # identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
 # 2009, 2010, 2011, 2012’.
 import os
-import tempfile
+from array import array
 
 import pytest
 from pygas.alignercpu import AlignerCpu
 from pygas.classes import Backtrack
 
-import pycroquet.tools as ctools
 from pycroquet import dualguide
 from pycroquet import libparser
 from pycroquet import readparser
+from pycroquet import readwriter
 from pycroquet.classes import Classification
 from pycroquet.classes import Library
+from pycroquet.classes import Seqread
 
 DATA_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -64,11 +65,8 @@ def map_resource(request):
         rev_comp=True,  # as some reads can be reversed in DG
     )
     # removed all the "at-scale" wrapping
-    results = aligner.align_queries(reads.keys(), keep_matrix=False)
-    # for code path, pickle
-    tdir = tempfile.TemporaryDirectory()
-    pickles = [ctools.pickle_this(tdir.name, "pre_matrix_{:05d}".format(1), [results])]
-    (aligned_results, multi_map, unique_map, unmap) = dualguide.pickles_to_mapset(pickles, reads, aligner)
+    results = aligner.align_queries(list(reads.keys()), keep_matrix=False)
+    (aligned_results, multi_map, unique_map, unmap) = dualguide.batches_to_mapset([results], reads, aligner)
     yield (aligned_results, multi_map, unique_map, unmap, library, stats)
 
 
@@ -117,3 +115,33 @@ def test_01_read_pair_to_guides(map_resource, read_l, read_r, mtype_l, mtype_r,
         aligned_results[read_l], aligned_results[read_r], library
     )
     assert classified == exp_class
+
+
+def _segment_fields(alignments):
+    return [
+        (a.query_name, a.flag, a.reference_id, a.reference_start, a.cigarstring, a.mapping_quality, a.get_tags())
+        for a in alignments
+    ]
+
+
+def test_02_to_mapped_reads_templates(map_resource, monkeypatch):
+    (aligned_results, _, _, _, library, _) = map_resource
+    ref_ids = {sgrna_id: i for (i, sgrna_id) in enumerate(sorted({s for g in library.guides for s in g.sgrna_ids}))}
+    monkeypatch.setattr(readwriter, "TEMPLATE_CACHE_SIZE", 2)
+    templates = {}
+    for _ in range(0, 2):
+        for (seq, (hit_type, hits)) in aligned_results.items():
+            if hit_type == "unmapped":
+                continue
+            for guide_idx in (None, [0]):
+                read = Seqread(qname="r1", member=1, sequence=seq, qual=array("i", [30] * len(seq)), rgid="1")
+                (expected, exp_multi) = readwriter.to_mapped_reads(
+                    read, ref_ids, library, hits, guide_idx=guide_idx, dual=True
+                )
+                read = Seqread(qname="r1", member=1, sequence=seq, qual=array("i", [30] * len(seq)), rgid="1")
+                (cached, multi) = readwriter.to_mapped_reads(
+                    read, ref_ids, library, hits, guide_idx=guide_idx, dual=True, templates=templates
+                )
+                assert multi == exp_multi
+                assert _segment_fields(cached) == _segment_fields(expected)
+                assert len(templates) <= 2
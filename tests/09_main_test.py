@@ -0,0 +1,129 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+import os
+
+import pytest
+from pygas.alignercpu import AlignerCpu
+
+from pycroquet import libparser
+from pycroquet import main
+from pycroquet import readparser
+
+TARGETS = ["AAAAAAAAAA", "GGGGCCCCCC", "GGGGGGGGGG", "TTTTTTTTTT"]
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cli", "input")
+
+QUERIES = ["AAAAAAAAAA", "GGGGCCCCCC", "GGGGCCCCCA", "CCCCCCCCCC", "ACGTACGTAC"]
+
+
+@pytest.mark.parametrize(
+    "cpus, read_chunk",
+    [
+        (1, 2),
+        (2, 1),
+        (2, 2),
+    ],
+)
+def test_01_main_mapping_by_chunk(cpus, read_chunk):
+    aligner = AlignerCpu(targets=TARGETS, rules=[], score_min=5, rev_comp=True)
+    seen = {}
+    with main.mapping_pool(aligner, cpus) as pool:
+        for (seq, hit_type, _) in main.select_alignments(
+            main.mapping_by_chunk(aligner, list(QUERIES), read_chunk, cpus, pool=pool), aligner.rules
+        ):
+            seen[seq] = hit_type
+    assert seen == {
+        "AAAAAAAAAA": "multimap",
+        "GGGGCCCCCC": "unique",
+        "GGGGCCCCCA": "unmapped",
+        "CCCCCCCCCC": "unique",
+        "ACGTACGTAC": "unmapped",
+    }
+
+
+def _hit_summary(batches, rules):
+    summary = {}
+    for (seq, hit_type, hits) in main.select_alignments(batches, rules):
+        summary[seq] = (hit_type, [(h.sm.target_id, h.sm.reversed, h.cigar, h.md, h.t_pos) for h in hits or []])
+    return summary
+
+
+@pytest.mark.parametrize(
+    "targets, rev_comp, match_type",
+    [
+        (TARGETS, True, 3),
+        (TARGETS, False, 3),
+        (TARGETS, True, 0),
+        (TARGETS + ["GGGGCCCCCCAA"], True, 3),
+        (TARGETS + ["GGGGCC"], True, 2),
+    ],
+)
+def test_02_main_exact_fast_path(targets, rev_comp, match_type):
+    aligner = AlignerCpu(targets=sorted(targets), rules=["M"], score_min=5, rev_comp=rev_comp, match_type=match_type)
+    queries = QUERIES + ["GGGG"]
+    (exact_batch, residue) = main.exact_fast_path(aligner, queries)
+    assert exact_batch.total_reads + len(residue) == len(queries)
+    fast = _hit_summary([exact_batch, aligner.align_queries(residue, keep_matrix=False)], aligner.rules)
+    assert fast == _hit_summary([aligner.align_queries(queries, keep_matrix=False)], aligner.rules)
+
+
+def test_03_main_process_reads_one_pool(tmp_path, monkeypatch):
+    library = libparser.load(os.path.join(DATA_DIR, "guides.tsv.gz"))
+    args = (library, os.path.join(DATA_DIR, "mini.fq.gz"), str(tmp_path), ["M"], 17, 2, 5)
+    expected = main.process_reads(*args, sample="bob")
+    pools = []
+
+    def counting_pool(aligner, usable_cpu):
+        pools.append(usable_cpu)
+        return mapping_pool(aligner, usable_cpu)
+
+    mapping_pool = main.mapping_pool
+    monkeypatch.setattr(main, "mapping_pool", counting_pool)
+    # force a dump on every new sequence, giving many partitions
+    monkeypatch.setattr(readparser, "DICT_ENTRY_BYTES", 1024 * 1024)
+    (query_dict, guide_results, aligned_results, stats) = main.process_reads(*args, sample="bob", max_memory=1)
+    assert len(list(readparser.partitions(query_dict))) > 1
+    assert pools == [2]
+    assert list(readparser.sorted_counts(query_dict)) == list(readparser.sorted_counts(expected[0]))
+    assert guide_results == expected[1]
+    assert {k: v[0] for k, v in aligned_results.items()} == {k: v[0] for k, v in expected[2].items()}
+    assert stats == expected[3]
+
+
+def test_04_main_process_reads_no_alignments(tmp_path, monkeypatch):
+    library = libparser.load(os.path.join(DATA_DIR, "guides.tsv.gz"))
+    args = (library, os.path.join(DATA_DIR, "mini.fq.gz"), str(tmp_path), ["M"], 17, 1, 5)
+    expected = main.process_reads(*args, sample="bob")
+    monkeypatch.setattr(readparser, "DICT_ENTRY_BYTES", 1024 * 1024)
+    (_, guide_results, aligned_results, stats) = main.process_reads(
+        *args, sample="bob", max_memory=1, keep_alignments=False
+    )
+    assert aligned_results == {}
+    assert guide_results == expected[1]
+    assert stats == expected[3]
@@ -27,15 +27,22 @@
 # statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
 # identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
 # 2009, 2010, 2011, 2012’.
+import gzip
 import json
 import os
 import tempfile
 from pprint import pprint
 
+import pysam
 import pytest
+from click.testing import CliRunner
 
+from pycroquet import cli
 from pycroquet import dualguide
+from pycroquet import readparser
+from pycroquet import readwriter
 from pycroquet import singleguide
+from pycroquet import singlepass
 
 DATA_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -188,3 +195,241 @@ def test_02_dual_guide(low_count, compare_to):
         del stats_old[i]
         del stats_new[i]
     assert stats_new == stats_old
+
+
+def _single_guide_cram(tdir, cpus, chunks=1000, single_pass=False, cache_reads=False, queries=None, qual_offset=33):
+    output = os.path.join(tdir, f"result_{cpus}_{single_pass}")
+    singleguide.run(
+        os.path.join(DATA_DIR, "input", "guides.tsv.gz"),
+        queries if queries else os.path.join(DATA_DIR, "input", "mini.fq.gz"),
+        "bob",
+        output,
+        os.path.join(tdir, f"workspace_{cpus}_{single_pass}"),
+        ["M"],
+        None,
+        17,
+        qual_offset,
+        cpus,
+        None,
+        False,
+        chunks,
+        False,
+        "all",
+        "CRITICAL",
+        single_pass=single_pass,
+        cache_reads=cache_reads,
+    )
+    with pysam.AlignmentFile(f"{output}.cram") as af:
+        return [a.to_string() for a in af]
+
+
+def test_03_single_guide_sharded(monkeypatch):
+    # force multiple shards from the 200 reads
+    monkeypatch.setattr(readwriter, "SHARD_READS", 30)
+    with tempfile.TemporaryDirectory() as tdir:
+        serial = _single_guide_cram(tdir, 1)
+        assert len(serial) > 0
+        assert _single_guide_cram(tdir, 3) == serial
+
+
+def test_04_single_guide_collapsed():
+    with tempfile.TemporaryDirectory() as tdir:
+        output = os.path.join(tdir, "result")
+        singleguide.run(
+            os.path.join(DATA_DIR, "input", "guides.tsv.gz"),
+            os.path.join(DATA_DIR, "input", "mini.fq.gz"),
+            "bob",
+            output,
+            os.path.join(tdir, "workspace"),
+            ["M"],
+            None,
+            17,
+            33,
+            1,
+            None,
+            False,
+            1000,
+            False,
+            "all",
+            "CRITICAL",
+            collapse_alignments=True,
+        )
+        with open(f"{output}.stats.json", "r") as sfp:
+            stats = json.load(sfp)
+        with pysam.AlignmentFile(f"{output}.cram") as af:
+            primary = [a for a in af if not a.is_secondary]
+    assert len(primary) == len({a.query_sequence for a in primary})
+    assert sum([a.get_tag(readwriter.COUNT_TAG) for a in primary]) == stats["total_reads"]
+    assert sum([a.get_tag(readwriter.COUNT_TAG) for a in primary if a.is_unmapped]) == stats["unmapped_reads"]
+
+
+def _dual_guide_run(
+    output, collapse_alignments, no_alignment=False, queries=None, sample=None, queries_r2=None, cpus=1
+):
+    dualguide.run(
+        os.path.join(DATA_DIR, "input", "dual_lib.tsv.gz"),
+        queries if queries else os.path.join(DATA_DIR, "input", "dual_reads.bam"),
+        sample,
+        output,
+        f"{output}_workspace",
+        [],
+        None,
+        15,
+        None,
+        cpus,
+        None,
+        False,
+        "TinQ",
+        0,
+        1000,
+        "WARN",
+        collapse_alignments=collapse_alignments,
+        no_alignment=no_alignment,
+        queries_r2=queries_r2,
+    )
+    with open(f"{output}.stats.json", "r") as sfp:
+        stats = json.load(sfp)
+    for i in ("command", "version", "phred_offset"):
+        del stats[i]
+    with gzip.open(f"{output}.counts.tsv.gz", "rt") as cfp:
+        counts = [line for line in cfp if not line.startswith("##")]
+    with gzip.open(f"{output}.query_class.tsv.gz", "rt") as qfp:
+        counts.extend(qfp.readlines())
+    return (stats, counts)
+
+
+def test_05_dual_guide_collapsed():
+    with tempfile.TemporaryDirectory() as tdir:
+        (stats, counts) = _dual_guide_run(os.path.join(tdir, "result"), False)
+        output = os.path.join(tdir, "collapsed")
+        assert _dual_guide_run(output, True) == (stats, counts)
+        with pysam.AlignmentFile(f"{output}.cram") as af:
+            pairs = [a.get_tag(readwriter.COUNT_TAG) for a in af if a.is_read1 and not a.is_secondary]
+    assert sum(pairs) == stats["total_pairs"]
+
+
+@pytest.mark.parametrize("cpus", [1, 3])
+def test_06_single_guide_single_pass(monkeypatch, cpus):
+    # small batches and reorder buffer to force waiting on the oldest batch
+    monkeypatch.setattr(singlepass, "REORDER_READS", 20)
+    with tempfile.TemporaryDirectory() as tdir:
+        two_pass = _single_guide_cram(tdir, cpus)
+        assert _single_guide_cram(tdir, cpus, chunks=7, single_pass=True) == two_pass
+        results = []
+        for output in (f"result_{cpus}_False", f"result_{cpus}_True"):
+            with open(os.path.join(tdir, f"{output}.stats.json"), "r") as sfp:
+                stats = json.load(sfp)
+            with gzip.open(os.path.join(tdir, f"{output}.counts.tsv.gz"), "rt") as cfp:
+                results.append((stats, cfp.read()))
+        assert results[0] == results[1]
+
+
+@pytest.mark.parametrize("cpus", [1, 3])
+def test_07_single_guide_cache_reads(monkeypatch, cpus):
+    monkeypatch.setattr(readwriter, "SHARD_READS", 30)
+    with tempfile.TemporaryDirectory() as tdir:
+        expected = _single_guide_cram(tdir, cpus)
+    with tempfile.TemporaryDirectory() as tdir:
+        assert _single_guide_cram(tdir, cpus, cache_reads=True) == expected
+        assert not os.path.exists(os.path.join(tdir, f"workspace_{cpus}_False", "read_meta.bin"))
+
+
+def test_08_dual_guide_no_alignment():
+    with tempfile.TemporaryDirectory() as tdir:
+        expected = _dual_guide_run(os.path.join(tdir, "result"), False)
+        output = os.path.join(tdir, "counts_only")
+        assert _dual_guide_run(output, False, no_alignment=True) == expected
+        assert not os.path.exists(f"{output}.cram")
+
+
+def _dual_guide_fastq(tdir):
+    """
+    Writes the pairs of dual_reads.bam as interleaved and read 1/read 2 fastq
+    """
+    pairs = {}
+    with pysam.AlignmentFile(os.path.join(DATA_DIR, "input", "dual_reads.bam"), check_sq=False) as af:
+        for a in af:
+            qual = "".join([chr(q + 33) for q in a.get_forward_qualities()])
+            pairs.setdefault(a.query_name, {})[a.is_read1] = f"@{a.query_name}\n{a.get_forward_sequence()}\n+\n{qual}\n"
+    files = [os.path.join(tdir, f"{name}.fq") for name in ("interleaved", "r1", "r2")]
+    with open(files[0], "w") as ifh, open(files[1], "w") as r1fh, open(files[2], "w") as r2fh:
+        for pair in pairs.values():
+            print(pair[True] + pair[False], end="", file=ifh)
+            print(pair[True], end="", file=r1fh)
+            print(pair[False], end="", file=r2fh)
+    return files
+
+
+def _alignments(cram):
+    # read groups differ as fastq has none
+    records = []
+    with pysam.AlignmentFile(cram, check_sq=False) as af:
+        for a in af:
+            a.set_tag("RG", None)
+            records.append(a.to_string())
+    return sorted(records)
+
+
+def test_09_dual_guide_fastq():
+    with tempfile.TemporaryDirectory() as tdir:
+        (interleaved, r1, r2) = _dual_guide_fastq(tdir)
+        expected = _dual_guide_run(os.path.join(tdir, "result"), False)
+        alignments = _alignments(os.path.join(tdir, "result.cram"))
+        for (output, queries, queries_r2) in (("interleaved", interleaved, None), ("r1_r2", r1, r2)):
+            output = os.path.join(tdir, output)
+            assert _dual_guide_run(output, False, queries=queries, sample="PSN1_R1", queries_r2=queries_r2) == expected
+            assert _alignments(f"{output}.cram") == alignments
+
+
+def test_10_dual_guide_sharded(monkeypatch):
+    monkeypatch.setattr(dualguide, "SHARD_PAIRS", 30)
+    with tempfile.TemporaryDirectory() as tdir:
+        expected = _dual_guide_run(os.path.join(tdir, "result"), False)
+        output = os.path.join(tdir, "sharded")
+        assert _dual_guide_run(output, False, cpus=3) == expected
+        alignments = []
+        for cram in ("result.cram", "sharded.cram"):
+            with pysam.AlignmentFile(os.path.join(tdir, cram), check_sq=False) as af:
+                alignments.append([a.to_string() for a in af])
+    assert alignments[0] == alignments[1]
+
+
+@pytest.mark.parametrize("cpus", [1, 3])
+def test_11_single_guide_single_pass_offset(monkeypatch, cpus):
+    # leading reads only have phred+64 compatible qualities, a later read disproves it
+    monkeypatch.setattr(readparser, "PHRED_SAMPLE_READS", 10)
+    with tempfile.TemporaryDirectory() as tdir:
+        queries = os.path.join(tdir, "late_low.fq")
+        with gzip.open(os.path.join(DATA_DIR, "input", "mini.fq.gz"), "rt") as ifh, open(queries, "w") as ofh:
+            for (idx, line) in enumerate(ifh):
+                if idx % 4 == 3 and idx < 200:
+                    line = line.replace("/", "F").replace("<", "F")
+                ofh.write(line)
+        assert readparser.input_stats(queries, sample="bob").phred_offset == readparser.OFFSET_ILLUMINA
+        two_pass = _single_guide_cram(tdir, cpus, queries=queries, qual_offset=None)
+        assert _single_guide_cram(tdir, cpus, single_pass=True, queries=queries, qual_offset=None) == two_pass
+        with open(os.path.join(tdir, f"result_{cpus}_True.stats.json"), "r") as sfp:
+            assert json.load(sfp)["phred_offset"] == readparser.OFFSET_CASAVA
+
+
+@pytest.mark.parametrize("command", ["single-guide", "long-read"])
+def test_12_single_pass_cache_reads(command):
+    with tempfile.TemporaryDirectory() as tdir:
+        result = CliRunner().invoke(
+            cli.cli,
+            [
+                command,
+                "-g",
+                os.path.join(DATA_DIR, "input", "guides.tsv.gz"),
+                "-q",
+                os.path.join(DATA_DIR, "input", "mini.fq.gz"),
+                "-s",
+                "bob",
+                "-o",
+                os.path.join(tdir, "result"),
+                "--single-pass",
+                "--cache-reads",
+            ],
+        )
+    assert result.exit_code == 2
+    assert "--cache-reads can not be used with --single-pass" in result.output
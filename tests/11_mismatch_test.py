@@ -0,0 +1,239 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+import random
+
+import pytest
+from pygas.alignercpu import AlignerCpu
+from pygas.matrix import revcomp
+
+from pycroquet import main
+from pycroquet import mismatch
+
+TARGETS = sorted(["AACCGGTTACGTACGTAAGG", "ACGTTGCAACGTTGCAACGT", "GGGGCCCCAAAATTTTGCGC", "CATGCATGCATGCATGCATG"])
+QUERIES = [
+    "AACCGGTTACGTACGTAAGG",  # exact
+    "AACCGGTTACCTACGTAAGG",  # 1 mismatch
+    "AACCGGTTACCTACGTTAGG",  # 2 mismatch
+    "AACCGGTAACCTACGTTAGG",  # 3 mismatch
+    "GCGCAAAATTTTGGGGCCCC",  # revcomp, exact
+    "CATGCATGCATGCATGCATC",  # mismatch at end, clipped so not exact boundary
+    "CATGCATGCATG",  # short
+    "TTTTTTTTTTTTTTTTTTTT",
+]
+
+
+@pytest.mark.parametrize(
+    "rules, match_type, expected",
+    [
+        (["M"], 0, True),
+        (["MM", "M"], 0, True),
+        (["MM"], 3, False),
+        (["MI"], 0, False),
+        ([], 0, False),
+    ],
+)
+def test_01_mismatch_usable(rules, match_type, expected):
+    aligner = AlignerCpu(targets=TARGETS, rules=rules, score_min=15, match_type=match_type)
+    assert mismatch.usable(aligner) == expected
+
+
+@pytest.mark.parametrize(
+    "query, max_mm, expected",
+    [
+        ("AACCGGTTACGTACGTAAGG", 0, {0}),
+        ("AACCGGTTACCTACGTTAGG", 1, set()),
+        ("AACCGGTTACCTACGTTAGG", 2, {0}),
+        ("AACCGGTTACGTACGTAAG", 2, set()),
+    ],
+)
+def test_02_mismatch_candidates(query, max_mm, expected):
+    assert mismatch.MismatchIndex(TARGETS, max_mm).candidates(query) == expected
+
+
+def _summary(batch, rules):
+    summary = {}
+    for (seq, hit_type, hits) in main.select_alignments([batch], rules):
+        summary[seq] = (
+            hit_type,
+            [(h.sm.target_id, h.sm.reversed, h.cigar, h.md, h.nm, h.sm.score) for h in hits or []],
+        )
+    return summary
+
+
+@pytest.mark.parametrize("rules", [["M"], ["MM"], ["MM", "M"]])
+@pytest.mark.parametrize("rev_comp", [True, False])
+def test_03_mismatch_map_queries(rules, rev_comp):
+    aligner = AlignerCpu(targets=TARGETS, rules=rules, score_min=15, rev_comp=rev_comp, match_type=0)
+    index = mismatch.MismatchIndex(TARGETS, aligner.max_penalty)
+    # the terminal mismatch is clipped by the aligner, see test_05
+    queries = [q for q in QUERIES if q != "CATGCATGCATGCATGCATC"]
+    assert _summary(index.map_queries(aligner, queries), rules) == _summary(
+        aligner.align_queries(queries, keep_matrix=False), rules
+    )
+
+
+def test_04_mismatch_map_queries_revcomp():
+    """
+    The aligner can drop a reverse complement hit when a later target scores higher in the forward orientation, even
+    below the minimum score, the index retains it.
+    """
+    aligner = AlignerCpu(targets=TARGETS, rules=["M"], score_min=15, rev_comp=True, match_type=0)
+    index = mismatch.MismatchIndex(TARGETS, aligner.max_penalty)
+    batch = index.map_queries(aligner, ["CCTTACGTACCTAACCGGTT"])
+    assert batch.unmapped == []
+    assert [(bt.sm.target, bt.sm.reversed, bt.cigar, bt.md, bt.nm) for bt in batch.mapped[0]] == [
+        ("AACCGGTTACGTACGTAAGG", True, "20M", "9C10", 1)
+    ]
+
+
+def test_05_mismatch_map_queries_ranked():
+    """
+    Hits are ranked by mismatches over the full length, the aligner clips a terminal mismatch (failing exact boundary
+    mode) and keeps the 2 mismatch forward hit instead.
+    """
+    targets = ["ATTTCAAG", "CAAGGCGT", "ACTACGGA", "GACAGACA", "TCATATAC", "TGCGTCGG"]
+    aligner = AlignerCpu(targets=targets, rules=["MM"], score_min=5, rev_comp=True, match_type=0)
+    index = mismatch.MismatchIndex(targets, aligner.max_penalty)
+    assert _summary(aligner.align_queries(["ACGACGCA"], keep_matrix=False), aligner.rules) == {
+        "ACGACGCA": ("unique", [(2, False, "8M", "2T3G1", 2, 6)])
+    }
+    assert _summary(index.map_queries(aligner, ["ACGACGCA"]), aligner.rules) == {
+        "ACGACGCA": ("unique", [(5, True, "8M", "7G", 1, 7)])
+    }
+    aligner = AlignerCpu(targets=TARGETS, rules=["M"], score_min=15, rev_comp=False, match_type=0)
+    index = mismatch.MismatchIndex(TARGETS, aligner.max_penalty)
+    assert _summary(index.map_queries(aligner, ["CATGCATGCATGCATGCATC"]), aligner.rules) == {
+        "CATGCATGCATGCATGCATC": ("unique", [(TARGETS.index("CATGCATGCATGCATGCATG"), False, "20M", "19G", 1, 19)])
+    }
+
+
+def _random_library(rng, seq_len):
+    return list(dict.fromkeys(["".join(rng.choice("ACGT") for _ in range(seq_len)) for _ in range(rng.randint(3, 12))]))
+
+
+def _random_queries(rng, targets):
+    """
+    Random sequences and every single base substitution of each target, a second substitution for some
+    """
+    queries = ["".join(rng.choice("ACGT") for _ in range(len(targets[0]))) for _ in range(20)]
+    for target in targets:
+        for i in range(0, len(target)):
+            query = target[:i] + rng.choice("ACGT") + target[i + 1 :]
+            if rng.random() < 0.5:
+                j = rng.randrange(len(target))
+                query = query[:j] + rng.choice("ACGT") + query[j + 1 :]
+            queries.append(query)
+    return list(dict.fromkeys(queries))
+
+
+def _hamming_oracle(aligner: AlignerCpu, query: str):
+    """
+    (target_id, reversed) of every full length hit with the fewest mismatches, checking all targets
+    """
+    found = []
+    orientations = [(query, False)] + ([(revcomp(query), True)] if aligner.rev_comp else [])
+    for (t_idx, target) in enumerate(aligner.targets):
+        for (o_query, is_reversed) in orientations:
+            mm = sum(1 for (a, b) in zip(target, o_query) if a != b)
+            if mm <= aligner.max_penalty and len(query) - mm >= aligner.score_min:
+                found.append((mm, t_idx, is_reversed))
+    if not found:
+        return None
+    best_mm = min([f[0] for f in found])
+    return [(t_idx, is_reversed) for (mm, t_idx, is_reversed) in sorted(found) if mm == best_mm]
+
+
+def _random_cases(seed):
+    rng = random.Random(seed)
+    for _ in range(0, 40):
+        seq_len = rng.choice([8, 10, 12, 20])
+        targets = _random_library(rng, seq_len)
+        rules = rng.choice([["M"], ["MM"], ["MMM"], ["MM", "M"]])
+        aligner = AlignerCpu(
+            targets=targets, rules=rules, score_min=seq_len - 4, rev_comp=rng.random() < 0.7, match_type=0
+        )
+        yield (aligner, _random_queries(rng, targets))
+
+
+def _selected(batch, rules):
+    return {
+        seq: None if hits is None else [(h.sm.target_id, h.sm.reversed) for h in hits]
+        for (seq, _, hits) in main.select_alignments([batch], rules)
+    }
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_06_mismatch_random_oracle(seed):
+    """
+    The index finds every target within the allowed mismatches, not only those sharing a segment by chance
+    """
+    for (aligner, queries) in _random_cases(seed):
+        index = mismatch.MismatchIndex(aligner.targets, aligner.max_penalty)
+        got = _selected(index.map_queries(aligner, queries), aligner.rules)
+        assert got == {q: _hamming_oracle(aligner, q) for q in queries}
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_07_mismatch_random_aligner(seed):
+    """
+    Equivalence with the aligner on randomised libraries.  Where the aligner maps a query the index maps it to the same
+    hits, or to hits with fewer mismatches (see module docstring), it never loses a mapped query.
+    """
+    (same, differ) = (0, 0)
+    for (aligner, queries) in _random_cases(seed):
+        index = mismatch.MismatchIndex(aligner.targets, aligner.max_penalty)
+        index_batch = index.map_queries(aligner, queries)
+        got = _selected(index_batch, aligner.rules)
+        got_nm = {hits[0].sm.original_seq: hits[0].nm for hits in index_batch.mapped}
+        aligned = aligner.align_queries(queries, keep_matrix=False)
+        for (seq, _, hits) in main.select_alignments([aligned], aligner.rules):
+            expected = None if hits is None else [(h.sm.target_id, h.sm.reversed) for h in hits]
+            if got[seq] == expected:
+                same += 1
+                continue
+            differ += 1
+            if expected is None:
+                continue
+            assert got[seq] is not None
+            assert got_nm[seq] <= hits[0].nm
+            if got_nm[seq] == hits[0].nm:
+                assert set(got[seq]) > set(expected)
+    # differences are the minority, mostly terminal mismatches
+    assert same > differ * 4
+
+
+@pytest.mark.parametrize("mismatch_index, expected", [(False, (2, False)), (True, (5, True))])
+def test_08_mismatch_map_reads_opt_in(mismatch_index, expected):
+    targets = ["ATTTCAAG", "CAAGGCGT", "ACTACGGA", "GACAGACA", "TCATATAC", "TGCGTCGG"]
+    aligner = AlignerCpu(targets=targets, rules=["MM"], score_min=5, rev_comp=True, match_type=0)
+    batches = main.map_reads(aligner, 1, 10, 1, ["ACGACGCA"], mismatch_index=mismatch_index)
+    assert [
+        (h.sm.target_id, h.sm.reversed) for (_, _, hits) in main.select_alignments(batches, aligner.rules) for h in hits
+    ] == [expected]
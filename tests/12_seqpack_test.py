@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+import os
+
+import pytest
+
+from pycroquet import readparser
+from pycroquet import seqpack
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+
+
+@pytest.mark.parametrize(
+    "seq, packed_type",
+    [
+        ("", int),
+        ("A", int),
+        ("ACGT", int),
+        ("TTCACCGAGCTTCCGGGAG", int),
+        ("TTCACCGAGCTTCCGGGAGT", int),
+        ("TTCANCGAGCTTCCGGGAG", str),
+        ("acgt", str),
+    ],
+)
+def test_01_seqpack_round_trip(seq, packed_type):
+    key = seqpack.pack(seq)
+    assert type(key) is packed_type
+    assert seqpack.unpack(key) == seq
+
+
+def test_02_seqpack_distinct_keys():
+    seqs = ["A", "AA", "AAA", "C", "CA", "AC", "T", "TTTT", "N"]
+    assert len({seqpack.pack(s) for s in seqs}) == len(seqs)
+
+
+@pytest.mark.parametrize("file", ["fastq/non-unique.fq", "htsfile/non-unique.sam"])
+def test_03_seqpack_parse_reads(file):
+    (unique, _, reads, _) = readparser.parse_reads(os.path.join(DATA_DIR, file), "bob", 1)
+    (p_unique, _, p_reads, _) = readparser.parse_reads(os.path.join(DATA_DIR, file), "bob", 1, packed=True)
+    assert p_unique == unique
+    assert {seqpack.unpack(k): v for k, v in p_reads.items()} == reads
@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2021-2022
+#
+# Author: CASM/Cancer IT <cgphelp@sanger.ac.uk>
+#
+# This file is part of pycroquet.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# 1. The usage of a range of years within a copyright statement contained within
+# this distribution should be interpreted as being equivalent to a list of years
+# including the first and last year specified and all consecutive years between
+# them. For example, a copyright statement that reads ‘Copyright (c) 2005, 2007-
+# 2009, 2011-2012’ should be interpreted as being identical to a statement that
+# reads ‘Copyright (c) 2005, 2007, 2008, 2009, 2011, 2012’ and a copyright
+# statement that reads ‘Copyright (c) 2005-2012’ should be interpreted as being
+# identical to a statement that reads ‘Copyright (c) 2005, 2006, 2007, 2008,
+# 2009, 2010, 2011, 2012’.
+import gzip
+import os
+
+import pysam
+import pytest
+
+from pycroquet import gzreader
+from pycroquet import readparser
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+FQ = os.path.join(DATA_DIR, "fastq", "non-unique.fq")
+
+
+def _read_all(fh, size):
+    data = []
+    while chunk := fh.read(size):
+        data.append(chunk)
+    fh.close()
+    return b"".join(data)
+
+
+@pytest.fixture
+def fastq_bytes():
+    # repeat so the file spans multiple BGZF blocks
+    with open(FQ, "rb") as ifh:
+        return ifh.read() * 2000
+
+
+@pytest.fixture
+def bgzf_file(tmp_path, fastq_bytes):
+    plain = tmp_path / "reads.fq"
+    plain.write_bytes(fastq_bytes)
+    bgzf = str(tmp_path / "reads.bgzf.fq.gz")
+    pysam.tabix_compress(str(plain), bgzf)
+    return bgzf
+
+
+@pytest.fixture
+def multi_member_file(tmp_path, fastq_bytes):
+    mid = len(fastq_bytes) // 2
+    path = tmp_path / "reads.fq.gz"
+    path.write_bytes(gzip.compress(fastq_bytes[0:mid]) + gzip.compress(fastq_bytes[mid:]))
+    return str(path)
+
+
+def test_01_gzreader_is_bgzf(bgzf_file, multi_member_file):
+    assert gzreader.is_bgzf(bgzf_file) is True
+    assert gzreader.is_bgzf(multi_member_file) is False
+
+
+@pytest.mark.parametrize("size", [100, 1024 * 1024, -1])
+def test_02_gzreader_bgzf(bgzf_file, fastq_bytes, size):
+    assert _read_all(gzreader.BgzfReader(bgzf_file, 2), size) == fastq_bytes
+
+
+@pytest.mark.parametrize("size", [100, 1024 * 1024, -1])
+def test_03_gzreader_readahead(multi_member_file, fastq_bytes, size):
+    assert _read_all(gzreader.ReadaheadGzipReader(multi_member_file), size) == fastq_bytes
+
+
+def test_04_gzreader_truncated(tmp_path, bgzf_file, multi_member_file):
+    for (src, reader) in (
+        (bgzf_file, lambda f: gzreader.BgzfReader(f, 2)),
+        (multi_member_file, gzreader.ReadaheadGzipReader),
+    ):
+        with open(src, "rb") as ifh:
+            data = ifh.read()
+        truncated = tmp_path / "truncated.gz"
+        truncated.write_bytes(data[0:-10])
+        with pytest.raises((ValueError, EOFError)):
+            _read_all(reader(str(truncated)), 1024)
+
+
+@pytest.mark.parametrize("cpus", [1, 2])
+def test_05_gzreader_parse_reads(bgzf_file, multi_member_file, cpus):
+    expected = readparser.parse_reads(FQ, "bob", 1)[2]
+    expected = {k: v * 2000 for k, v in expected.items()}
+    for seq_file in (bgzf_file, multi_member_file):
+        assert readparser.parse_reads(seq_file, "bob", cpus)[2] == expected